@@ -0,0 +1,250 @@
+"""
+Archive of blocked emails.
+
+Emails are appended to gzip compressed mbox segments (archive/segment-00001.mbox.gz, ...) and indexed by sender, date
+and subject in archive/index.sqlite3. Every email is its own gzip member, so a single email can be read back without
+decompressing the whole segment, while "zcat segment-00001.mbox.gz" still gives a normal mbox file. Writes are
+collected during a pass and made durable with one fsync and one commit by flush().
+
+Search the archive from the terminal:
+
+    python3 archive.py --sender spam.com --since 2024-01-01
+    python3 archive.py --subject "winner" --show
+"""
+
+import argparse
+import datetime
+import gzip
+import os
+import re
+import sqlite3
+import threading
+
+ARCHIVE_DIR = 'archive'
+SEGMENT_BYTES = 64 * 1024 * 1024
+
+# the body is compressed in pieces of about this many characters, so a big email is never copied as a whole
+CHUNK_CHARS = 64 * 1024
+
+# lines starting with "From " would start a new email in the mbox
+_from_line = re.compile(r'^From ', re.MULTILINE)
+_line_break = re.compile(r'\r\n|\r')
+
+
+def mbox_chunks(sender, subject, date, text):
+    """
+    Formats an email as an mbox entry, piece by piece.
+
+    :param sender: The From header.
+    :param subject: The decoded subject.
+    :param date: The date as a datetime.
+    :param text: The decoded body.
+    :return: A generator of bytes.
+    """
+    yield ('From MAILER-DAEMON ' + date.strftime('%a %b %d %H:%M:%S %Y') + '\n' +
+           'From: ' + sender + '\n' +
+           'Subject: ' + subject + '\n' +
+           'Date: ' + date.strftime('%a, %d %b %Y %H:%M:%S %z') + '\n\n').encode('utf-8', 'replace')
+
+    # the pieces end at line breaks, so every line is escaped as a whole
+    start = 0
+    while start < len(text):
+        end = text.find('\n', start + CHUNK_CHARS)
+        end = len(text) if end < 0 else end + 1
+        yield _from_line.sub('>From ', _line_break.sub('\n', text[start:end])).encode('utf-8', 'replace')
+        start = end
+
+    yield b'\n' if text.endswith(('\n', '\r')) else b'\n\n'
+
+
+def mbox_entry(sender, subject, date, text):
+    """
+    Formats an email as an mbox entry.
+
+    :return: The entry as bytes, see mbox_chunks() for the parameters.
+    """
+    return b''.join(mbox_chunks(sender, subject, date, text))
+
+
+def _index_date(date):
+    # dates are indexed in UTC so they sort correctly
+    if date.tzinfo is not None:
+        date = date.astimezone(datetime.timezone.utc)
+    return date.isoformat()
+
+
+class Archive:
+    """
+    Can be shared by several accounts that are checked at the same time.
+    """
+
+    def __init__(self, directory=ARCHIVE_DIR, segment_bytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._segment = None
+        self._segment_name = None
+
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite3'), check_same_thread=False)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS emails (
+                id INTEGER PRIMARY KEY,
+                account TEXT,
+                folder TEXT,
+                uid INTEGER,
+                sender TEXT,
+                subject TEXT,
+                date TEXT,
+                segment TEXT,
+                offset INTEGER,
+                length INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS emails_sender ON emails (sender);
+            CREATE INDEX IF NOT EXISTS emails_date ON emails (date);
+            CREATE INDEX IF NOT EXISTS emails_subject ON emails (subject);
+        ''')
+
+    def _open_segment(self):
+        # continue the newest segment until it is full
+        segments = sorted(name for name in os.listdir(self.directory) if name.startswith('segment-'))
+        number = int(segments[-1][8:13]) if segments else 1
+        if segments and os.path.getsize(os.path.join(self.directory, segments[-1])) >= self.segment_bytes:
+            number += 1
+
+        self._segment_name = 'segment-' + str(number).zfill(5) + '.mbox.gz'
+        self._segment = open(os.path.join(self.directory, self._segment_name), 'ab')
+
+    def _segment_file(self):
+        if self._segment is None or self._segment.tell() >= self.segment_bytes:
+            self._close_segment()
+            self._open_segment()
+        return self._segment
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.flush()
+            os.fsync(self._segment.fileno())
+            self._segment.close()
+            self._segment = None
+
+    def add(self, sender, subject, date, text, uid=None, account='', folder=''):
+        """
+        Appends an email to the archive. It becomes durable and searchable with the next flush().
+
+        :param sender: The From header.
+        :param subject: The decoded subject.
+        :param date: The date as a datetime.
+        :param text: The decoded body.
+        :param uid: The UID of the email on the server.
+        :param account: The account the email was found in.
+        :param folder: The folder the email was found in.
+        """
+        with self._lock:
+            segment = self._segment_file()
+            offset = segment.tell()
+
+            # compressed straight into the segment as its own gzip member
+            with gzip.GzipFile(filename='', mode='wb', fileobj=segment, mtime=0) as member:
+                for chunk in mbox_chunks(sender, subject, date, text):
+                    member.write(chunk)
+
+            self._pending.append(
+                (account, folder, uid, sender, subject, _index_date(date), self._segment_name, offset,
+                 segment.tell() - offset)
+            )
+
+    def flush(self):
+        """
+        Makes everything added since the last flush durable: one fsync of the segment and one index commit.
+        """
+        with self._lock:
+            if not self._pending:
+                return
+
+            self._segment.flush()
+            os.fsync(self._segment.fileno())
+
+            with self.db:
+                self.db.executemany(
+                    'INSERT INTO emails (account, folder, uid, sender, subject, date, segment, offset, length) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    self._pending
+                )
+            self._pending = []
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._close_segment()
+            self.db.close()
+
+    def query(self, sender=None, subject=None, since=None, until=None, limit=100):
+        """
+        Searches the index.
+
+        :param sender: Part of the sender.
+        :param subject: Part of the subject.
+        :param since: Only emails from this ISO date on.
+        :param until: Only emails before this ISO date.
+        :param limit: The maximum number of results.
+        :return: A list of sqlite3.Row, newest first.
+        """
+        conditions = []
+        parameters = []
+        if sender:
+            conditions.append('sender LIKE ?')
+            parameters.append('%' + sender + '%')
+        if subject:
+            conditions.append('subject LIKE ?')
+            parameters.append('%' + subject + '%')
+        if since:
+            conditions.append('date >= ?')
+            parameters.append(since)
+        if until:
+            conditions.append('date < ?')
+            parameters.append(until)
+
+        self.db.row_factory = sqlite3.Row
+        return self.db.execute(
+            'SELECT * FROM emails' + (' WHERE ' + ' AND '.join(conditions) if conditions else '') +
+            ' ORDER BY date DESC LIMIT ?',
+            parameters + [limit]
+        ).fetchall()
+
+    def read(self, row):
+        """
+        Returns an archived email as text.
+
+        :param row: A result of query().
+        """
+        with open(os.path.join(self.directory, row['segment']), 'rb') as f:
+            f.seek(row['offset'])
+            return gzip.decompress(f.read(row['length'])).decode('utf-8', 'replace')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search the archive of blocked emails.')
+    parser.add_argument('--dir', default=ARCHIVE_DIR, help='the archive directory')
+    parser.add_argument('--sender', help='part of the sender')
+    parser.add_argument('--subject', help='part of the subject')
+    parser.add_argument('--since', help='only emails from this date on, e.g. 2024-01-31')
+    parser.add_argument('--until', help='only emails before this date')
+    parser.add_argument('--limit', type=int, default=100, help='the maximum number of results')
+    parser.add_argument('--show', action='store_true', help='print the emails, not just the list')
+    args = parser.parse_args()
+
+    archive = Archive(args.dir)
+    for row in archive.query(args.sender, args.subject, args.since, args.until, args.limit):
+        if args.show:
+            print(archive.read(row))
+        else:
+            date = datetime.datetime.fromisoformat(row['date'])
+            print(date.strftime('%Y-%m-%d %H:%M') + '  ' + row['sender'] + '  ' + row['subject'])
+    archive.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Compares ways of parsing Date headers on a corpus of formats seen in real emails.
+
+    strptime        the old '%a, %d %b %Y %H:%M:%S %z' after removing ' (UTC)', fails on many of the formats
+    parse_date      decoding.parse_date() without its cache
+    parse_date      decoding.parse_date() with its cache, on a stream where headers repeat like in a spam burst
+    (cached)
+
+The results are the parsed share of the corpus and microseconds per header.
+
+    python3 benchmarks/bench_dates.py
+    python3 benchmarks/bench_dates.py --headers 500000 --unique 0.2 --json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from decoding import parse_date  # noqa: E402
+
+# one template per format, filled with random dates
+FORMATS = (
+    '{weekday}, {day} {month} {year} {time} {zone}',
+    '{weekday}, {day:02d} {month} {year} {time} {zone}',
+    '{weekday}, {day} {month} {year} {time} +0000 (UTC)',
+    '{weekday}, {day} {month} {year} {time} {zone} ({zone_name})',
+    '{day} {month} {year} {time} {zone}',
+    '{weekday}, {day} {month} {year} {time} GMT',
+    '{weekday}, {day} {month} {year} {time} EST',
+    '{weekday}, {day} {month} {year} {short_time} {zone}',
+    '{weekday}, {day} {month} {short_year} {time} {zone}',
+    '{weekday}, {day} {month} {year} {time} -0000',
+    '{weekday},  {day} {month} {year} {time} {zone}',
+    '{weekday}, {day} {month} {year} {time}',
+    'not a date',
+    '',
+)
+
+ZONES = (('+0000', 'UTC'), ('+0200', 'CEST'), ('-0700', 'PDT'), ('+0530', 'IST'), ('-0500', 'EST'))
+
+
+def old_parse(value):
+    try:
+        return datetime.datetime.strptime(value.replace(' (UTC)', ''), '%a, %d %b %Y %H:%M:%S %z')
+    except ValueError:
+        return None
+
+
+def make_header(rng):
+    date = datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=rng.randrange(5 * 365 * 86400))
+    zone, zone_name = rng.choice(ZONES)
+    return rng.choice(FORMATS).format(
+        weekday=date.strftime('%a'), day=date.day, month=date.strftime('%b'), year=date.year,
+        short_year=date.strftime('%y'), time=date.strftime('%H:%M:%S'), short_time=date.strftime('%H:%M'),
+        zone=zone, zone_name=zone_name
+    )
+
+
+def measure(parse, headers):
+    start_time = perf_counter()
+    parsed = sum(parse(header) is not None for header in headers)
+    seconds = perf_counter() - start_time
+    return {'parsed': parsed / len(headers), 'us_per_header': seconds / len(headers) * 1e6}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--headers', type=int, default=200000, help='how many headers are parsed')
+    parser.add_argument('--unique', type=float, default=0.01, help='the share of distinct headers in the stream')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    distinct = [make_header(rng) for _ in range(max(1, int(args.headers * args.unique)))]
+    headers = [rng.choice(distinct) for _ in range(args.headers)]
+
+    parse_date.cache_clear()
+    results = {
+        'strptime': measure(old_parse, headers),
+        'parse_date': measure(parse_date.__wrapped__, headers),
+        'parse_date (cached)': measure(parse_date, headers),
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print('{:<20} {:>8} {:>10}'.format('parser', 'parsed', 'us/header'))
+    for name, result in results.items():
+        print('{:<20} {:>7.1f}% {:>10.2f}'.format(name, result['parsed'] * 100, result['us_per_header']))
+
+
+if __name__ == '__main__':
+    main()
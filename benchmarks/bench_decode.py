@@ -0,0 +1,87 @@
+"""
+Compares the old character-by-character decode_email_str with decoding.decode_part on quoted-printable bodies of
+1 KB, 1 MB and 20 MB.
+
+    python3 benchmarks/bench_decode.py
+    python3 benchmarks/bench_decode.py --skip-legacy-above 1000000
+"""
+
+import argparse
+import os
+import quopri
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from decoding import decode_part  # noqa: E402
+
+SIZES = (1000, 1000 * 1000, 20 * 1000 * 1000)
+
+MIME_HEADERS = b'Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n'
+
+
+def legacy_decode_email_str(email_input: str):
+    # the implementation from main.py before the decoding module existed
+    decoded_email = ''
+    i = 0
+    while i < len(email_input) - 1:
+
+        hex_code = ''
+        while i < len(email_input) - 2 and email_input[i] == '=' and \
+                email_input[i + 1].isalnum() and email_input[i + 2].isalnum():
+            hex_code += (email_input[i + 1] + email_input[i + 2])
+            i += 3
+
+        if hex_code != '':
+            decoded_email += bytes.fromhex(hex_code).decode("utf-8", "ignore")
+            if i < len(email_input) - 1 and email_input[i] == '=':
+                i += 1
+
+        if i < len(email_input) - 1:
+            decoded_email += email_input[i]
+            i += 1
+
+    return decoded_email
+
+
+def make_body(size):
+    line = 'Grüße from the spam department, this offer is only valid today – act now!\n'
+    text = (line * (size // len(line) + 1))[:size]
+    return quopri.encodestring(text.encode('utf-8'))
+
+
+def best_of(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--skip-legacy-above', type=int, default=None,
+                        help='skip the old function for bodies larger than this many bytes')
+    args = parser.parse_args()
+
+    print('{:>10} {:>12} {:>12} {:>10}'.format('body', 'legacy ms', 'new ms', 'speedup'))
+    for size in SIZES:
+        body = make_body(size)
+        repeat = 5 if size < 10 * 1000 * 1000 else 1
+
+        new = best_of(lambda: decode_part(body, MIME_HEADERS), repeat)
+
+        if args.skip_legacy_above is not None and size > args.skip_legacy_above:
+            print('{:>10} {:>12} {:>12.2f} {:>10}'.format(size, '-', new * 1000, '-'))
+            continue
+
+        text = body.decode('ascii')
+        legacy = best_of(lambda: legacy_decode_email_str(text), repeat)
+        print('{:>10} {:>12.2f} {:>12.2f} {:>9.0f}x'.format(size, legacy * 1000, new * 1000, legacy / new))
+
+
+if __name__ == '__main__':
+    main()
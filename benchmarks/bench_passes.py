@@ -0,0 +1,222 @@
+"""
+Runs complete passes of the bot against the fake IMAP server and SMTP sink in fake_servers.py, no mail account needed.
+
+Scenarios:
+    folder_10k      a folder with 10,000 emails (2% spam) is scanned completely on every pass
+    blacklist_50k   1,000 emails are checked against a blacklist with 50,000 entries
+    spam_burst      500 new spam emails arrive before every pass and are archived, replied to and deleted
+    backfill        the first run over a folder with 20,000 emails (30% spam), all archived and deleted at once
+    backfill_stream the same in stream mode: windows of 1,000 UIDs and at most 16 MB of bodies at a time
+
+Every scenario runs in its own process, so the peak RSS (which includes the fake server's mailbox) belongs to that
+scenario alone. The results are passes per second, the p50/p99 pass latency and the peak RSS.
+
+    python3 benchmarks/bench_passes.py
+    python3 benchmarks/bench_passes.py --scenario spam_burst --latency 5 --passes 20
+    python3 benchmarks/bench_passes.py --scale 0.1 --json > results.json
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from time import perf_counter, sleep
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_servers import FakeIMAPServer, FakeSMTPServer, Mailbox, fill_mailbox  # noqa: E402
+
+SCENARIOS = {
+    'folder_10k': {'messages': 10000, 'spam_ratio': 0.02, 'blacklist': 100, 'burst': 0, 'full_scan': True,
+                   'handle': False},
+    'blacklist_50k': {'messages': 1000, 'spam_ratio': 0.05, 'blacklist': 50000, 'burst': 0, 'full_scan': True,
+                      'handle': False},
+    'spam_burst': {'messages': 5000, 'spam_ratio': 0.0, 'blacklist': 200, 'burst': 500, 'full_scan': False,
+                   'handle': True},
+    'backfill': {'messages': 20000, 'spam_ratio': 0.3, 'blacklist': 100, 'burst': 0, 'full_scan': True,
+                 'handle': True, 'settings': {'also_reply_to_email': False}},
+    'backfill_stream': {'messages': 20000, 'spam_ratio': 0.3, 'blacklist': 100, 'burst': 0, 'full_scan': True,
+                        'handle': True, 'settings': {'also_reply_to_email': False, 'stream_mode': True,
+                                                     'stream_window': 1000, 'stream_memory_mb': 16}},
+}
+
+
+def bench_blacklist(size):
+    return ['@spam' + str(number) + '.test' for number in range(size)]
+
+
+def bench_settings(imap_port, smtp_port, workdir, blacklist, handle, max_results):
+    from widgets import config_defaults
+    from config_service import validate
+
+    settings = {
+        **config_defaults,
+        'username': 'bench@example.com',
+        'password': 'bench',
+        'imap_address': '127.0.0.1',
+        'imap_port': imap_port,
+        'imap_ssl': False,
+        'smtp_address': '127.0.0.1',
+        'smtp_port': smtp_port,
+        'smtp_starttls': False,
+        'blacklist': blacklist,
+        'search_mail_folder': 'INBOX',
+        'max_search_results': max_results,
+        'update_interval': 10,
+        'idle_mode': False,
+        'also_reply_to_email': handle,
+        'save_archive': handle,
+        'block_emails': handle,
+        'spool_dir': os.path.join(workdir, 'spool'),
+        'archive_dir': os.path.join(workdir, 'archive'),
+        'sender_reply_limit': 10 ** 9,
+        'global_reply_limit': 10 ** 9,
+    }
+    validate(settings)
+    return settings
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_scenario(name, passes, latency, scale):
+    from main import EmailBlocker
+    from scan_state import ScanState
+    from reply_cache import ReplyCache
+    from archive import Archive
+
+    # the reply templates are found relative to the repository
+    os.chdir(ROOT)
+
+    scenario = SCENARIOS[name]
+    rng = random.Random(1)
+    blacklist = bench_blacklist(max(1, int(scenario['blacklist'] * scale)))
+    message_count = int(scenario['messages'] * scale)
+    burst = int(scenario['burst'] * scale)
+
+    def sender(number):
+        if rng.random() < scenario['spam_ratio']:
+            return 'Spammer <user' + str(number) + rng.choice(blacklist) + '>'
+        return 'Friend ' + str(number) + ' <friend' + str(number) + '@example.org>'
+
+    mailbox = Mailbox()
+    fill_mailbox(mailbox, message_count, sender, rng)
+
+    with tempfile.TemporaryDirectory() as workdir, \
+            FakeIMAPServer({'INBOX': mailbox}, latency) as imap_server, \
+            FakeSMTPServer(latency) as smtp_server, \
+            open(os.devnull, 'w') as devnull:
+
+        settings = bench_settings(imap_server.port, smtp_server.port, workdir, blacklist, scenario['handle'],
+                                  message_count + burst * passes)
+        settings.update(scenario.get('settings', {}))
+        archive = Archive(settings['archive_dir'])
+
+        start_time = perf_counter()
+        with redirect_stdout(devnull):
+            blocker = EmailBlocker(
+                settings,
+                ScanState(os.path.join(workdir, 'state.json')),
+                archive=archive,
+                reply_cache=ReplyCache(settings, os.path.join(workdir, 'reply_cache.json')),
+                interactive=False
+            )
+            blocker.replies.start()
+        setup_seconds = perf_counter() - start_time
+
+        latencies = []
+        scanned = blocked = 0
+        for number in range(passes):
+            if burst:
+                fill_mailbox(mailbox, burst, lambda n: 'Spammer <burst' + str(number) + '-' + str(n) +
+                             rng.choice(blacklist) + '>', rng)
+            if scenario['full_scan']:
+                blocker.scan_state.folders.clear()
+
+            start_time = perf_counter()
+            with redirect_stdout(devnull):
+                pass_scanned, pass_blocked = blocker.bot_pass()
+            latencies.append(perf_counter() - start_time)
+            scanned += pass_scanned
+            blocked += pass_blocked
+
+        # the replies are sent in the background, wait for them to get the SMTP throughput too
+        start_time = perf_counter()
+        with redirect_stdout(devnull):
+            while blocker.replies.pending() and perf_counter() - start_time < 120:
+                sleep(0.05)
+            drain_seconds = perf_counter() - start_time
+            blocker.close()
+        archive.close()
+
+    return {
+        'scenario': name,
+        'passes': passes,
+        'passes_per_second': passes / sum(latencies),
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'scanned_per_pass': scanned / passes,
+        'blocked': blocked,
+        'replies_sent': smtp_server.received,
+        'reply_drain_seconds': drain_seconds,
+        'setup_seconds': setup_seconds,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), action='append',
+                        help='the scenario to run, can be given several times (default: all)')
+    parser.add_argument('--passes', type=int, default=5, help='passes per scenario')
+    parser.add_argument('--latency', type=float, default=0.0, help='milliseconds every server command is delayed by')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the number of emails and entries')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    scenarios = args.scenario or list(SCENARIOS)
+
+    if args.child:
+        print(json.dumps(run_scenario(scenarios[0], args.passes, args.latency / 1000, args.scale)))
+        return
+
+    results = []
+    for name in scenarios:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', '--scenario', name, '--passes', str(args.passes),
+             '--latency', str(args.latency), '--scale', str(args.scale)],
+            check=True, stdout=subprocess.PIPE, text=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+        if not args.json:
+            if len(results) == 1:
+                print('{:<14} {:>9} {:>9} {:>9} {:>9} {:>8} {:>8} {:>8}'.format(
+                    'scenario', 'passes/s', 'p50 ms', 'p99 ms', 'scanned', 'blocked', 'replies', 'RSS MB'))
+            result = results[-1]
+            print('{:<14} {:>9.2f} {:>9.1f} {:>9.1f} {:>9.0f} {:>8} {:>8} {:>8.1f}'.format(
+                name, result['passes_per_second'], result['p50_ms'], result['p99_ms'], result['scanned_per_pass'],
+                result['blocked'], result['replies_sent'], result['peak_rss_mb']))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Measures how the blacklist search scales with the size of the blacklist.
+
+Without arguments only the query planning is measured (time, number of SEARCH commands and bytes sent).
+With --live the queries are also run against the account in "config files/config.yml" (read-only), which shows the
+actual search time on that server.
+
+    python3 benchmarks/bench_search.py
+    python3 benchmarks/bench_search.py --live --connections 4
+"""
+
+import argparse
+import os
+import random
+import string
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from blacklist import BlacklistMatcher  # noqa: E402
+from search_query import plan_search, run_search  # noqa: E402
+
+SIZES = (10, 100, 1000, 10000, 50000)
+
+
+def random_blacklist(size, seed=1):
+    rng = random.Random(seed)
+    entries = []
+    for _ in range(size):
+        name = ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(5, 12)))
+        domain = ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 10)))
+        entries.append(rng.choice([name, '@' + domain + '.com', name + '@' + domain + '.com']))
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--live', action='store_true', help='also run the searches against the configured account')
+    parser.add_argument('--budget', type=int, default=8000, help='command size budget in bytes')
+    parser.add_argument('--connections', type=int, default=1, help='connections to spread the searches over')
+    args = parser.parse_args()
+
+    imap = settings = None
+    if args.live:
+        from widgets import config
+        from connections import open_imap
+
+        settings = config()
+        imap = open_imap(settings)
+        imap.select(settings['search_mail_folder'], readonly=True)
+
+    def connect():
+        extra = open_imap(settings)
+        extra.select(settings['search_mail_folder'], readonly=True)
+        return extra
+
+    print('{:>8} {:>10} {:>9} {:>10} {:>10}'.format('entries', 'plan ms', 'commands', 'bytes', 'search ms'))
+    for size in SIZES:
+        blacklist = random_blacklist(size)
+
+        start = perf_counter()
+        queries = plan_search(BlacklistMatcher(blacklist).search_terms(), budget=args.budget)
+        plan_ms = (perf_counter() - start) * 1000
+
+        search_ms = ''
+        if imap is not None:
+            start = perf_counter()
+            run_search(imap, queries, connect=connect, connections=args.connections)
+            search_ms = '{:.1f}'.format((perf_counter() - start) * 1000)
+
+        print('{:>8} {:>10.1f} {:>9} {:>10} {:>10}'.format(
+            size, plan_ms, len(queries), sum(len(query) for query in queries), search_ms
+        ))
+
+    if imap is not None:
+        imap.logout()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,612 @@
+"""
+An in-process fake IMAP server and SMTP sink, so the bot can be benchmarked without a real mailbox.
+
+The IMAP server understands the commands the bot uses (LOGIN, SELECT, NOOP, UID SEARCH, UID FETCH with BODYSTRUCTURE,
+UID STORE, UID EXPUNGE, EXPUNGE, UID MOVE, UID COPY, CREATE, IDLE, LOGOUT) and answers the way real servers do,
+including literals and partial fetches. Emails added to a folder while a connection idles on it are announced with
+EXISTS, so push mode can be tried out as well.
+Every command can be slowed down by a fixed latency to imitate a server on the other side of the internet.
+The SMTP sink accepts every email and only counts them.
+
+    mailbox = Mailbox()
+    mailbox.add(make_message(rng, 'spam@example.com'))
+    with FakeIMAPServer({'INBOX': mailbox}, latency=0.002) as imap_server, FakeSMTPServer() as smtp_server:
+        ... connect to 127.0.0.1:imap_server.port without SSL
+"""
+
+import base64
+import datetime
+import email.utils
+import quopri
+import random
+import re
+import socketserver
+import threading
+from time import sleep, time
+
+ENCODINGS = ('7bit', 'quoted-printable', 'base64')
+
+_WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'offer', 'winner', 'meeting', 'invoice', 'tomorrow', 'price',
+          'grüße', 'café', 'naïve', 'déjà', 'vu', 'free', 'urgent', 'account', 'update')
+
+_token = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+_literal = re.compile(rb'\{(\d+)\+?\}\r\n$')
+_header_fields = re.compile(rb'HEADER\.FIELDS \(([^)]*)\)', re.IGNORECASE)
+_partial = re.compile(rb'BODY(?:\.PEEK)?\[1\]<(\d+)\.(\d+)>', re.IGNORECASE)
+
+
+def make_message(rng, sender, body_bytes=2000, encoding='7bit', subject=None, date=None):
+    """
+    Builds a plain text email.
+
+    :param rng: A random.Random.
+    :param sender: The From header.
+    :param body_bytes: The approximate size of the decoded body.
+    :param encoding: One of ENCODINGS.
+    :param subject: The subject, random if not given.
+    :param date: The Date header, now if not given.
+    :return: The raw email as bytes.
+    """
+    words = []
+    size = 0
+    while size < body_bytes:
+        word = rng.choice(_WORDS)
+        words.append(word + ('\n' if rng.random() < 0.1 else ' '))
+        size += len(word) + 1
+    body = ''.join(words).encode('utf-8')
+
+    if encoding == 'base64':
+        body = base64.encodebytes(body)
+    elif encoding == 'quoted-printable':
+        body = quopri.encodestring(body)
+    else:
+        # 7bit bodies can't contain the umlauts
+        body = body.decode('utf-8').encode('ascii', 'replace')
+
+    headers = [
+        'From: ' + sender,
+        'To: bench@example.com',
+        'Subject: ' + (subject or ' '.join(rng.choice(_WORDS) for _ in range(5))),
+        'Date: ' + (date or email.utils.formatdate(localtime=True)),
+        'Message-ID: ' + email.utils.make_msgid(str(rng.randrange(10 ** 9))),
+        'MIME-Version: 1.0',
+        'Content-Type: text/plain; charset="utf-8"',
+        'Content-Transfer-Encoding: ' + encoding,
+    ]
+    return '\r\n'.join(headers).encode('utf-8') + b'\r\n\r\n' + body.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+
+
+class FakeMessage:
+
+    def __init__(self, uid, raw, internaldate=None):
+        self.uid = uid
+        self.raw = raw
+        self.flags = set()
+        # when the server received the email, a timestamp
+        self.internaldate = time() if internaldate is None else internaldate
+
+        header, _, self.body = raw.partition(b'\r\n\r\n')
+        # header name -> the complete header line(s)
+        self.headers = {}
+        for line in re.split(rb'\r\n(?![ \t])', header):
+            name = line.split(b':', 1)[0].strip().upper()
+            self.headers[name] = self.headers.get(name, b'') + line + b'\r\n'
+
+        self.sender = self.header_value(b'FROM').lower()
+        self.subject = self.header_value(b'SUBJECT').lower()
+        self.mime = self.headers.get(b'CONTENT-TYPE', b'') + self.headers.get(b'CONTENT-TRANSFER-ENCODING', b'') + \
+            b'\r\n'
+
+        # every fake email is a single text part
+        encoding = self.header_value(b'CONTENT-TRANSFER-ENCODING').upper().encode() or b'7BIT'
+        self.structure = b'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "' + encoding + b'" ' + \
+            str(len(self.body)).encode() + b' ' + str(self.body.count(b'\n')).encode() + b')'
+
+    def header_value(self, name):
+        line = self.headers.get(name, b'')
+        return line.partition(b':')[2].strip().decode('utf-8', 'replace')
+
+    def header_fields(self, names):
+        return b''.join(self.headers.get(name, b'') for name in names) + b'\r\n'
+
+
+class Mailbox:
+    """
+    A mail folder. Emails can be added while the server is running, e.g. to imitate a spam burst.
+    """
+
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.next_uid = 1
+        self.lock = threading.Lock()
+        # notified when emails are added, for the connections in IDLE
+        self.added = threading.Condition(self.lock)
+
+    def add(self, raw, internaldate=None):
+        with self.lock:
+            self.messages.append(FakeMessage(self.next_uid, raw, internaldate))
+            self.next_uid += 1
+            self.added.notify_all()
+
+    def add_copy(self, message):
+        # copies keep their flags and arrival date but get a new UID
+        with self.lock:
+            copy = FakeMessage(self.next_uid, message.raw, message.internaldate)
+            copy.flags = set(message.flags)
+            self.messages.append(copy)
+            self.next_uid += 1
+            self.added.notify_all()
+
+    def __len__(self):
+        return len(self.messages)
+
+
+def _uid_set(text, max_uid):
+    uids = set()
+    for part in text.split(b','):
+        first, _, last = part.partition(b':')
+        first = max_uid if first == b'*' else int(first)
+        last = first if not last else max_uid if last == b'*' else int(last)
+        if first > last:
+            first, last = last, first
+        uids.add((first, last))
+    return uids
+
+
+def _in_uid_set(uid, ranges):
+    return any(first <= uid <= last for first, last in ranges)
+
+
+def _unquote(token):
+    if token.startswith(b'"'):
+        return re.sub(rb'\\(.)', rb'\1', token[1:-1])
+    return token
+
+
+class _FromAny:
+    # a whole OR tree of FROM keys, checked with one regex of the escaped terms instead of the bot's matcher, so a bug
+    # in it isn't mirrored
+
+    def __init__(self, terms):
+        self.terms = terms
+        self.pattern = None
+
+    def matches(self, message, ranges):
+        # compiled on the first email only, OR keys are merged term by term while the search is parsed
+        if self.pattern is None:
+            self.pattern = re.compile('|'.join(map(re.escape, self.terms)))
+        return self.pattern.search(message.sender) is not None
+
+
+def _parse_key(tokens):
+    token = tokens.pop(0)
+    upper = token.upper()
+
+    if token == b'(':
+        keys = []
+        while tokens[0] != b')':
+            keys.append(_parse_key(tokens))
+        tokens.pop(0)
+        return lambda message, ranges: all(_matches(key, message, ranges) for key in keys)
+    if upper == b'ALL':
+        return lambda message, ranges: True
+    if upper == b'UID':
+        uid_set = tokens.pop(0)
+        return lambda message, ranges: _in_uid_set(message.uid, ranges[uid_set])
+    if upper == b'FROM':
+        return _FromAny([_unquote(tokens.pop(0)).decode('utf-8').lower()])
+    if upper == b'SUBJECT':
+        term = _unquote(tokens.pop(0)).decode('utf-8').lower()
+        return lambda message, ranges: term in message.subject
+    if upper == b'BEFORE':
+        date = datetime.datetime.strptime(_unquote(tokens.pop(0)).decode('ascii'), '%d-%b-%Y').timestamp()
+        return lambda message, ranges: message.internaldate < date
+    if upper == b'DELETED':
+        return lambda message, ranges: '\\Deleted' in message.flags
+    if upper == b'UNDELETED':
+        return lambda message, ranges: '\\Deleted' not in message.flags
+    if upper == b'NOT':
+        key = _parse_key(tokens)
+        return lambda message, ranges: not _matches(key, message, ranges)
+    if upper == b'OR':
+        left = _parse_key(tokens)
+        right = _parse_key(tokens)
+        if isinstance(left, _FromAny) and isinstance(right, _FromAny):
+            return _FromAny(left.terms + right.terms)
+        return lambda message, ranges: _matches(left, message, ranges) or _matches(right, message, ranges)
+    raise ValueError('unsupported search key ' + token.decode('ascii', 'replace'))
+
+
+def _internaldate(timestamp):
+    date = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    return (str(date.day).rjust(2) + date.strftime('-%b-%Y %H:%M:%S +0000')).encode('ascii')
+
+
+def _matches(key, message, ranges):
+    return key.matches(message, ranges) if isinstance(key, _FromAny) else key(message, ranges)
+
+
+class _IMAPHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        self.mailbox = None
+        # the UIDNEXT of the last EXISTS sent, emails from there on are announced by the next IDLE
+        self.announced_uid = 0
+        self.server.connections += 1
+
+    def send(self, data):
+        self.wfile.write(data)
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+
+        # collect the literals, e.g. a search term with non-ASCII characters
+        while True:
+            literal = _literal.search(line)
+            if not literal:
+                return line.rstrip(b'\r\n')
+            self.send(b'+ Ready for literal data\r\n')
+            line = line[:literal.start()] + b'"' + self.rfile.read(int(literal.group(1))) + b'"' + \
+                self.rfile.readline()
+
+    def handle(self):
+        self.send(b'* OK [CAPABILITY ' + self.server.capabilities + b' AUTH=PLAIN] Fake IMAP server ready\r\n')
+        while True:
+            line = self.read_command()
+            if line is None:
+                return
+
+            tag, _, rest = line.partition(b' ')
+            command, _, arguments = rest.partition(b' ')
+            command = command.upper()
+            if command == b'UID':
+                command, _, arguments = arguments.partition(b' ')
+                command = b'UID ' + command.upper()
+
+            if self.server.latency:
+                sleep(self.server.latency)
+
+            handler = getattr(self, 'do_' + command.decode('ascii', 'replace').replace(' ', '_'), None)
+            if handler is None:
+                self.send(tag + b' BAD Unknown command\r\n')
+                continue
+            try:
+                if handler(tag, arguments) is False:
+                    return
+            except (ValueError, IndexError, KeyError) as e:
+                self.send(tag + b' BAD ' + str(e).encode('utf-8', 'replace') + b'\r\n')
+
+    def do_CAPABILITY(self, tag, arguments):
+        self.send(b'* CAPABILITY ' + self.server.capabilities + b' AUTH=PLAIN\r\n' +
+                  tag + b' OK CAPABILITY completed\r\n')
+
+    def do_LOGIN(self, tag, arguments):
+        self.send(tag + b' OK [CAPABILITY ' + self.server.capabilities + b'] Logged in\r\n')
+
+    def do_NOOP(self, tag, arguments):
+        self.send(tag + b' OK NOOP completed\r\n')
+
+    def do_LOGOUT(self, tag, arguments):
+        self.send(b'* BYE Logging out\r\n' + tag + b' OK LOGOUT completed\r\n')
+        return False
+
+    def do_SELECT(self, tag, arguments):
+        mailbox = self.server.find_mailbox(arguments.strip())
+        if mailbox is None:
+            self.mailbox = None
+            self.send(tag + b' NO Mailbox does not exist\r\n')
+            return
+
+        self.mailbox = mailbox
+        with mailbox.lock:
+            count = len(mailbox)
+            self.announced_uid = mailbox.next_uid
+        self.send(b'* ' + str(count).encode() + b' EXISTS\r\n'
+                  b'* 0 RECENT\r\n'
+                  b'* OK [UIDVALIDITY ' + str(mailbox.uidvalidity).encode() + b'] UIDs valid\r\n'
+                  b'* OK [UIDNEXT ' + str(self.announced_uid).encode() + b'] Predicted next UID\r\n' +
+                  tag + b' OK [READ-WRITE] SELECT completed\r\n')
+
+    do_EXAMINE = do_SELECT
+
+    def do_CLOSE(self, tag, arguments):
+        if self.mailbox is not None:
+            self.expunge(None, announce=False)
+        self.mailbox = None
+        self.send(tag + b' OK CLOSE completed\r\n')
+
+    def do_IDLE(self, tag, arguments):
+        self.send(b'+ idling\r\n')
+        done = threading.Event()
+        mailbox = self.mailbox
+
+        def announce():
+            # new emails are pushed while idling, until the client sends DONE. Emails that came in since the last
+            # EXISTS are announced right away, like a real server does
+            while True:
+                with mailbox.added:
+                    mailbox.added.wait_for(lambda: done.is_set() or mailbox.next_uid != self.announced_uid)
+                    if done.is_set():
+                        return
+                    self.announced_uid = mailbox.next_uid
+                    count = len(mailbox)
+                self.send(b'* ' + str(count).encode() + b' EXISTS\r\n')
+
+        announcer = threading.Thread(target=announce, daemon=True) if mailbox is not None else None
+        if announcer is not None:
+            announcer.start()
+
+        self.rfile.readline()
+        if announcer is not None:
+            with mailbox.added:
+                done.set()
+                mailbox.added.notify_all()
+            announcer.join()
+        self.send(tag + b' OK IDLE terminated\r\n')
+
+    def do_UID_SEARCH(self, tag, arguments):
+        tokens = _token.findall(arguments)
+        if tokens and tokens[0].upper() == b'CHARSET':
+            tokens = tokens[2:]
+
+        # compiled searches are reused, the bot sends the same queries on every pass
+        key_text = b' '.join(tokens)
+        keys = self.server.search_cache.get(key_text)
+        if keys is None:
+            keys = []
+            while tokens:
+                keys.append(_parse_key(tokens))
+            self.server.search_cache[key_text] = keys
+
+        with self.mailbox.lock:
+            messages = list(self.mailbox.messages)
+        max_uid = messages[-1].uid if messages else 0
+        ranges = {uid_set: _uid_set(uid_set, max_uid) for uid_set in _token.findall(arguments) if
+                  re.match(rb'^[\d*]+(:[\d*]+)?(,[\d*]+(:[\d*]+)?)*$', uid_set)}
+
+        found = [str(message.uid).encode() for message in messages
+                 if all(_matches(key, message, ranges) for key in keys)]
+        self.send(b'* SEARCH' + b''.join(b' ' + uid for uid in found) + b'\r\n' + tag + b' OK SEARCH completed\r\n')
+
+    def do_UID_FETCH(self, tag, arguments):
+        uid_set, _, items = arguments.partition(b' ')
+        fields = _header_fields.search(items)
+        fields = fields.group(1).upper().split() if fields else None
+        partial = _partial.search(items)
+        wants_mime = b'1.MIME]' in items.upper()
+        wants_body = partial is not None or b'[1]' in items
+        wants_structure = b'BODYSTRUCTURE' in items.upper()
+        wants_internaldate = b'INTERNALDATE' in items.upper()
+        wants_flags = re.search(rb'\bFLAGS\b', items.upper()) is not None
+
+        with self.mailbox.lock:
+            messages = list(self.mailbox.messages)
+        ranges = _uid_set(uid_set, messages[-1].uid if messages else 0)
+
+        response = []
+        for seq, message in enumerate(messages, 1):
+            if not _in_uid_set(message.uid, ranges):
+                continue
+
+            response.append(b'* ' + str(seq).encode() + b' FETCH (UID ' + str(message.uid).encode())
+            if wants_flags:
+                response.append(b' FLAGS (' + ' '.join(sorted(message.flags)).encode() + b')')
+            if wants_internaldate:
+                response.append(b' INTERNALDATE "' + _internaldate(message.internaldate) + b'"')
+            if wants_structure:
+                response.append(b' BODYSTRUCTURE ' + message.structure)
+            if fields is not None:
+                data = message.header_fields(fields)
+                response.append(b' BODY[HEADER.FIELDS (' + b' '.join(fields) + b')] {' + str(len(data)).encode() +
+                                b'}\r\n' + data)
+            if wants_mime:
+                response.append(b' BODY[1.MIME] {' + str(len(message.mime)).encode() + b'}\r\n' + message.mime)
+            if wants_body:
+                if partial is not None:
+                    start, length = int(partial.group(1)), int(partial.group(2))
+                    data = message.body[start:start + length]
+                    response.append(b' BODY[1]<' + str(start).encode() + b'> {' + str(len(data)).encode() +
+                                    b'}\r\n' + data)
+                else:
+                    response.append(b' BODY[1] {' + str(len(message.body)).encode() + b'}\r\n' + message.body)
+            response.append(b')\r\n')
+
+        response.append(tag + b' OK FETCH completed\r\n')
+        self.send(b''.join(response))
+
+    def do_UID_STORE(self, tag, arguments):
+        uid_set, _, rest = arguments.partition(b' ')
+        action, _, flags = rest.partition(b' ')
+        flags = {flag.decode('ascii') for flag in flags.strip(b'()').split()}
+
+        with self.mailbox.lock:
+            ranges = _uid_set(uid_set, self.mailbox.messages[-1].uid if self.mailbox.messages else 0)
+            for message in self.mailbox.messages:
+                if _in_uid_set(message.uid, ranges):
+                    if action.upper().startswith(b'+'):
+                        message.flags |= flags
+                    elif action.upper().startswith(b'-'):
+                        message.flags -= flags
+                    else:
+                        message.flags = set(flags)
+        self.send(tag + b' OK STORE completed\r\n')
+
+    def expunge(self, uid_set, announce=True):
+        with self.mailbox.lock:
+            ranges = _uid_set(uid_set, self.mailbox.messages[-1].uid if self.mailbox.messages else 0) \
+                if uid_set else None
+            expunged = [seq for seq, message in enumerate(self.mailbox.messages, 1)
+                        if '\\Deleted' in message.flags and (ranges is None or _in_uid_set(message.uid, ranges))]
+            for seq in reversed(expunged):
+                del self.mailbox.messages[seq - 1]
+
+        # highest first, so the sequence numbers of the others don't change
+        if announce:
+            self.send(b''.join(b'* ' + str(seq).encode() + b' EXPUNGE\r\n' for seq in reversed(expunged)))
+
+    def copy(self, tag, arguments):
+        uid_set, _, name = arguments.partition(b' ')
+        target = self.server.find_mailbox(name.strip())
+        if target is None:
+            self.send(tag + b' NO [TRYCREATE] Mailbox does not exist\r\n')
+            return False
+
+        with self.mailbox.lock:
+            ranges = _uid_set(uid_set, self.mailbox.messages[-1].uid if self.mailbox.messages else 0)
+            messages = [message for message in self.mailbox.messages if _in_uid_set(message.uid, ranges)]
+        for message in messages:
+            target.add_copy(message)
+        return True
+
+    def do_UID_COPY(self, tag, arguments):
+        if self.copy(tag, arguments):
+            self.send(tag + b' OK COPY completed\r\n')
+
+    def do_UID_MOVE(self, tag, arguments):
+        if b'MOVE' not in self.server.capabilities.split():
+            self.send(tag + b' BAD Unknown command\r\n')
+            return
+        if not self.copy(tag, arguments):
+            return
+
+        uid_set = arguments.partition(b' ')[0]
+        with self.mailbox.lock:
+            ranges = _uid_set(uid_set, self.mailbox.messages[-1].uid if self.mailbox.messages else 0)
+            moved = [seq for seq, message in enumerate(self.mailbox.messages, 1) if _in_uid_set(message.uid, ranges)]
+            for seq in reversed(moved):
+                del self.mailbox.messages[seq - 1]
+        self.send(b''.join(b'* ' + str(seq).encode() + b' EXPUNGE\r\n' for seq in reversed(moved)) +
+                  tag + b' OK MOVE completed\r\n')
+
+    def do_CREATE(self, tag, arguments):
+        name = _unquote(arguments.strip()).decode('utf-8')
+        if self.server.find_mailbox(arguments.strip()) is not None:
+            self.send(tag + b' NO [ALREADYEXISTS] Mailbox already exists\r\n')
+            return
+        self.server.mailboxes[name] = Mailbox()
+        self.send(tag + b' OK CREATE completed\r\n')
+
+    def do_EXPUNGE(self, tag, arguments):
+        self.expunge(None)
+        self.send(tag + b' OK EXPUNGE completed\r\n')
+
+    def do_UID_EXPUNGE(self, tag, arguments):
+        self.expunge(arguments.strip())
+        self.send(tag + b' OK EXPUNGE completed\r\n')
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.wfile.write(b'220 fake.smtp ESMTP ready\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+
+            if self.server.latency:
+                sleep(self.server.latency)
+
+            if command == b'EHLO':
+                self.wfile.write(b'250-fake.smtp\r\n250-AUTH PLAIN LOGIN\r\n250-8BITMIME\r\n250 SIZE 52428800\r\n')
+            elif command == b'HELO':
+                self.wfile.write(b'250 fake.smtp\r\n')
+            elif command == b'AUTH':
+                if line.upper().startswith(b'AUTH LOGIN'):
+                    self.wfile.write(b'334 VXNlcm5hbWU6\r\n')
+                    self.rfile.readline()
+                    self.wfile.write(b'334 UGFzc3dvcmQ6\r\n')
+                    self.rfile.readline()
+                self.wfile.write(b'235 Authentication successful\r\n')
+            elif command == b'DATA':
+                self.wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                size = 0
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data == b'.\r\n':
+                        break
+                    size += len(data)
+                with self.server.lock:
+                    self.server.received += 1
+                    self.server.received_bytes += size
+                self.wfile.write(b'250 Queued\r\n')
+            elif command == b'QUIT':
+                self.wfile.write(b'221 Bye\r\n')
+                return
+            else:
+                # MAIL, RCPT, RSET and NOOP are simply accepted
+                self.wfile.write(b'250 OK\r\n')
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler, latency):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.latency = latency
+        self.port = self.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeIMAPServer(_Server):
+
+    def __init__(self, mailboxes, latency=0.0, move=True):
+        """
+        :param mailboxes: A dict of folder name -> Mailbox, folders created by the bot are added to it.
+        :param latency: Seconds every command is delayed by.
+        :param move: Whether the server supports UID MOVE, otherwise the bot has to copy and delete.
+        """
+        super().__init__(_IMAPHandler, latency)
+        self.mailboxes = mailboxes
+        self.search_cache = {}
+        self.connections = 0
+        self.capabilities = b'IMAP4rev1 UIDPLUS IDLE' + (b' MOVE' if move else b'')
+
+    def find_mailbox(self, name):
+        """
+        :param name: The folder name as sent by the client, maybe quoted.
+        :return: The Mailbox or None.
+        """
+        name = _unquote(name).decode('utf-8').lower()
+        return next((box for box_name, box in self.mailboxes.items() if box_name.lower() == name), None)
+
+
+class FakeSMTPServer(_Server):
+
+    def __init__(self, latency=0.0):
+        """
+        :param latency: Seconds every command is delayed by.
+        """
+        super().__init__(_SMTPHandler, latency)
+        self.lock = threading.Lock()
+        self.received = 0
+        self.received_bytes = 0
+
+
+def fill_mailbox(mailbox, count, senders, rng=None, body_bytes=(500, 20000), encodings=ENCODINGS):
+    """
+    Adds many random emails to a mailbox.
+
+    :param mailbox: The Mailbox.
+    :param count: How many emails to add.
+    :param senders: A function that returns the sender for the n-th email.
+    :param rng: A random.Random.
+    :param body_bytes: The smallest and largest body size.
+    :param encodings: The transfer encodings to pick from.
+    """
+    rng = rng or random.Random(1)
+    for number in range(count):
+        mailbox.add(make_message(rng, senders(number), rng.randint(*body_bytes), rng.choice(encodings)))
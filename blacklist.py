@@ -0,0 +1,191 @@
+"""
+Matches senders against the blacklist.
+
+Blacklist entries can have one of these forms:
+
+    spam                    the From header contains "spam" (the default, same as older versions)
+    exact:bob@example.com   the sender address is exactly bob@example.com
+    domain:example.com      the sender address is at example.com or any of its subdomains
+    regex:^promo-\\d+@       the From header matches the regular expression
+
+The matcher is built once for a blacklist. Substrings are found with a single Aho-Corasick scan and domains with
+suffix lookups, so matching a sender takes about the same time for ten entries as for ten thousand.
+"""
+
+import re
+from collections import namedtuple, deque
+from email.utils import parseaddr
+
+# kind is one of 'exact', 'domain', 'substring' or 'regex', entry is the blacklist line the rule was made from
+Rule = namedtuple('Rule', ['kind', 'value', 'entry', 'index'])
+
+_prefixes = ('exact', 'domain', 'regex')
+
+
+def parse_rule(entry, index=0):
+    """
+    Turns a blacklist entry into a Rule.
+
+    :param entry: A line of the blacklist.
+    :param index: The position of the entry in the blacklist.
+    """
+    entry = str(entry)
+    kind, _, value = entry.partition(':')
+    if kind.lower() in _prefixes and value:
+        kind = kind.lower()
+        value = value.strip()
+        if kind != 'regex':
+            value = value.lower()
+        return Rule(kind, value, entry, index)
+
+    return Rule('substring', entry.lower(), entry, index)
+
+
+class _SubstringAutomaton:
+    """
+    Aho-Corasick automaton that finds the first (by blacklist order) rule whose value occurs in a text.
+
+    With all_matches it can also find every rule that occurs in a text, still with a single scan.
+    """
+
+    def __init__(self, rules, all_matches=False):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]
+        # node -> the rules that end exactly at that node, and the next node on the fail path that ends a rule
+        self.ends = {}
+        self.next_end = [0] if all_matches else None
+
+        for rule in rules:
+            node = 0
+            for char in rule.value:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                    if all_matches:
+                        self.next_end.append(0)
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            if all_matches:
+                self.ends.setdefault(node, []).append(rule)
+            if self.output[node] is None or rule.index < self.output[node].index:
+                self.output[node] = rule
+
+        # breadth first, so the fail link of every parent is known before its children
+        pending = deque(self.goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for char, child in self.goto[node].items():
+                pending.append(child)
+
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                if self.fail[child] == child:
+                    self.fail[child] = 0
+                if all_matches:
+                    fallback = self.fail[child]
+                    self.next_end[child] = fallback if fallback in self.ends else self.next_end[fallback]
+
+                # a node also matches everything its fail link matches
+                inherited = self.output[self.fail[child]]
+                if inherited is not None and (self.output[child] is None or inherited.index < self.output[child].index):
+                    self.output[child] = inherited
+
+    def search(self, text):
+        goto, fail, output = self.goto, self.fail, self.output
+
+        best = None
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+
+            found = output[node]
+            if found is not None and (best is None or found.index < best.index):
+                best = found
+                if best.index == 0:
+                    break
+        return best
+
+    def search_all(self, text):
+        """
+        Returns every rule whose value occurs in the text. Only works if the automaton was built with all_matches.
+        """
+        goto, fail, ends, next_end = self.goto, self.fail, self.ends, self.next_end
+
+        found = []
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+
+            end = node if node in ends else next_end[node]
+            while end:
+                found += ends[end]
+                end = next_end[end]
+        return found
+
+
+class BlacklistMatcher:
+
+    def __init__(self, blacklist):
+        self.entries = tuple(blacklist)
+        self.rules = [parse_rule(entry, index) for index, entry in enumerate(self.entries)]
+
+        self._exact = {}
+        self._domains = {}
+        for rule in reversed(self.rules):
+            if rule.kind == 'exact':
+                self._exact[rule.value] = rule
+            elif rule.kind == 'domain':
+                self._domains[rule.value.lstrip('@.')] = rule
+
+        self._substrings = _SubstringAutomaton([rule for rule in self.rules if rule.kind == 'substring'])
+        self._regexes = [(re.compile(rule.value, re.IGNORECASE), rule) for rule in self.rules if rule.kind == 'regex']
+
+    def __len__(self):
+        return len(self.rules)
+
+    def match(self, sender):
+        """
+        Checks a sender against the blacklist.
+
+        :param sender: The From header, e.g. 'Bob <bob@example.com>'.
+        :return: The Rule that matched or None. Exact addresses win over domains, domains over substrings and
+        substrings over regular expressions.
+        """
+        address = parseaddr(sender)[1].lower()
+
+        if address in self._exact:
+            return self._exact[address]
+
+        if self._domains and '@' in address:
+            labels = address.rpartition('@')[2].split('.')
+            for i in range(len(labels)):
+                rule = self._domains.get('.'.join(labels[i:]))
+                if rule is not None:
+                    return rule
+
+        rule = self._substrings.search(sender.lower())
+        if rule is not None:
+            return rule
+
+        for pattern, rule in self._regexes:
+            if pattern.search(sender):
+                return rule
+
+        return None
+
+    def search_terms(self):
+        """
+        Returns the strings to search the From header for on the server, or None if some rules (regular expressions)
+        can't be searched for on the server and every email has to be checked locally.
+        """
+        if self._regexes:
+            return None
+        return [rule.value.lstrip('@.') if rule.kind == 'domain' else rule.value for rule in self.rules]
@@ -0,0 +1,292 @@
+"""
+Loads "config files/config.yml" and keeps it up to date while the program runs.
+
+The file is only parsed again when its modification time or size changed, which is checked with a cheap os.stat()
+call. Every loaded config is validated and handed out as a read-only snapshot (lists become tuples), so the settings
+can't change halfway through a pass. A config with errors is reported and the previous snapshot is kept, so a typo
+doesn't stop the program.
+
+Editing the file while the program sleeps or waits for new emails takes effect within a second.
+
+The files the bot keeps between runs (the scan state, the reply cache and the decision log) are stored in state_dir,
+which defaults to the directory of the config file.
+"""
+
+import os
+import threading
+from time import monotonic, sleep
+from types import MappingProxyType
+import yaml
+from connections import CONNECTION_KEYS
+from content_rules import validate_rules
+from widgets import config_defaults, Style, log
+
+CONFIG_FILE = 'config files/config.yml'
+
+# how often the file is checked for changes while waiting
+POLL_INTERVAL = 1.0
+
+REQUIRED_KEYS = ('blacklist', 'search_mail_folder', 'max_search_results', 'update_interval', 'also_reply_to_email',
+                 'save_archive', 'block_emails')
+
+# the numbers that can have a fraction, e.g. update_interval: 0.5, all other numbers have to be whole
+FRACTIONAL_KEYS = ('update_interval', 'idle_timeout', 'reply_retry_delay', 'reply_cache_hours', 'poll_jitter',
+                   'min_poll_seconds', 'retry_seconds', 'max_retry_seconds')
+
+# the types the settings must have
+SCHEMA = {
+    'username': str,
+    'password': str,
+    'imap_address': str,
+    'smtp_address': str,
+    'smtp_port': (int, str),
+    'blacklist': list,
+    'search_mail_folder': str,
+    'max_search_results': int,
+    'update_interval': (int, float),
+    'also_reply_to_email': bool,
+    'save_archive': bool,
+    'block_emails': bool,
+    'accounts': list,
+    'folders': list,
+    **{key: type(value) for key, value in config_defaults.items()},
+    **{key: (int, float) for key in FRACTIONAL_KEYS},
+}
+
+# the settings that only allow a few values
+CHOICES = {
+    'archive_backend': ('archive', 'text'),
+    'reply_cache_key': ('sender', 'thread'),
+    'log_format': ('text', 'json'),
+    'block_action': ('delete', 'move', 'quarantine'),
+}
+
+# the intervals that must be more than 0
+POSITIVE_KEYS = ('update_interval', 'min_poll_seconds', 'retry_seconds', 'max_retry_seconds')
+
+
+class ConfigError(Exception):
+    """
+    Raised when the config file can't be used, the message lists everything that is wrong with it.
+    """
+
+
+def _check_types(settings, where=''):
+    problems = []
+    for key, value in settings.items():
+        expected = SCHEMA.get(key)
+        if expected is None:
+            continue
+        expected = expected if isinstance(expected, tuple) else (expected,)
+
+        # yaml booleans are ints in python, but "true" is never a valid number of anything
+        if not isinstance(value, expected) or (isinstance(value, bool) and bool not in expected):
+            problems.append(where + key + ' should be ' + ' or '.join(t.__name__ for t in expected) + ', not ' +
+                            repr(value))
+    return problems
+
+
+def _block_folder_problems(settings, where=''):
+    # a blocked email moved to the folder it was found in would stay there, and is never checked again
+    action = settings.get('block_action')
+    if action not in ('move', 'quarantine') or settings.get('block_emails') is False:
+        return []
+    target = settings.get(action + '_folder')
+    folders = settings.get('folders') or [settings.get('search_mail_folder')]
+    if not isinstance(target, str) or not isinstance(folders, list):
+        return []
+    return [where + action + '_folder "' + target + '" is a checked folder, block_action: ' + action +
+            ' would leave the blocked emails in it' for folder in folders
+            if isinstance(folder, str) and folder.lower() == target.lower()]
+
+
+def _stream_problems(settings, where=''):
+    # stream_memory_mb can only be kept with a limit on every body
+    if settings.get('stream_mode') is True and isinstance(settings.get('max_body_bytes'), int) and \
+            settings['max_body_bytes'] <= 0:
+        return [where + 'max_body_bytes should be more than 0 with stream_mode']
+    return []
+
+
+def validate(settings):
+    """
+    Checks that a config has every required setting and that all settings have the right type.
+
+    :param settings: The config dict, with the defaults filled in.
+    :raise ConfigError: If anything is wrong.
+    """
+    problems = _check_types(settings)
+    problems += [key + ' is missing' for key in REQUIRED_KEYS if key not in settings]
+    problems += [key + ' should be one of ' + ', '.join(choices) + ', not ' + repr(settings[key])
+                 for key, choices in CHOICES.items() if key in settings and settings[key] not in choices]
+    problems += [key + ' should be more than 0' for key in POSITIVE_KEYS
+                 if isinstance(settings.get(key), (int, float)) and settings[key] <= 0]
+    if isinstance(settings.get('poll_jitter'), (int, float)) and not 0 <= settings['poll_jitter'] < 1:
+        problems.append('poll_jitter should be between 0 and 1, not ' + repr(settings['poll_jitter']))
+
+    if isinstance(settings.get('blacklist'), list):
+        problems += ['blacklist entry ' + repr(entry) + ' should be str'
+                     for entry in settings['blacklist'] if not isinstance(entry, str)]
+
+    if isinstance(settings.get('rules'), list):
+        problems += validate_rules(settings['rules'])
+
+    accounts = settings.get('accounts') or []
+    if not isinstance(accounts, list):
+        accounts = []
+    for number, account in enumerate(accounts, 1):
+        where = 'accounts #' + str(number) + ': '
+        if not isinstance(account, dict):
+            problems.append(where + 'should be a mapping of settings')
+            continue
+        problems += _check_types(account, where)
+        problems += [where + key + ' is missing' for key in CONNECTION_KEYS if key not in {**settings, **account}]
+        problems += _block_folder_problems({**settings, **account}, where)
+        problems += _stream_problems({**settings, **account}, where)
+
+    # without accounts the top level settings are the account
+    if not accounts:
+        problems += [key + ' is missing' for key in CONNECTION_KEYS if key not in settings]
+        problems += _block_folder_problems(settings)
+        problems += _stream_problems(settings)
+
+    if problems:
+        raise ConfigError('\n'.join(problems))
+
+
+def state_path(settings, filename):
+    """
+    Returns where a file that is kept between runs is stored, and creates state_dir if it doesn't exist yet.
+
+    :param settings: The config dict.
+    :param filename: The name of the file, relative names are in state_dir.
+    """
+    directory = settings['state_dir']
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, filename)
+
+
+def freeze(value):
+    """
+    Turns a loaded config into a read-only one: dicts become mapping proxies and lists become tuples.
+    """
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def changed(old, new, keys):
+    """
+    Checks whether any of the given settings differ between two configs.
+
+    :param old: The previous config, may be None.
+    :param new: The new config.
+    :param keys: The settings to compare.
+    """
+    return old is None or any(old.get(key) != new.get(key) for key in keys)
+
+
+def update_config_file(filename=CONFIG_FILE, **changes):
+    """
+    Changes some settings in the config file and leaves the others as they are.
+
+    :param filename: The config file.
+    :param changes: The settings to change.
+    """
+    with open(filename) as stream:
+        settings = yaml.safe_load(stream) or {}
+    settings.update(changes)
+    with open(filename, 'w') as f:
+        yaml.dump(settings, f)
+
+
+class ConfigService:
+    """
+    Can be shared by several threads, snapshots are never changed once they were handed out.
+    """
+
+    def __init__(self, filename=CONFIG_FILE):
+        """
+        :param filename: The config file.
+        :raise FileNotFoundError: If the config file doesn't exist yet.
+        :raise ConfigError: If the config file has errors.
+        """
+        self.filename = filename
+        self.version = 0
+
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._snapshot = None
+
+        self.reload()
+
+    def reload(self):
+        """
+        Loads the config file again, but only if it changed since it was last loaded.
+
+        :return: True if there is a new snapshot.
+        """
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            if self._snapshot is None:
+                raise
+            # the file is probably being replaced by an editor right now
+            return False
+        stamp = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            if stamp == self._stamp:
+                return False
+            self._stamp = stamp
+
+            try:
+                with open(self.filename) as stream:
+                    loaded = yaml.safe_load(stream) or {}
+                if not isinstance(loaded, dict):
+                    raise ConfigError('The config file should contain a mapping of settings')
+                settings = {**config_defaults, **loaded}
+                validate(settings)
+                # the state is kept next to the config file unless it goes somewhere else
+                settings['state_dir'] = settings['state_dir'] or os.path.dirname(self.filename)
+            except (yaml.YAMLError, ConfigError) as e:
+                if self._snapshot is None:
+                    raise ConfigError(str(e))
+                log('The config file has errors, the previous settings are kept:\n' + str(e), Style.red, 'error')
+                return False
+
+            self._snapshot = freeze(settings)
+            self.version += 1
+            return True
+
+    def snapshot(self):
+        """
+        Returns the current config, loading the file again if it changed.
+
+        :return: A read-only config mapping.
+        """
+        self.reload()
+        return self._snapshot
+
+    def wait_for_change(self, timeout, stop=None):
+        """
+        Sleeps until the config file changes or the timeout runs out.
+
+        :param timeout: The maximum number of seconds to wait.
+        :param stop: A threading.Event that ends the wait early when it is set.
+        :return: True if the config changed.
+        """
+        deadline = monotonic() + timeout
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return False
+            if stop is None:
+                sleep(min(POLL_INTERVAL, remaining))
+            elif stop.wait(min(POLL_INTERVAL, remaining)):
+                return False
+            if self.reload():
+                return True
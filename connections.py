@@ -0,0 +1,196 @@
+"""
+Keeps the IMAP session and a few SMTP connections alive between passes and replies, so the TLS handshake and login
+only happen when a connection was actually lost.
+"""
+
+import errno
+import imaplib
+import smtplib
+import socket
+import ssl
+import threading
+from contextlib import contextmanager
+from metrics import metrics
+
+# the config keys that require new connections when they change
+CONNECTION_KEYS = ('username', 'password', 'imap_address', 'imap_port', 'imap_ssl', 'smtp_address', 'smtp_port',
+                   'smtp_starttls')
+
+# the errors that mean the server can't be reached right now, unlike local ones such as a missing file or a full disk
+NETWORK_ERRORS = (ConnectionError, socket.timeout, socket.gaierror, ssl.SSLError, imaplib.IMAP4.abort)
+NETWORK_ERRNOS = (errno.ENETDOWN, errno.ENETUNREACH, errno.ENETRESET, errno.EHOSTDOWN, errno.EHOSTUNREACH)
+
+
+def is_network_error(error):
+    """
+    Tells a lost connection apart from local I/O errors.
+
+    :param error: The exception.
+    """
+    return isinstance(error, NETWORK_ERRORS) or isinstance(error, OSError) and error.errno in NETWORK_ERRNOS
+
+
+def open_imap(settings):
+    """
+    Connects and logs in to the IMAP server.
+
+    :param settings: The config dict.
+    :return: A logged in imaplib connection.
+    """
+    with metrics.stage('connect', account=settings['username']):
+        if settings['imap_ssl']:
+            imap = imaplib.IMAP4_SSL(settings['imap_address'], settings['imap_port'])
+        else:
+            # only for servers on this computer, like the fake server of the benchmarks
+            imap = imaplib.IMAP4(settings['imap_address'], settings['imap_port'])
+    with metrics.stage('login', account=settings['username']):
+        imap.login(settings['username'], settings['password'])
+
+    # servers usually advertise more capabilities (IDLE, UIDPLUS, ...) once logged in
+    # noinspection PyProtectedMember
+    imap._get_capabilities()
+
+    return imap
+
+
+def open_smtp(settings):
+    """
+    Connects and logs in to the SMTP server.
+
+    :param settings: The config dict.
+    :return: A logged in smtplib connection.
+    """
+    with metrics.stage('smtp_connect', account=settings['username']):
+        server = smtplib.SMTP(settings['smtp_address'], int(settings['smtp_port']))
+        try:
+            if settings['smtp_starttls']:
+                server.starttls(context=ssl.create_default_context())
+            server.login(settings['username'], settings['password'])
+        except Exception:
+            server.close()
+            raise
+    return server
+
+
+class ConnectionManager:
+
+    def __init__(self, settings):
+        self.settings = settings
+
+        self._imap = None
+        self._smtp_pool = []
+        self._lock = threading.Lock()
+
+        self.counters = {
+            'imap_reused': 0,
+            'imap_reopened': 0,
+            'smtp_reused': 0,
+            'smtp_reopened': 0,
+        }
+
+    def update(self, settings):
+        """
+        Applies a newly loaded config. Open connections are only dropped when the login or server settings changed.
+
+        :param settings: The config dict.
+        """
+        changed = any(self.settings.get(key) != settings.get(key) for key in CONNECTION_KEYS)
+        self.settings = settings
+        if changed:
+            self.close()
+
+    def imap(self):
+        """
+        Returns the IMAP session, checking it with NOOP first. A new one is opened if there is none or it died.
+        """
+        if self._imap is not None:
+            try:
+                self._imap.noop()
+                self.counters['imap_reused'] += 1
+                return self._imap
+            except (OSError, imaplib.IMAP4.error):
+                self.drop_imap()
+
+        self._imap = open_imap(self.settings)
+        self.counters['imap_reopened'] += 1
+        return self._imap
+
+    def drop_imap(self):
+        """
+        Forgets the IMAP session, e.g. after a network error. The next call to imap() opens a new one.
+        """
+        imap, self._imap = self._imap, None
+        if imap is not None:
+            try:
+                imap.logout()
+            except (OSError, imaplib.IMAP4.error):
+                pass
+
+    @contextmanager
+    def smtp(self):
+        """
+        Lends out a logged in SMTP connection from the pool. It goes back into the pool afterwards, unless the block
+        raised an error, in which case the connection is thrown away.
+        """
+        server = None
+        with self._lock:
+            while self._smtp_pool and server is None:
+                server = self._smtp_pool.pop()
+                try:
+                    if server.noop()[0] != 250:
+                        raise smtplib.SMTPServerDisconnected
+                    self.counters['smtp_reused'] += 1
+                except (OSError, smtplib.SMTPException):
+                    _quit_smtp(server)
+                    server = None
+
+        if server is None:
+            server = open_smtp(self.settings)
+            with self._lock:
+                self.counters['smtp_reopened'] += 1
+
+        try:
+            yield server
+        except Exception:
+            _quit_smtp(server)
+            raise
+
+        with self._lock:
+            if len(self._smtp_pool) < self.settings['smtp_pool_size']:
+                self._smtp_pool.append(server)
+                server = None
+        if server is not None:
+            _quit_smtp(server)
+
+    def sendmail(self, sender, receiver, message):
+        """
+        Sends an email over a pooled connection. If the pooled connection turns out to be dead, the email is sent again
+        over a fresh one.
+
+        :param sender: The sender address.
+        :param receiver: The receiver address.
+        :param message: The full message as str or bytes.
+        """
+        try:
+            with self.smtp() as server:
+                server.sendmail(sender, receiver, message)
+        except (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout):
+            with self.smtp() as server:
+                server.sendmail(sender, receiver, message)
+
+    def close(self):
+        """
+        Closes every open connection.
+        """
+        self.drop_imap()
+        with self._lock:
+            pool, self._smtp_pool = self._smtp_pool, []
+        for server in pool:
+            _quit_smtp(server)
+
+
+def _quit_smtp(server):
+    try:
+        server.quit()
+    except (OSError, smtplib.SMTPException):
+        server.close()
@@ -0,0 +1,272 @@
+"""
+Blocks emails by their content, for spammers who change their sender address all the time.
+
+Rules are listed in the config next to the blacklist. Every rule has a name and one or more conditions which all have
+to match. A condition is a pattern, or a list of patterns of which one has to match, written like blacklist entries
+(a plain substring, exact:, domain: or regex:):
+
+    rules:
+      - name: lottery
+        subject: regex:(winner|lottery|prize)
+        body: [claim your prize, wire transfer]
+      - name: unknown newsletters
+        list_id: domain:mailer.example.com
+      - name: executables
+        attachment: [.exe, .scr, .js, application/x-msdownload]
+      - name: bad relay
+        received: domain:relay.example.net
+
+The conditions can check:
+
+    from, reply_to  the address (exact:, domain:) or the whole header
+    subject         the decoded subject
+    list_id         the list id between < and > (exact:, domain:) or the whole header
+    received        the host names and IP addresses in the Received headers
+    attachment      the file names and content types of the parts of the email, known without downloading them
+    body            the decoded text of the email
+
+All rules are compiled into a single plan: every field is scanned once per email for the patterns of all rules, with
+one Aho-Corasick pass for the substrings and dict lookups for exact values and domains. The header conditions are
+checked first; the body is only downloaded for emails where a rule that depends on it could still match.
+"""
+
+import re
+from collections import namedtuple, Counter
+from email.utils import parseaddr
+from blacklist import parse_rule, _SubstringAutomaton
+from decoding import decode_header_value
+
+# the fields a rule can check and the headers they need
+FIELDS = {
+    'from': ('FROM',),
+    'reply_to': ('REPLY-TO',),
+    'subject': ('SUBJECT',),
+    'list_id': ('LIST-ID',),
+    'received': ('RECEIVED',),
+    'attachment': (),
+    'body': (),
+}
+
+# the fields that need the body of the email to be downloaded
+BODY_FIELDS = ('body',)
+
+_host = re.compile(r'[a-z0-9-]+(?:\.[a-z0-9-]+)+')
+_angle_brackets = re.compile(r'<([^>]*)>')
+
+
+class ContentRule(namedtuple('ContentRule', ['name', 'index', 'conditions'])):
+
+    @property
+    def entry(self):
+        # shown in the output like the blacklist entry that blocked an email
+        return 'rule: ' + self.name
+
+
+def validate_rules(rules):
+    """
+    Checks the rules from the config.
+
+    :param rules: The rules list.
+    :return: A list of problems, empty if the rules are fine.
+    """
+    problems = []
+    for number, rule in enumerate(rules, 1):
+        where = 'rules #' + str(number) + ': '
+        if not isinstance(rule, dict):
+            problems.append(where + 'should be a mapping of conditions')
+            continue
+
+        unknown = [key for key in rule if key != 'name' and key not in FIELDS]
+        if unknown:
+            problems.append(where + 'unknown conditions ' + ', '.join(map(str, unknown)) + ' (use ' +
+                            ', '.join(FIELDS) + ')')
+        if not any(key in FIELDS for key in rule):
+            problems.append(where + 'has no conditions')
+
+        for field in FIELDS:
+            if field not in rule:
+                continue
+            patterns = [rule[field]] if isinstance(rule[field], str) else rule[field]
+            if not isinstance(patterns, list) or not patterns or not all(isinstance(p, str) for p in patterns):
+                problems.append(where + field + ' should be a pattern or a list of patterns')
+                continue
+            for pattern in patterns:
+                parsed = parse_rule(pattern)
+                if parsed.kind == 'regex':
+                    try:
+                        re.compile(parsed.value)
+                    except re.error as e:
+                        problems.append(where + field + ': invalid regular expression ' + repr(parsed.value) + ' (' +
+                                        str(e) + ')')
+    return problems
+
+
+def _field_values(field, message):
+    """
+    Returns the texts that substrings and regular expressions are searched in and the keys that exact: and domain:
+    patterns are compared with.
+    """
+    if field in ('from', 'reply_to', 'subject', 'list_id'):
+        text = decode_header_value(message.header(FIELDS[field][0]))
+        if field == 'subject':
+            keys = [text.strip().lower()]
+        elif field == 'list_id':
+            keys = [value.strip().lower() for value in _angle_brackets.findall(text)] or [text.strip().lower()]
+        else:
+            keys = [parseaddr(text)[1].lower()]
+        return [text], keys
+
+    if field == 'received':
+        texts = message.header_values('Received')
+        return texts, [host for text in texts for host in _host.findall(text.lower())]
+
+    if field == 'attachment':
+        texts = []
+        keys = []
+        for content_type, filename in message.attachments():
+            texts.append((filename + ' ' + content_type).strip())
+            keys.append(content_type)
+            if filename:
+                keys.append(filename)
+                if '.' in filename:
+                    extension = filename.rpartition('.')[2]
+                    keys += [extension, '.' + extension]
+        return texts, keys
+
+    text = message.text()
+    return [text], [text.strip().lower()]
+
+
+class _PatternSet:
+    """
+    The patterns of one field from all rules.
+    """
+
+    def __init__(self, patterns):
+        """
+        :param patterns: (pattern, condition number) tuples.
+        """
+        self.exact = {}
+        self.domains = {}
+        self.regexes = []
+
+        substrings = []
+        for pattern, condition in patterns:
+            rule = parse_rule(pattern, condition)
+            if rule.kind == 'exact':
+                self.exact.setdefault(rule.value, set()).add(condition)
+            elif rule.kind == 'domain':
+                self.domains.setdefault(rule.value.lstrip('@.'), set()).add(condition)
+            elif rule.kind == 'regex':
+                self.regexes.append((re.compile(rule.value, re.IGNORECASE), condition))
+            elif rule.value:
+                substrings.append(rule)
+
+        self.automaton = _SubstringAutomaton(substrings, all_matches=True) if substrings else None
+
+    def matches(self, texts, keys):
+        """
+        Returns the numbers of the conditions that match.
+        """
+        found = set()
+        for key in keys:
+            found |= self.exact.get(key, set())
+            if self.domains:
+                labels = key.rpartition('@')[2].split('.')
+                for i in range(len(labels)):
+                    found |= self.domains.get('.'.join(labels[i:]), set())
+
+        for text in texts:
+            if self.automaton is not None:
+                found.update(rule.index for rule in self.automaton.search_all(text.lower()))
+            for pattern, condition in self.regexes:
+                if condition not in found and pattern.search(text):
+                    found.add(condition)
+        return found
+
+
+class ContentRules:
+
+    def __init__(self, rules):
+        """
+        :param rules: The rules list from the config.
+        """
+        self.entries = tuple(rules)
+        self.rules = []
+
+        patterns = {field: [] for field in FIELDS}
+        # condition number -> the index of its rule
+        self._condition_rule = []
+        self._header_counts = []
+        self._body_conditions = []
+
+        for index, rule in enumerate(self.entries):
+            conditions = []
+            body_conditions = set()
+            for field in FIELDS:
+                if field not in rule:
+                    continue
+                condition = len(self._condition_rule)
+                self._condition_rule.append(index)
+                conditions.append((field, rule[field]))
+
+                values = [rule[field]] if isinstance(rule[field], str) else rule[field]
+                patterns[field] += [(value, condition) for value in values]
+                if field in BODY_FIELDS:
+                    body_conditions.add(condition)
+
+            self.rules.append(ContentRule(str(rule.get('name') or 'rule ' + str(index + 1)), index, tuple(conditions)))
+            self._header_counts.append(len(conditions) - len(body_conditions))
+            self._body_conditions.append(body_conditions)
+
+        self._fields = {field: _PatternSet(field_patterns) for field, field_patterns in patterns.items()
+                        if field_patterns}
+        self._header_fields = [field for field in self._fields if field not in BODY_FIELDS]
+
+        # rules that only check the body can't be ruled out by the headers
+        self._body_only = [index for index, count in enumerate(self._header_counts) if not count]
+
+        self.header_fields = tuple(dict.fromkeys(name for field in self._fields for name in FIELDS[field]))
+        self.needs_structure = 'attachment' in self._fields
+
+    def __len__(self):
+        return len(self.rules)
+
+    def check_headers(self, message):
+        """
+        Checks the conditions that don't need the body.
+
+        :param message: A FetchedMessage with the header_fields (and the BODYSTRUCTURE if needs_structure) fetched.
+        :return: The ContentRule that matched or None, and the indexes of the rules that can only be decided with the
+                 body.
+        """
+        satisfied = set()
+        for field in self._header_fields:
+            satisfied |= self._fields[field].matches(*_field_values(field, message))
+
+        counts = Counter(self._condition_rule[condition] for condition in satisfied)
+        candidates = [index for index, count in counts.items() if count == self._header_counts[index]]
+        candidates += self._body_only
+
+        decided = [index for index in candidates if not self._body_conditions[index]]
+        if decided:
+            return self.rules[min(decided)], []
+        return None, sorted(candidates)
+
+    def check_body(self, message, pending):
+        """
+        Checks the body conditions of the rules check_headers() couldn't decide.
+
+        :param message: The FetchedMessage, its body is downloaded if it wasn't yet.
+        :param pending: The rule indexes returned by check_headers().
+        :return: The ContentRule that matched or None.
+        """
+        satisfied = set()
+        for field in BODY_FIELDS:
+            if field in self._fields:
+                satisfied |= self._fields[field].matches(*_field_values(field, message))
+
+        for index in pending:
+            if self._body_conditions[index] <= satisfied:
+                return self.rules[index]
+        return None
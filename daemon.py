@@ -0,0 +1,134 @@
+"""
+Runs the bot without a terminal, e.g. as a systemd service or in a container.
+
+    python3 daemon.py --config /etc/emailautoblock/config.yml
+
+The config file can also be given in the EMAILAUTOBLOCK_CONFIG environment variable. Nothing is ever asked: a missing
+or invalid config file ends the process with exit code 2 and a failed login with exit code 1. The scan state, reply
+cache and decision log are kept next to the config file, or in state_dir if it is set. The spool, archive and reply
+templates are found relative to the working directory, just like with main.py.
+
+Readiness and health:
+
+    systemd     with Type=notify, READY=1 is sent right before the first pass and STOPPING=1 on shutdown
+    HTTP        with metrics_port set, /readyz answers 200 from then on and /healthz as long as the passes (or IDLE
+                renewals) keep coming, see metrics.py
+
+SIGTERM and SIGINT let the pass that is running finish, wait for the replies that are being sent and close the
+connections, then the process exits with 0.
+
+    [Service]
+    Type=notify
+    WorkingDirectory=/opt/emailAutoBlock
+    Environment=EMAILAUTOBLOCK_CONFIG=/etc/emailautoblock/config.yml
+    ExecStart=/usr/bin/python3 daemon.py
+    Restart=on-failure
+"""
+
+import argparse
+import os
+import signal
+import socket
+import sys
+from config_service import ConfigService, ConfigError, CONFIG_FILE
+from main import EmailBlocker, AccountError
+from metrics import metrics
+from widgets import Style, log, set_log_format
+
+CONFIG_ENV = 'EMAILAUTOBLOCK_CONFIG'
+
+EXIT_ACCOUNT_ERROR = 1
+EXIT_CONFIG_ERROR = 2
+
+
+def notify(state, report=True):
+    """
+    Sends a status to systemd (sd_notify), does nothing when not started by systemd with Type=notify.
+
+    :param state: E.g. 'READY=1'.
+    :param report: Whether a failure is logged, never from a signal handler since printing there can interrupt a print.
+    """
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return
+    if address.startswith('@'):
+        # an abstract socket
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode('utf-8'))
+    except OSError as e:
+        if report:
+            log('Could not notify systemd: ' + str(e), level='warning')
+
+
+def run(config_file):
+    """
+    Runs the bot until SIGTERM or SIGINT.
+
+    :param config_file: The path of the config file.
+    :return: The exit code.
+    """
+    try:
+        config_service = ConfigService(config_file)
+    except FileNotFoundError:
+        log('The config file "' + config_file + '" does not exist. Run setup_wizard.py or write it by hand.',
+            level='error', config=config_file)
+        return EXIT_CONFIG_ERROR
+    except ConfigError as e:
+        log('The config file has errors:\n' + str(e), Style.red, 'error', config=config_file)
+        return EXIT_CONFIG_ERROR
+
+    settings = config_service.snapshot()
+    set_log_format(settings['log_format'])
+    if settings['metrics_port']:
+        metrics.serve(settings['metrics_port'], settings['metrics_address'])
+
+    try:
+        if settings.get('accounts'):
+            from engine import Engine
+
+            bot = Engine(config_service)
+        else:
+            bot = EmailBlocker(config_service=config_service, interactive=False)
+    except AccountError:
+        return EXIT_ACCOUNT_ERROR
+
+    # the signals that were received, only logged once the pass is done since printing in the handler could interrupt
+    # a print of the pass
+    received = []
+
+    def stop(signal_number, _):
+        received.append(signal_number)
+        notify('STOPPING=1', report=False)
+        bot.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    metrics.ready = True
+    notify('READY=1\nSTATUS=Checking emails\nMAINPID=' + str(os.getpid()))
+    try:
+        bot.run_forever()
+    except AccountError:
+        return EXIT_ACCOUNT_ERROR
+    finally:
+        if received:
+            log('Stopping (' + signal.Signals(received[0]).name + ')', signal=received[0])
+        bot.close()
+        log('Stopped')
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the bot as a service, without any prompts.')
+    parser.add_argument('--config', default=os.environ.get(CONFIG_ENV, CONFIG_FILE),
+                        help='the config file (default: $' + CONFIG_ENV + ' or "' + CONFIG_FILE + '")')
+    args = parser.parse_args()
+
+    sys.exit(run(args.config))
+
+
+if __name__ == '__main__':
+    main()
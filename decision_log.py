@@ -0,0 +1,202 @@
+"""
+Append-only log of what the bot decided for every email it checked.
+
+Every line is a JSON object with the UID, sender, the blacklist entry or rule that matched, the action and the
+headers the decision was based on. The lines of a pass are appended as one gzip member, so the file stays small and
+zcat prints all of it.
+
+The log (decision_log_file, in state_dir unless the path is absolute) is written in shadow mode (shadow_mode: true),
+where nothing is deleted, archived or replied to, or always with log_decisions: true. Before a changed blacklist or new
+rules go live, replay the log to see which emails they would block differently:
+
+    python3 decision_log.py --blacklist new_blacklist.txt
+    python3 decision_log.py --config "config files/new_config.yml"
+
+Only headers are logged, so rules with body conditions can't always be decided by a replay.
+"""
+
+import argparse
+
+import datetime
+import gzip
+import json
+import os
+import threading
+from time import perf_counter
+from blacklist import BlacklistMatcher
+from config_service import ConfigService, CONFIG_FILE, state_path
+from content_rules import ContentRules, FIELDS
+from decoding import decode_header_value
+from imap_tools import FetchedMessage
+
+# kept in state_dir, see config_service.state_path()
+DECISION_LOG = 'decisions.jsonl.gz'
+
+# the action of emails no rule matched
+ACTION_PASS = 'pass'
+
+# fetched while logging, so replay can check header conditions the current rules don't use
+HEADER_FIELDS = tuple(name for names in FIELDS.values() for name in names)
+
+
+def actions_for(settings):
+    """
+    Describes what happens to a blocked email with the given config, e.g. 'archive,reply,quarantine'.
+
+    :param settings: The config dict.
+    """
+    actions = [name for name, key in (('archive', 'save_archive'), ('reply', 'also_reply_to_email')) if settings[key]]
+    if settings['block_emails']:
+        actions.append(settings['block_action'])
+    return ','.join(actions) or 'keep'
+
+
+def decision(message, account, folder, rule, action, shadow):
+    """
+    Builds the log entry of an email.
+
+    :param message: The FetchedMessage.
+    :param account: The username of the account.
+    :param folder: The mail folder.
+    :param rule: The blacklist entry or rule that matched, None if none did.
+    :param action: What was done to the email, see actions_for() and ACTION_PASS.
+    :param shadow: Whether the action was only logged.
+    """
+    entry = {
+        'account': account,
+        'folder': folder,
+        'uid': message.uid,
+        'sender': message.sender,
+        'rule': rule,
+        'action': action,
+        'shadow': shadow,
+        'headers': message.sections.get('HEADER', b'').decode('utf-8', 'replace'),
+    }
+    if message.fetch_text:
+        # the BODYSTRUCTURE, for attachment conditions
+        entry['fetch'] = message.fetch_text.decode('utf-8', 'replace')
+    return entry
+
+
+class DecisionLog:
+    """
+    Can be shared by several accounts that are checked at the same time.
+    """
+
+    def __init__(self, filename=DECISION_LOG):
+        self.filename = filename
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, decisions):
+        """
+        Appends the decisions of a pass.
+
+        :param decisions: A list of dicts with uid, sender, rule, action and headers.
+        """
+        if not decisions:
+            return
+
+        now = datetime.datetime.now().astimezone().isoformat(timespec='seconds')
+        lines = ''.join(json.dumps({'time': now, **decision}, ensure_ascii=False) + '\n' for decision in decisions)
+        member = gzip.compress(lines.encode('utf-8'), mtime=0)
+
+        with self._lock, open(self.filename, 'ab') as f:
+            f.write(member)
+
+
+def read_decisions(filename=DECISION_LOG):
+    """
+    Reads the decisions back, oldest first.
+
+    :param filename: The decision log.
+    :return: A generator of dicts.
+    """
+    with gzip.open(filename, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def replay(decisions, blacklist, rules=()):
+    """
+    Checks the logged emails again with another blacklist and rules.
+
+    :param decisions: The log entries, e.g. from read_decisions().
+    :param blacklist: The blacklist entries.
+    :param rules: The content rules.
+    :return: A generator of (log entry, the entry or rule that matches now or None, whether a body condition left it
+             undecided) tuples.
+    """
+    matcher = BlacklistMatcher(blacklist)
+    content_rules = ContentRules(rules)
+
+    for entry in decisions:
+        message = FetchedMessage(0)
+        message.uid = entry['uid']
+        message.sections['HEADER'] = entry['headers'].encode('utf-8')
+        message.fetch_text = entry.get('fetch', '').encode('utf-8')
+
+        rule = matcher.match(decode_header_value(message.sender))
+        pending = None
+        if rule is None and content_rules:
+            rule, pending = content_rules.check_headers(message)
+        yield entry, rule.entry if rule is not None else None, bool(pending)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay the decision log with another blacklist or rules.')
+    parser.add_argument('--log', help='the decision log (default: decision_log_file of the config)')
+    parser.add_argument('--config', default=CONFIG_FILE, help='the config file with the blacklist and rules to check')
+    parser.add_argument('--blacklist', help='a file with one blacklist entry per line, used instead of the config\'s')
+    parser.add_argument('--limit', type=int, default=20, help='the maximum number of changed emails listed')
+    args = parser.parse_args()
+
+    settings = ConfigService(args.config).snapshot()
+    log_file = args.log or state_path(settings, settings['decision_log_file'])
+    blacklist = settings['blacklist']
+    if args.blacklist:
+        with open(args.blacklist) as f:
+            blacklist = [line.strip() for line in f if line.strip()]
+
+    start_time = perf_counter()
+
+    # an email that was logged more than once counts with its latest decision
+    latest = {}
+    for entry in read_decisions(log_file):
+        latest[(entry['account'], entry['folder'], entry['uid'])] = entry
+
+    newly_blocked = []
+    unblocked = []
+    undecided = []
+    before = now = 0
+    for entry, rule, pending in replay(latest.values(), blacklist, settings['rules']):
+        before += entry['rule'] is not None
+        now += rule is not None
+        if pending:
+            undecided.append((entry, 'body condition'))
+        elif rule is not None and entry['rule'] is None:
+            newly_blocked.append((entry, rule))
+        elif rule is None and entry['rule'] is not None:
+            unblocked.append((entry, entry['rule']))
+
+    seconds = perf_counter() - start_time
+    print('Replayed ' + str(len(latest)) + ' emails in ' + '{:.2f}'.format(seconds) + ' seconds (' +
+          '{:.0f}'.format(len(latest) / max(seconds, 1e-9)) + ' per second)')
+    print('Blocked before: ' + str(before) + ', now: ' + str(now))
+
+    for title, changes in (('Newly blocked', newly_blocked), ('No longer blocked', unblocked),
+                           ('Undecided without the body', undecided)):
+        print('\n' + title + ': ' + str(len(changes)))
+        for entry, reason in changes[:args.limit]:
+            print('  ' + entry['folder'] + ' ' + str(entry['uid']) + '  ' + decode_header_value(entry['sender']) +
+                  '  (' + reason + ')')
+        if len(changes) > args.limit:
+            print('  ...')
+
+
+if __name__ == '__main__':
+    main()
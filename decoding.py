@@ -0,0 +1,132 @@
+"""
+Turns the raw bytes fetched from the server into readable text.
+
+Bodies are decoded according to their MIME headers: the Content-Transfer-Encoding (quoted-printable, base64, ...) is
+undone by the stdlib codecs and the result is decoded with the part's charset. Headers such as the subject are decoded
+from RFC 2047 encoded words (=?utf-8?q?...?=).
+"""
+
+import datetime
+import re
+from email.header import decode_header, make_header
+from email.parser import BytesFeedParser, BytesHeaderParser
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+
+# bodies are fed to the parser in pieces of this size, so it never has to copy the whole body at once
+CHUNK_SIZE = 64 * 1024
+
+# how many Date headers parse_date() remembers, spam bursts often share the same one
+DATE_CACHE_SIZE = 4096
+
+_MONTHS = {name: number for number, name in enumerate(
+    ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'), 1)}
+
+# "Mon, 3 Jun 2024 10:00:00 +0200 (CEST)", the way almost all mail programs write the date
+_rfc5322_date = re.compile(r'(?:[A-Za-z]{3}, *)?(\d{1,2}) ([A-Za-z]{3}) (\d{4}) (\d\d):(\d\d):(\d\d) ([+-]\d{4})'
+                           r'(?: *\([^)]*\))? *$')
+_zones = {}
+
+
+def decode_header_value(value):
+    """
+    Decodes RFC 2047 encoded words in a header, e.g. '=?utf-8?q?Gr=C3=BC=C3=9Fe?=' becomes 'Grüße'.
+
+    :param value: The raw header value.
+    :return: The decoded header value. Malformed encoded words are left as they are.
+    """
+    if '=?' not in value:
+        return value
+    try:
+        return str(make_header(decode_header(value)))
+    except (LookupError, UnicodeError, ValueError):
+        return value
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(value):
+    """
+    Parses a Date header the way real emails write it: with or without the weekday, with zone comments like "(UTC)" or
+    "(PST)", obsolete zone names like "EST" or "GMT", two digit years, ...
+
+    :param value: The Date header value.
+    :return: A timezone aware datetime, or None if the value isn't a date. Dates without a zone are taken as UTC.
+    """
+    # the usual format is read directly, the email module handles everything else
+    found = _rfc5322_date.match(value)
+    if found and found.group(2).lower() in _MONTHS:
+        day, month, year, hour, minute, second, zone = found.groups()
+        try:
+            if zone not in _zones:
+                # zones of 24 hours or more, e.g. "+9999", raise a ValueError too
+                offset = datetime.timedelta(hours=int(zone[1:3]), minutes=int(zone[3:]))
+                _zones[zone] = datetime.timezone(-offset if zone[0] == '-' else offset)
+            return datetime.datetime(int(year), _MONTHS[month.lower()], int(day), int(hour), int(minute), int(second),
+                                     tzinfo=_zones[zone])
+        except ValueError:
+            return None
+
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date
+
+
+def _text_payload(message):
+    # the plain text alternative is preferred, then html, then whatever comes first
+    parts = [part for part in message.walk() if not part.is_multipart()]
+    for content_type in ('text/plain', 'text/html'):
+        for part in parts:
+            if part.get_content_type() == content_type:
+                return part
+    return parts[0] if parts else message
+
+
+def decode_part(body, mime_headers=b''):
+    """
+    Decodes a body part.
+
+    :param body: The raw bytes of the part, e.g. BODY[1].
+    :param mime_headers: The MIME headers of the part (Content-Type, Content-Transfer-Encoding), e.g. BODY[1.MIME].
+    If empty, the part is treated as plain text.
+    :return: The decoded text.
+    """
+    parser = BytesFeedParser()
+    parser.feed(mime_headers.rstrip(b'\r\n') + b'\r\n\r\n' if mime_headers.strip() else b'\r\n')
+
+    view = memoryview(body)
+    for start in range(0, len(view), CHUNK_SIZE):
+        parser.feed(bytes(view[start:start + CHUNK_SIZE]))
+
+    part = _text_payload(parser.close())
+    payload = part.get_payload(decode=True) or b''
+
+    charset = part.get_content_charset() or 'utf-8'
+    try:
+        return payload.decode(charset, 'replace')
+    except LookupError:
+        return payload.decode('utf-8', 'replace')
+
+
+def mime_headers_for_part(part_headers, message_headers):
+    """
+    Picks the MIME headers that describe BODY[1].
+
+    Servers return the part's own headers as BODY[1.MIME]. For a message that isn't multipart some servers leave that
+    empty, in which case the message's own Content-Type and Content-Transfer-Encoding apply.
+
+    :param part_headers: The raw BODY[1.MIME] bytes, may be empty.
+    :param message_headers: The raw message header bytes.
+    :return: Raw header bytes.
+    """
+    if part_headers and BytesHeaderParser().parsebytes(part_headers).get('Content-Type'):
+        return part_headers
+
+    headers = BytesHeaderParser().parsebytes(message_headers or b'')
+    if headers.get_content_maintype() == 'multipart':
+        # the first part of a multipart message without headers of its own is plain us-ascii text
+        return b''
+    return message_headers or b''
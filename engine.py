@@ -0,0 +1,249 @@
+"""
+Checks many mail accounts and folders from a single process.
+
+Accounts are listed in the config under "accounts". Every account inherits the top level settings and can override
+any of them. "folders" lists the mail folders to check and defaults to "search_mail_folder":
+
+    accounts:
+      - username: me@example.com
+        password: ...
+        imap_address: imap.example.com
+        smtp_address: smtp.example.com
+        smtp_port: 587
+        folders: [INBOX, Junk]
+      - username: ...
+
+On every pass the folders that are due are checked by a pool of worker threads. At most "account_concurrency" folders of
+the same account are checked at the same time. Every folder has its own schedule (see scheduler.py), so a folder that
+gets a lot of spam is checked more often than a quiet one. A folder that fails (a wrong password, a missing folder, a
+network error) is reported and tried again later, with a longer wait after every failure, without affecting the others.
+
+The folders are always polled, idle_mode only applies to a single account checked by main.py.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, monotonic
+from main import EmailBlocker, AccountError
+from config_service import ConfigService, state_path
+from scan_state import ScanState, STATE_FILE
+from archive import Archive
+from reply_cache import ReplyCache, CACHE_FILE
+from decision_log import DecisionLog
+from metrics import metrics
+from widgets import Style, log, set_log_format
+
+
+def account_configs(settings):
+    """
+    Splits the config into one config per account.
+
+    :param settings: The config dict.
+    :return: A list of (account config, folders) tuples.
+    """
+    shared = {key: value for key, value in settings.items() if key != 'accounts'}
+
+    accounts = []
+    for account in settings.get('accounts') or [{}]:
+        account_config = {**shared, **account}
+        if 'spool_dir' not in account:
+            # every account needs its own spool so the replies go out through the right SMTP server
+            account_config['spool_dir'] = os.path.join(shared['spool_dir'], account_config['username'])
+
+        folders = account_config.pop('folders', None) or [account_config['search_mail_folder']]
+        accounts.append((account_config, folders))
+    return accounts
+
+
+class Engine:
+
+    def __init__(self, config_service=None):
+        """
+        :param config_service: Where the latest config comes from, otherwise the config file is loaded.
+        """
+        self.config_service = config_service or ConfigService()
+        self.settings = self.config_service.snapshot()
+        self.scan_state = ScanState(state_path(self.settings, STATE_FILE))
+        self.archive = Archive(self.settings['archive_dir'])
+        self.reply_cache = ReplyCache(self.settings, state_path(self.settings, CACHE_FILE))
+        self.decision_log = DecisionLog(state_path(self.settings, self.settings['decision_log_file']))
+
+        # (username, folder) -> EmailBlocker, every folder gets its own IMAP session
+        self.blockers = {}
+        # username -> ReplyQueue, shared by all folders of an account
+        self.replies = {}
+        # username -> semaphore limiting how many folders of the account are checked at once
+        self.limits = {}
+        # username -> the account_concurrency its semaphore was built with
+        self.concurrency = {}
+        # the accounts with idle_mode that were told it is ignored
+        self.idle_ignored = set()
+        # (username, folder) -> monotonic() time when the folder is checked next
+        self.due = {}
+
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+
+        # set by stop(), run_forever() returns after the pass that is running
+        self.stopping = threading.Event()
+
+    def sync(self):
+        """
+        Creates a checker for every account and folder in the config and applies the config to existing ones.
+        """
+        wanted = {}
+        for account_config, folders in account_configs(self.settings):
+            for folder in folders:
+                wanted[(account_config['username'], folder)] = {**account_config, 'search_mail_folder': folder}
+
+        for key in list(self.blockers):
+            if key not in wanted:
+                self.blockers.pop(key).connections.close()
+                self.due.pop(key, None)
+
+        idle = sorted({key[0] for key, settings in wanted.items() if settings['idle_mode']})
+        if idle and set(idle) != self.idle_ignored:
+            log(' idle_mode is ignored with accounts, the folders are polled instead: ' + ', '.join(idle), Style.yellow,
+                'warning', accounts=idle)
+        self.idle_ignored = set(idle)
+
+        for key, settings in wanted.items():
+            username = key[0]
+            if self.concurrency.get(username) != settings['account_concurrency']:
+                # folders that are being checked release the old semaphore, the new limit applies to the next ones
+                self.limits[username] = threading.BoundedSemaphore(settings['account_concurrency'])
+                self.concurrency[username] = settings['account_concurrency']
+
+            if key in self.blockers:
+                self.blockers[key].apply_config(settings)
+                continue
+
+            try:
+                blocker = EmailBlocker(
+                    settings,
+                    self.scan_state,
+                    self.replies.get(username),
+                    self.archive,
+                    self.reply_cache,
+                    interactive=False,
+                    decision_log=self.decision_log
+                )
+            except AccountError as e:
+                log(' Skipping ' + username + ': ' + str(e), Style.red, 'error', account=username)
+                continue
+
+            if username not in self.replies:
+                self.replies[username] = blocker.replies
+                blocker.replies.start()
+            self.blockers[key] = blocker
+
+    def check_folder(self, key):
+        """
+        Runs a single pass over one folder of one account and schedules the next one. Errors are reported but never
+        raised.
+
+        :param key: The (username, folder) tuple.
+        """
+        username, folder = key
+        blocker = self.blockers[key]
+
+        scanned = blocked = errors = 0
+        with self.limits[username]:
+            start_time = perf_counter()
+            try:
+                scanned, blocked = blocker.bot_pass()
+            except AccountError as e:
+                errors = 1
+                metrics.count('errors', account=username, kind='account')
+                log(' ' + username + ': ' + str(e), Style.red, 'error', account=username, folder=folder)
+            except Exception as e:
+                errors = 1
+                metrics.count('errors', account=username, kind=type(e).__name__)
+                log(' ' + username + ' "' + folder + '" failed: ' + type(e).__name__ + ': ' + str(e), Style.red,
+                    'error', account=username, folder=folder)
+                # the connections are reopened on the next pass
+                blocker.connections.close()
+            elapsed = perf_counter() - start_time
+
+        if errors:
+            blocker.scheduler.record_failure()
+        else:
+            blocker.scheduler.record(blocked)
+        self.due[key] = monotonic() + blocker.scheduler.next_delay()
+
+        with self._stats_lock:
+            stats = self.stats.setdefault(username, {'scanned': 0, 'blocked': 0, 'errors': 0, 'seconds': 0.0})
+            stats['scanned'] += scanned
+            stats['blocked'] += blocked
+            stats['errors'] += errors
+            stats['seconds'] += elapsed
+
+    def run_pass(self, keys=None):
+        """
+        Checks folders once and prints a summary.
+
+        :param keys: The (username, folder) tuples to check, all folders if None.
+        """
+        self.stats = {}
+        start_time = perf_counter()
+
+        with ThreadPoolExecutor(self.settings['engine_workers']) as pool:
+            list(pool.map(self.check_folder, list(self.blockers) if keys is None else keys))
+
+        self.print_summary(perf_counter() - start_time)
+
+    def print_summary(self, elapsed):
+        log('\n Pass finished in ' + '{:.1f}'.format(elapsed) + ' seconds ', Style.blue + Style.inverted,
+            seconds=round(elapsed, 3))
+        for username, stats in sorted(self.stats.items()):
+            rate = stats['scanned'] / stats['seconds'] if stats['seconds'] else 0.0
+            failed = ', ' + str(stats['errors']) + ' failed' if stats['errors'] else ''
+            log(' ' + username + ': ' + str(stats['scanned']) + ' checked (' + '{:.1f}'.format(rate) + '/s), ' +
+                str(stats['blocked']) + ' blocked' + failed,
+                Style.red if stats['errors'] else '', 'error' if stats['errors'] else 'info', account=username, **stats)
+
+    def stop(self):
+        """
+        Makes run_forever() return once the pass that is running is done. Can be called from a signal handler.
+        """
+        self.stopping.set()
+
+    def close(self):
+        """
+        Waits for the replies that are being sent right now and closes all connections.
+        """
+        for replies in self.replies.values():
+            replies.stop(timeout=30)
+        for blocker in self.blockers.values():
+            blocker.connections.close()
+        self.archive.close()
+
+    def run_forever(self):
+        # check every folder when it is due until stop() is called
+        while not self.stopping.is_set():
+            # the config file is only parsed again when it changed, unchanged checkers keep their state
+            self.settings = self.config_service.snapshot()
+            set_log_format(self.settings['log_format'])
+            self.sync()
+
+            now = monotonic()
+            due = [key for key in self.blockers if self.due.get(key, now) <= now]
+            if due:
+                self.run_pass(due)
+            if self.stopping.is_set():
+                break
+
+            # sleep until the next folder is due, new folders are due right away
+            next_due = min((self.due.get(key, now) for key in self.blockers),
+                           default=now + self.settings['update_interval'] * 60)
+            sleep_time = max(0.0, next_due - monotonic())
+            metrics.heartbeat(sleep_time)
+            seconds = round(sleep_time)
+            log('\nSleeping for ' + str(seconds // 60) + ' minutes and ' + str(seconds % 60) + ' seconds',
+                sleep_seconds=round(sleep_time, 1))
+
+            # an edited config file is applied right away instead of after the sleep
+            if self.config_service.wait_for_change(sleep_time, self.stopping):
+                log('\nThe config file changed, checking again with the new settings')
+                self.due.clear()
@@ -0,0 +1,635 @@
+"""
+Helpers for talking to IMAP servers in as few round trips as possible.
+
+imaplib hands FETCH responses back as a flat list of (text, literal) tuples and stray bytes, which is awkward to use
+when many messages are fetched with a single command. The functions in here take care of building compact message
+sets and parsing those responses back into one object per message.
+"""
+
+import datetime
+import re
+import socket
+from email.parser import BytesHeaderParser
+from decoding import decode_part, mime_headers_for_part, decode_header_value, parse_date
+from time import monotonic
+
+# the header fields that are downloaded for every candidate message
+HEADER_FIELDS = ('FROM', 'SUBJECT', 'DATE', 'CONTENT-TYPE', 'CONTENT-TRANSFER-ENCODING')
+
+# how often idle_wait() calls its interrupt function, in seconds
+INTERRUPT_INTERVAL = 1.0
+
+# how many bytes are read at once while waiting in IDLE
+IDLE_READ_SIZE = 4096
+
+# IMAP dates always use the English month names, whatever the locale is
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+# quarantined emails are tagged with the day they were moved, e.g. $Quarantined-20261018, since the server keeps the
+# date they first arrived
+QUARANTINE_KEYWORD = '$Quarantined-'
+
+_message_start = re.compile(rb'^\s*(\d+) \(')
+_uid_item = re.compile(rb'UID (\d+)')
+_internaldate_item = re.compile(rb'INTERNALDATE "([^"]+)"')
+_flags_item = re.compile(rb'FLAGS \(([^)]*)\)')
+_section_item = re.compile(rb'(BODY\[[^\]]*\])(?:<\d+>)? \{\d+\}$')
+_literal_marker = re.compile(rb'\{\d+\}$')
+_structure_token = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+_folded_line = re.compile(r'\r?\n[ \t]+')
+
+
+def message_set(ids):
+    """
+    Compacts message ids (or UIDs) into an IMAP message set, so a single command can address all of them.
+    For example, [b'1', b'2', b'3', b'7'] becomes '1:3,7'.
+
+    :param ids: An iterable of ids as bytes, str or int.
+    :return: A message set string.
+    """
+    numbers = sorted({int(i) for i in ids})
+    ranges = []
+
+    start = previous = None
+    for number in numbers:
+        if previous is not None and number == previous + 1:
+            previous = number
+            continue
+        if start is not None:
+            ranges.append(str(start) if start == previous else str(start) + ':' + str(previous))
+        start = previous = number
+
+    if start is not None:
+        ranges.append(str(start) if start == previous else str(start) + ':' + str(previous))
+
+    return ','.join(ranges)
+
+
+class FetchedMessage:
+    """
+    Everything a FETCH command returned for a single message.
+
+    If the body wasn't fetched together with the headers, it is downloaded the first time it is used.
+    """
+
+    def __init__(self, seq):
+        self.seq = seq
+        self.uid = None
+        self.sections = {}
+        self._headers = None
+        self._text = None
+
+        # the FETCH response without the BODY[...] sections, e.g. the BODYSTRUCTURE
+        self.fetch_text = b''
+        self._structure = None
+
+        # set by batch_fetch() so the body can be downloaded later
+        self.imap = None
+        self.max_body_bytes = None
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._headers = BytesHeaderParser().parsebytes(self.sections.get('HEADER', b''))
+        return self._headers
+
+    def header(self, name):
+        """
+        Returns an unfolded header value or an empty string if the header is missing.
+
+        :param name: The header name, e.g. 'From'.
+        """
+        value = self.headers.get(name)
+        if value is None:
+            return ''
+        return _folded_line.sub(' ', str(value)).strip()
+
+    def header_values(self, name):
+        """
+        Returns the unfolded values of a header that can occur several times, e.g. 'Received'.
+
+        :param name: The header name.
+        """
+        return [_folded_line.sub(' ', str(value)).strip() for value in self.headers.get_all(name, [])]
+
+    @property
+    def sender(self):
+        return self.header('From')
+
+    @property
+    def subject(self):
+        return self.header('Subject')
+
+    @property
+    def date(self):
+        return self.header('Date')
+
+    @property
+    def internaldate(self):
+        """
+        When the server received the message, as a timezone aware datetime. None if it wasn't fetched.
+        """
+        found = _internaldate_item.search(self.fetch_text)
+        if not found:
+            return None
+        # "17-Jul-1996 02:44:25 -0700" is a Date header with dashes
+        return parse_date(found.group(1).decode('ascii', 'replace').strip().replace('-', ' ', 2))
+
+    @property
+    def date_time(self):
+        """
+        The date of the message as a timezone aware datetime. The INTERNALDATE is used when the Date header is missing
+        or unreadable, None is returned if neither can be used.
+        """
+        return parse_date(self.date) or self.internaldate
+
+    @property
+    def body(self):
+        if 'BODY[1]' not in self.sections and self.imap is not None:
+            fetch_bodies(self.imap, [self], self.max_body_bytes)
+        return self.sections.get('BODY[1]', b'')
+
+    def release_body(self):
+        """
+        Lets go of the downloaded body, it is downloaded again if it is used later.
+        """
+        self.sections.pop('BODY[1]', None)
+        self.sections.pop('BODY[1.MIME]', None)
+        self._text = None
+
+    def text(self):
+        """
+        Returns the first body part decoded according to its MIME headers.
+        """
+        if self._text is None:
+            body = self.body
+            mime_headers = mime_headers_for_part(self.sections.get('BODY[1.MIME]'), self.sections.get('HEADER'))
+            self._text = decode_part(body, mime_headers)
+        return self._text
+
+    @property
+    def structure(self):
+        """
+        The parsed BODYSTRUCTURE as nested lists of bytes, or None if it wasn't fetched.
+        """
+        if self._structure is None:
+            start = self.fetch_text.upper().find(b'BODYSTRUCTURE (')
+            if start < 0:
+                return None
+            self._structure = parse_structure(self.fetch_text[start + len(b'BODYSTRUCTURE '):])
+        return self._structure
+
+    def attachments(self):
+        """
+        Returns the content type and file name of every part of the email, according to the BODYSTRUCTURE.
+
+        :return: A list of (content type, file name) tuples in lower case, the file name is empty if there is none.
+        """
+        return list(_structure_parts(self.structure)) if self.structure is not None else []
+
+
+def parse_structure(data):
+    """
+    Parses a parenthesized IMAP list, like a BODYSTRUCTURE, into nested lists. NIL becomes None.
+
+    :param data: Bytes starting with the opening parenthesis.
+    """
+    stack = [[]]
+    for token in _structure_token.findall(data):
+        if token == b'(':
+            stack.append([])
+        elif token == b')':
+            if len(stack) == 1:
+                break
+            finished = stack.pop()
+            stack[-1].append(finished)
+            if len(stack) == 1:
+                break
+        elif token.startswith(b'"'):
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', token[1:-1]))
+        else:
+            stack[-1].append(None if token.upper() == b'NIL' else token)
+    return stack[0][0] if stack[0] else None
+
+
+def _structure_parts(part):
+    if not isinstance(part, list) or not part:
+        return
+
+    # a multipart starts with its sub parts
+    if isinstance(part[0], list):
+        for sub_part in part:
+            if not isinstance(sub_part, list):
+                break
+            yield from _structure_parts(sub_part)
+        return
+
+    content_type = b'/'.join(value or b'' for value in part[:2]).decode('utf-8', 'replace').lower()
+
+    # the file name is either the "name" parameter or the "filename" of the content disposition
+    filename = ''
+    for item in part[2:]:
+        pairs = item if isinstance(item, list) else []
+        if len(pairs) >= 2 and isinstance(pairs[0], bytes) and isinstance(pairs[1], list):
+            pairs = pairs[1]
+        for key, value in zip(pairs[::2], pairs[1::2]):
+            if isinstance(key, bytes) and key.upper() in (b'NAME', b'FILENAME') and isinstance(value, bytes):
+                filename = decode_header_value(value.decode('utf-8', 'replace')).lower()
+    yield content_type, filename
+
+    # an attached email has its own structure
+    if content_type == 'message/rfc822' and len(part) > 8:
+        yield from _structure_parts(part[8])
+
+
+def _section_name(section):
+    section = section.decode('ascii', 'replace').upper()
+    if 'HEADER' in section:
+        return 'HEADER'
+    return section
+
+
+def parse_fetch_response(data):
+    """
+    Parses the raw response of a FETCH command that covered many messages.
+
+    :param data: The data list returned by imaplib's fetch() or uid('FETCH', ...).
+    :return: A dict of sequence number -> FetchedMessage.
+    """
+    messages = {}
+    current = None
+
+    for item in data:
+        if item is None:
+            continue
+
+        text = item[0] if isinstance(item, tuple) else item
+
+        start = _message_start.match(text)
+        if start:
+            seq = int(start.group(1))
+            current = messages.setdefault(seq, FetchedMessage(seq))
+
+        if current is None:
+            continue
+
+        uid = _uid_item.search(text)
+        if uid:
+            current.uid = int(uid.group(1))
+
+        if isinstance(item, tuple):
+            section = _section_item.search(text)
+            if section:
+                current.sections[_section_name(section.group(1))] = item[1]
+                current.fetch_text += text[:section.start()]
+            else:
+                # a literal inside the BODYSTRUCTURE, e.g. a file name with special characters
+                current.fetch_text += _literal_marker.sub(b'', text) + \
+                    b'"' + item[1].replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+        else:
+            current.fetch_text += text
+
+    return messages
+
+
+def batch_fetch(imap, uids, fields=HEADER_FIELDS, with_body=True, max_body_bytes=None, with_structure=False):
+    """
+    Fetches the headers (and optionally the first body part) of many messages with a single UID FETCH command.
+    Everything is fetched with BODY.PEEK so none of the messages get marked as read.
+
+    :param imap: A logged in imaplib connection with a mailbox selected.
+    :param uids: Message UIDs.
+    :param fields: The header fields to download.
+    :param with_body: Also download BODY[1] and its MIME headers. Otherwise it is downloaded when first used.
+    :param max_body_bytes: Only download the first max_body_bytes bytes of the body. None or 0 for no limit.
+    :param with_structure: Also download the BODYSTRUCTURE, which lists the attachments without their content.
+    :return: A list of FetchedMessage in the same order as uids.
+    """
+    if not uids:
+        return []
+
+    # the INTERNALDATE stands in for broken Date headers, it's only a few bytes per message
+    items = 'UID INTERNALDATE BODY.PEEK[HEADER.FIELDS (' + ' '.join(fields) + ')]'
+    if with_structure:
+        items += ' BODYSTRUCTURE'
+    if with_body:
+        items += ' BODY.PEEK[1.MIME] BODY.PEEK[1]' + ('<0.' + str(max_body_bytes) + '>' if max_body_bytes else '')
+
+    _, data = imap.uid('FETCH', message_set(uids), '(' + items + ')')
+    messages = {message.uid: message for message in parse_fetch_response(data).values()}
+
+    for message in messages.values():
+        message.imap = imap
+        message.max_body_bytes = max_body_bytes
+
+    return [messages[int(uid)] for uid in uids if int(uid) in messages]
+
+
+def fetch_bodies(imap, messages, max_bytes=None):
+    """
+    Downloads the first body part of many already fetched messages with a single UID FETCH command.
+
+    :param imap: A logged in imaplib connection with the mailbox of the messages selected.
+    :param messages: FetchedMessage objects without a body.
+    :param max_bytes: Only download the first max_bytes bytes of every body. None or 0 downloads them completely.
+    """
+    missing = {message.uid: message for message in messages if 'BODY[1]' not in message.sections}
+    if not missing:
+        return
+
+    partial = '<0.' + str(max_bytes) + '>' if max_bytes else ''
+    _, data = imap.uid('FETCH', message_set(missing), '(UID BODY.PEEK[1.MIME] BODY.PEEK[1]' + partial + ')')
+
+    for fetched in parse_fetch_response(data).values():
+        message = missing.get(fetched.uid)
+        if message is not None:
+            message.sections.update(fetched.sections)
+
+    # don't try again for messages the server returned nothing for
+    for message in missing.values():
+        message.sections.setdefault('BODY[1]', b'')
+
+
+def uid_search(imap, criteria, after_uid=0, up_to_uid=None):
+    """
+    Runs a UID SEARCH that only covers messages newer than after_uid.
+
+    :param imap: A logged in imaplib connection with a mailbox selected.
+    :param criteria: IMAP search criteria, e.g. 'FROM "spam@example.com"'.
+    :param after_uid: Only return UIDs greater than this.
+    :param up_to_uid: Only return UIDs up to this one, None for no limit.
+    :return: A sorted list of UIDs as int.
+    """
+    uid_range = str(after_uid + 1) + ':' + (str(up_to_uid) if up_to_uid else '*')
+    _, data = imap.uid('SEARCH', None, 'UID', uid_range, '(' + criteria + ')')
+
+    uids = []
+    for block in data:
+        if block:
+            uids += [int(uid) for uid in block.split()]
+
+    # "n:*" always matches the newest message, even if its UID is lower than n
+    return sorted(uid for uid in uids if uid > after_uid and (not up_to_uid or uid <= up_to_uid))
+
+
+def highest_uid(imap):
+    """
+    Returns the UID of the newest message in the selected mailbox, or None if it is empty.
+    """
+    _, data = imap.uid('SEARCH', None, 'UID', '*')
+    uids = [int(uid) for block in data if block for uid in block.split()]
+    return max(uids) if uids else None
+
+
+def uid_validity(imap):
+    """
+    Returns the UIDVALIDITY of the selected mailbox, or None if the server didn't report one.
+    """
+    _, data = imap.response('UIDVALIDITY')
+    if data and data[0]:
+        return int(data[-1])
+    return None
+
+
+def delete_messages(imap, uids):
+    """
+    Deletes many messages at once: one UID STORE over the whole set followed by a single expunge.
+    When the server supports UIDPLUS only the given messages are expunged, otherwise a plain EXPUNGE is used.
+
+    :param imap: A logged in imaplib connection with a mailbox selected.
+    :param uids: The UIDs of the messages to delete.
+    :return: The number of messages that were deleted.
+    """
+    uids = set(uids)
+    if not uids:
+        return 0
+
+    uid_set = message_set(uids)
+    imap.uid('STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+
+    if 'UIDPLUS' in imap.capabilities:
+        imap.uid('EXPUNGE', uid_set)
+    else:
+        imap.expunge()
+
+    return len(uids)
+
+
+def quote_mailbox(name):
+    """
+    Quotes a mailbox name for a command, imaplib sends arguments as they are.
+
+    :param name: The mailbox name, e.g. 'Junk E-mail'.
+    """
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def move_messages(imap, uids, folder, keyword=None):
+    """
+    Moves many messages to another folder at once with a single UID MOVE. Servers without MOVE get one UID COPY and
+    then delete_messages(). The folder is created if it doesn't exist yet.
+
+    :param imap: A logged in imaplib connection with a mailbox selected.
+    :param uids: The UIDs of the messages to move.
+    :param folder: The folder to move them to.
+    :param keyword: A keyword the messages are tagged with first, e.g. quarantine_keyword(). It is kept in the other
+                    folder. Servers that don't allow keywords move the messages without it.
+    :return: The number of messages that were moved.
+    """
+    uids = set(uids)
+    if not uids:
+        return 0
+
+    uid_set = message_set(uids)
+    mailbox = quote_mailbox(folder)
+    if keyword is not None:
+        imap.uid('STORE', uid_set, '+FLAGS.SILENT', '(' + keyword + ')')
+    command = 'MOVE' if 'MOVE' in imap.capabilities else 'COPY'
+
+    typ, data = imap.uid(command, uid_set, mailbox)
+    if typ != 'OK':
+        # usually "NO [TRYCREATE]", the folder doesn't exist yet
+        imap.create(mailbox)
+        typ, data = imap.uid(command, uid_set, mailbox)
+        if typ != 'OK':
+            raise imap.error(command + ' to ' + folder + ' failed: ' + b' '.join(data).decode('utf-8', 'replace'))
+
+    if command == 'COPY':
+        delete_messages(imap, uids)
+    return len(uids)
+
+
+def search_date(date):
+    """
+    Formats a date for SEARCH keys like BEFORE, e.g. '18-Oct-2026'.
+    """
+    return str(date.day) + '-' + MONTHS[date.month - 1] + '-' + str(date.year)
+
+
+def quarantine_keyword(date=None):
+    """
+    Returns the keyword quarantined messages are tagged with, e.g. '$Quarantined-20261018'.
+
+    :param date: The day the messages are moved, today if not given.
+    """
+    return QUARANTINE_KEYWORD + (date or datetime.date.today()).strftime('%Y%m%d')
+
+
+def quarantine_date(flags):
+    """
+    Returns the latest day in the quarantine keywords of a message, or None if it has none.
+
+    :param flags: The flags of the message as strings.
+    """
+    dates = []
+    for flag in flags:
+        if flag.lower().startswith(QUARANTINE_KEYWORD.lower()):
+            try:
+                dates.append(datetime.datetime.strptime(flag[len(QUARANTINE_KEYWORD):], '%Y%m%d').date())
+            except ValueError:
+                continue
+    return max(dates, default=None)
+
+
+def fetch_flags(imap):
+    """
+    Downloads the flags of all messages in the selected mailbox with a single UID FETCH.
+
+    :param imap: A logged in imaplib connection with a mailbox selected, which must not be empty.
+    :return: A dict of UID -> list of flags as strings.
+    """
+    _, data = imap.uid('FETCH', '1:*', '(FLAGS)')
+    flags = {}
+    for item in data:
+        line = item[0] if isinstance(item, tuple) else item
+        uid = _uid_item.search(line or b'')
+        found = _flags_item.search(line or b'')
+        if uid and found:
+            flags[int(uid.group(1))] = found.group(1).decode('utf-8', 'replace').split()
+    return flags
+
+
+def purge_quarantine(imap, folder, days):
+    """
+    Deletes the messages that were moved to the quarantine folder more than the given number of days ago, with one
+    delete_messages(). The server keeps the arrival date of moved messages, so the day of the move is searched with
+    SAVEDBEFORE on servers with SAVEDATE and read from the keyword move_messages() tagged them with otherwise. Messages
+    without that keyword, e.g. ones quarantined by an older version, are tagged with today and kept for the full number
+    of days from then on. Servers that don't allow keywords fall back to the arrival date. The folder stays selected.
+
+    :param imap: A logged in imaplib connection.
+    :param folder: The quarantine folder.
+    :param days: How many days the messages are kept.
+    :return: The number of messages that were deleted.
+    """
+    typ, data = imap.select(quote_mailbox(folder))
+    if typ != 'OK' or not int(data[0] or 0):
+        # nothing was moved there yet, or it was all deleted
+        return 0
+
+    cutoff = datetime.date.today() - datetime.timedelta(days=days)
+    _, permanent = imap.response('PERMANENTFLAGS')
+
+    if 'SAVEDATE' in imap.capabilities:
+        key = 'SAVEDBEFORE'
+    elif permanent and permanent[-1] and b'\\*' not in permanent[-1]:
+        # no new keywords can be stored
+        key = 'BEFORE'
+    else:
+        key = None
+
+    if key is not None:
+        typ, data = imap.uid('SEARCH', key, search_date(cutoff))
+        uids = [int(uid) for uid in data[0].split()] if typ == 'OK' and data and data[0] else []
+        return delete_messages(imap, uids)
+
+    expired = []
+    untagged = []
+    for uid, flags in fetch_flags(imap).items():
+        date = quarantine_date(flags)
+        if date is None:
+            untagged.append(uid)
+        elif date < cutoff:
+            expired.append(uid)
+
+    if untagged:
+        imap.uid('STORE', message_set(untagged), '+FLAGS.SILENT', '(' + quarantine_keyword() + ')')
+    return delete_messages(imap, expired)
+
+
+def _is_exists(line):
+    # "* 23 EXISTS", the number of emails in the folder changed
+    return line.startswith(b'* ') and line.rstrip().upper().endswith(b'EXISTS')
+
+
+def idle_wait(imap, timeout, interrupt=None):
+    """
+    Sends IDLE and waits until the server pushes a new message (an EXISTS response) or the timeout runs out, then ends
+    the IDLE with DONE. Servers drop idle connections after 30 minutes, so the timeout should stay below that and the
+    caller simply calls this again.
+
+    :param imap: A logged in imaplib connection with a mailbox selected. The server must support IDLE.
+    :param timeout: The maximum number of seconds to wait.
+    :param interrupt: Called about every second while waiting, the IDLE ends early when it returns True.
+    :return: True if new mail arrived, False if the timeout ran out or the wait was interrupted.
+    """
+    # noinspection PyProtectedMember
+    tag = imap._new_tag()
+    imap.send(tag + b' IDLE\r\n')
+
+    # wait for the continuation response, "+ idling"
+    while True:
+        line = imap.readline()
+        if not line:
+            raise imap.abort('connection closed while starting IDLE')
+        if line.startswith(b'+'):
+            break
+        if line.startswith(tag):
+            raise imap.error('IDLE failed: ' + line.decode('utf-8', 'replace').strip())
+
+    new_mail = False
+    deadline = monotonic() + timeout
+    blocking_timeout = imap.sock.gettimeout()
+    # what was read while waiting, a line that was cut off by a timeout stays here until the rest of it arrives
+    pending = b''
+    try:
+        while not new_mail:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+
+            # a socket timeout instead of select(), which can't see lines imaplib has already buffered, e.g. an EXISTS
+            # that came in the same packet as "+ idling"
+            imap.sock.settimeout(min(remaining, INTERRUPT_INTERVAL) if interrupt is not None else remaining)
+            try:
+                chunk = imap.file.read1(IDLE_READ_SIZE)
+            except socket.timeout:
+                # read1() only waits on the socket once imaplib's buffer is empty, so nothing was lost, but the file
+                # object refuses to read again after a timeout
+                imap.file.close()
+                imap.file = imap.sock.makefile('rb')
+                if interrupt is not None and interrupt():
+                    break
+                continue
+
+            if not chunk:
+                raise imap.abort('connection closed during IDLE')
+            *lines, pending = (pending + chunk).split(b'\n')
+            new_mail = any(_is_exists(line) for line in lines)
+    finally:
+        imap.sock.settimeout(blocking_timeout)
+
+    imap.send(b'DONE\r\n')
+
+    # read everything up to the tagged response of the IDLE command
+    while True:
+        line = pending + imap.readline()
+        pending = b''
+        if not line:
+            raise imap.abort('connection closed while ending IDLE')
+        if line.startswith(tag):
+            break
+        if _is_exists(line):
+            new_mail = True
+
+    return new_mail
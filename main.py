@@ -1,310 +1,840 @@
 import imaplib
 import os
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-import ssl
-import smtplib
+import threading
+from email.utils import parseaddr
 import datetime
-from time import sleep
-from widgets import sleep_time_until_checkpoint, easy_read, clear_console, easy_write, Style, config
+from time import perf_counter, monotonic
+from widgets import clear_console, easy_write, Style, log, set_log_format
+from imap_tools import batch_fetch, fetch_bodies, delete_messages, move_messages, purge_quarantine, \
+    quarantine_keyword, uid_validity, highest_uid, idle_wait, HEADER_FIELDS
+from scan_state import ScanState, search_key, STATE_FILE
+from connections import ConnectionManager, open_imap, is_network_error
+from reply_queue import ReplyQueue
+from blacklist import BlacklistMatcher
+from content_rules import ContentRules
+from search_query import plan_search, run_search
+from decoding import decode_header_value
+from archive import Archive
+from reply_cache import ReplyCache, CACHE_FILE, HEADER_FIELDS as REPLY_HEADER_FIELDS
+from config_service import ConfigService, ConfigError, changed, update_config_file, state_path
+from metrics import metrics
+from scheduler import Scheduler, SCHEDULE_KEYS
+from decision_log import DecisionLog, decision, actions_for, ACTION_PASS, HEADER_FIELDS as DECISION_HEADER_FIELDS
 import socket
-from setup_wizard import SetupWizard
 
 
-def imap_operation(search_str, criteria_field='from', logic_operator='or', previous_operation=''):
+# the config keys the blacklist matcher, the content rules and the search queries are built from
+MATCHER_KEYS = ('blacklist', 'rules', 'search_command_budget', 'shadow_mode', 'log_decisions')
+
+# how often the old emails are removed from the quarantine folder, in seconds
+SWEEP_INTERVAL = 3600
+
+# how many passes try to check and handle an email before it is left alone
+MESSAGE_ATTEMPTS = 3
+
+# the config keys of the reply cache
+REPLY_CACHE_KEYS = ('reply_cache_hours', 'reply_cache_size', 'reply_cache_key', 'sender_reply_limit',
+                    'global_reply_limit')
+
+
+def batches(items, size):
     """
-    Layers IMAP logic operators.
-    For example, you want to search for emails FROM 'grandma' OR FROM 'grandpa@example.com', do this:
-    
-    
-    x = imap_operation('grandma', 'from', 'or')
+    Splits a list into batches of the given size, or returns it as a single batch if size is None.
+    """
+    size = size or len(items)
+    return [items[start:start + size] for start in range(0, len(items), size)] if items else []
 
-    x = imap_operation('grandpa@example.com', 'from', 'or', x)
-    
-    :param search_str: A string of criteria to search for.
-    :param criteria_field: Can be an IMAP search criteria field such as 'from', 'to', 'subject', etc.
-    :param logic_operator: Can be 'or' or 'and'.
-    :param previous_operation: Use to chain multiple criteria.
-    :return: A string of IMAP search criteria.
+
+class AccountError(Exception):
+    """
+    Raised when an account can't be checked until its settings are fixed, e.g. after a failed login.
     """
-    
-    if logic_operator.upper() not in ['OR', 'AND']:
-        print('Invalid logic operator')
-        raise ValueError
-    
-    if previous_operation != '':
-        previous_operation += ' '
-    
-    return previous_operation + logic_operator.upper() + ' ' + criteria_field.upper() + ' ' + search_str
 
 
-def decode_email_str(email_input: str):
+def load_config():
     """
-    Emails are an encoded mess, especially when they contain special characters. Unfortunately, simply .decode() doesn't
-     work.
-    This function attempts to decode them into a simple string that resembles the original.
+    Loads the config file or prompts the user to set up the config.
     
-    :param email_input:
-    :return:
+    :return: A ConfigService that keeps the config up to date.
     """
-    decoded_email = ''
-    i = 0
-    while i < len(email_input) - 1:
-        
-        hex_code = ''
-        while i < len(email_input) - 2 and email_input[i] == '=' and \
-                email_input[i + 1].isalnum() and email_input[i + 2].isalnum():
-            hex_code += (email_input[i + 1] + email_input[i + 2])
-            i += 3
-        
-        if hex_code != '':
-            decoded_email += bytes.fromhex(hex_code).decode("utf-8", "ignore")
-            if i < len(email_input) - 1 and email_input[i] == '=':
-                i += 1
-        
-        if i < len(email_input) - 1:
-            decoded_email += email_input[i]
-            i += 1
-    
-    return decoded_email
+    try:
+        return ConfigService()
+    except FileNotFoundError:
+        from setup_wizard import SetupWizard
+        
+        print('It seems like you haven\'t run the setup wizard yet.\nLet\'s do that now!')
+        input('Press enter to continue...')
+        SetupWizard().setup()
+        return ConfigService()
 
 
 class EmailBlocker:
     
-    def __init__(self):
-        
-        # Load config file or prompt user to set up config
-        try:
-            self.config = config()
-        except FileNotFoundError:
-            print('It seems like you haven\'t run the setup wizard yet.\nLet\'s do that now!')
-            input('Press enter to continue...')
-            self.setupWizard = SetupWizard()
-            self.setupWizard.setup()
-            self.config = config()
+    def __init__(self, settings=None, scan_state=None, replies=None, archive=None, reply_cache=None, interactive=True,
+                 config_service=None, decision_log=None):
+        """
+        :param settings: The config of the account to check. Taken from the config service if not given.
+        :param scan_state: A ScanState shared with other accounts, otherwise one is created.
+        :param replies: A ReplyQueue shared with other folders of the same account, otherwise one is created.
+        :param archive: An Archive shared with other accounts, otherwise one is created when it is first needed.
+        :param reply_cache: A ReplyCache shared with other accounts, otherwise one is created.
+        :param interactive: Whether the user can be asked for input, e.g. for a valid mailbox name.
+        :param config_service: Where run_forever() gets the latest config from, otherwise the config file is loaded.
+        :param decision_log: A DecisionLog shared with other accounts, otherwise one is created when it is first needed.
+        """
+        if settings is None:
+            config_service = config_service or load_config()
+            settings = config_service.snapshot()
+        self.config_service = config_service
+        self.config = settings
+        self.interactive = interactive
         
         # make sure the blacklist contains items
         if len(self.config['blacklist']) == 0:
-            print('There\'s nothing in the blacklist.\nYou need to use the "setup_wizard.py" to add some.')
-            exit()
+            log('There\'s nothing in the blacklist.\nYou need to use the "setup_wizard.py" to add some.', level='error',
+                account=self.config.get('username'))
+            raise AccountError('The blacklist is empty')
         
-        # read the fancy email template
-        try:
-            self.email_reply_html = easy_read('templates/fancy_template.html')
-        except FileNotFoundError:
-            self.email_reply_html = None
-            self.reply_fancy_email = False
+        # the IMAP session and SMTP connections are kept open between passes
+        self.connections = ConnectionManager(self.config)
         
-        # read the plain text email template
-        try:
-            self.email_reply_plain_text = easy_read('templates/plain_template.txt')
-        except FileNotFoundError:
-            self.email_reply_plain_text = 'Email could not be delivered.'
-            easy_write('templates/plain_template.txt', self.email_reply_plain_text)
+        # replies are sent in the background so a slow SMTP server doesn't hold up the passes
+        self.replies = replies or ReplyQueue(
+            self.send_email,
+            spool_dir=self.config['spool_dir'],
+            max_queued=self.config['reply_queue_size'],
+            workers=self.config['reply_workers'],
+            per_server=self.config['smtp_pool_size'],
+            retries=self.config['reply_retries'],
+            retry_delay=self.config['reply_retry_delay'],
+        )
+        
+        # built once and reused for every email
+        self.build_matchers()
+        
+        # remembers which emails were already checked in earlier passes
+        self.scan_state = scan_state or ScanState(state_path(self.config, STATE_FILE))
+        
+        # keeps a sender from getting a reply for every single email
+        self.reply_cache = reply_cache or ReplyCache(self.config, state_path(self.config, CACHE_FILE))
+        
+        # decides when the folder is checked next
+        self.scheduler = Scheduler(self.config)
+        
+        # where blocked emails are archived
+        self._archive = archive
+        self.owns_archive = archive is None
+        
+        # where the decisions are logged in shadow mode or with log_decisions
+        self._decision_log = decision_log
+        
+        # set to False once the server turns out not to support IMAP IDLE
+        self.idle_supported = True
+        
+        # when the quarantine folder is cleaned up next
+        self.next_sweep = 0
+        
+        # the emails of the pass that failed, and the ones that failed in earlier passes as UID -> attempts
+        self.failed_uids = set()
+        self.retry_uids = {}
+        
+        # the reply templates are encoded once and reloaded when they change, loaded with the first reply
+        self._templates = None
+        
+        # set by stop(), run_forever() returns after the pass that is running
+        self.stopping = threading.Event()
+    
+    @property
+    def templates(self):
+        if self._templates is None:
+            from reply_templates import ReplyTemplates
+            self._templates = ReplyTemplates()
+        return self._templates
     
-    def send_email(self, receiver_email, message, subject='No Subject', html=None):
+    def send_email(self, receiver_email, subject='No Subject', quoted='', values=None):
         """
-        Sends an email to the specified receiver.
+        Sends a reply built from the templates to the specified receiver.
         
         :param receiver_email: The email address of the receiver.
-        :param message: The message to send.
         :param subject: The subject of the email.
-        :param html: The HTML version of the email.
+        :param quoted: The quoted original email, added below the plain text template.
+        :param values: The values for the template placeholders: sender, subject and date.
         """
         
-        # login to the email server
-        port = int(self.config['smtp_port'])
-        smtp_server = self.config['smtp_address']
-        
         sender_email = self.config['username']
-        password = self.config['password']
-        
-        msg = MIMEMultipart("alternative")
-        msg['Subject'] = subject
-        msg['From'] = sender_email
-        msg['To'] = receiver_email
-        
-        part1 = MIMEText(message)
-        msg.attach(part1)
-        if html:
-            part2 = MIMEText(html, 'html')
-            msg.attach(part2)
+        msg = self.templates.build(sender_email, receiver_email, subject, quoted, values)
         
-        context = ssl.create_default_context()
         try:
-            with smtplib.SMTP(smtp_server, port) as server:
-                server.starttls(context=context)
-                server.login(sender_email, password)
-                server.sendmail(sender_email, receiver_email, msg.as_string())
+            with self.stage('smtp'):
+                self.connections.sendmail(sender_email, receiver_email, msg)
         except socket.gaierror:
-            print('Sending email failed! You probably gave a wrong SMTP server.\n'
-                  'Delete the "config files/" directory and run again to set up the correct credentials or edit the '
-                  'config file manually.')
-            exit()
+            log('Sending email failed! You probably gave a wrong SMTP server.\n'
+                'Delete the "config files/" directory and run again to set up the correct credentials or edit the '
+                'config file manually.', level='error', account=sender_email)
+            raise
+        metrics.count('replied', account=sender_email)
     
-    def bot_pass(self):
-        # connect to the server and go to its inbox
+    def connect(self):
+        """
+        Returns the logged in IMAP session, reconnecting if it was lost.
+        
+        :return: A logged in imaplib connection.
+        """
+        # reuse the open connection or connect to the server
         try:
-            imap = imaplib.IMAP4_SSL(self.config['imap_address'])
-            # noinspection PyBroadException
+            return self.connections.imap()
         except socket.gaierror:
-            print('Looks like you gave a wrong IMAP server.\n'
-                  'Delete the "config files/" directory and run again to set up the correct credentials or edit the'
-                  ' config file manually.')
-            imap = None
-            exit()
-
-        # noinspection PyBroadException
-        try:
-            imap.login(self.config['username'], self.config['password'])
-            
+            log('Looks like you gave a wrong IMAP server.\n'
+                'Delete the "config files/" directory and run again to set up the correct credentials or edit the'
+                ' config file manually.', level='error', account=self.config['username'])
+            raise AccountError('Unknown IMAP server ' + self.config['imap_address'])
         except imaplib.IMAP4.error:
             # error occurs when there is incorrect login information
-            print('Login failed! Either the email, password, or IMAP server is wrong. \n'
-                  'If you have 2FA enabled, you will have to generate an app-specific password from your account '
-                  'settings.'
-                  '\n'
-                  ''
-                  'Delete the "config files/" directory and run again to set up the correct credentials or edit the '
-                  'config file manually.')
-            exit()
+            log('Login failed! Either the email, password, or IMAP server is wrong. \n'
+                'If you have 2FA enabled, you will have to generate an app-specific password from your account '
+                'settings.'
+                '\n'
+                ''
+                'Delete the "config files/" directory and run again to set up the correct credentials or edit the '
+                'config file manually.', level='error', account=self.config['username'])
+            raise AccountError('Login failed for ' + self.config['username'])
+    
+    def stage(self, name):
+        """
+        Times a stage of the pass for the metrics of this account.
+        
+        :param name: The stage, e.g. 'search'.
+        """
+        return metrics.stage(name, account=self.config['username'])
+    
+    def open_search_connection(self, folder):
+        """
+        Opens an extra connection used to run some of the search queries in parallel.
         
-        # format a logical string to search for the email
-        imap_operation_str = ''
-        for blocked_server in self.config['blacklist']:
-            imap_operation_str = imap_operation(blocked_server, previous_operation=imap_operation_str)
+        :param folder: The mail folder to select (read-only).
+        """
+        imap = open_imap(self.config)
+        imap.select(folder, readonly=True)
+        return imap
+    
+    def block_folder(self):
+        """
+        Returns the folder blocked emails are moved to, None if they are deleted.
+        """
+        if self.config['block_action'] == 'move':
+            return self.config['move_folder']
+        if self.config['block_action'] == 'quarantine':
+            return self.config['quarantine_folder']
+        return None
+    
+    def sweep_quarantine(self, imap):
+        """
+        Deletes the emails that were moved to the quarantine folder more than quarantine_days ago, at most once every
+        SWEEP_INTERVAL seconds. The checked folder has to be selected again afterwards.
+        
+        :param imap: The logged in IMAP session.
+        """
+        if self.config['block_action'] != 'quarantine' or not self.config['quarantine_days'] or \
+                monotonic() < self.next_sweep:
+            return
+        self.next_sweep = monotonic() + SWEEP_INTERVAL
         
-        print('\n' + Style.blue + Style.inverted + ' -> ' + datetime.datetime.now().strftime('%H:%M') +
-              ' Checking emails in "' + self.config['search_mail_folder'] + '" ' + Style.reset)
+        with self.stage('sweep'):
+            purged = purge_quarantine(imap, self.config['quarantine_folder'], self.config['quarantine_days'])
+        metrics.count('purged', purged, account=self.config['username'])
+        if purged:
+            log(' Removed ' + str(purged) + ' email(s) quarantined more than ' + str(self.config['quarantine_days']) +
+                ' days ago from "' + self.config['quarantine_folder'] + '"', account=self.config['username'],
+                purged=purged)
+    
+    def message_error(self, message, step, error):
+        """
+        Reports an email that couldn't be checked or handled. The pass goes on with the other emails.
+        
+        :param message: The email.
+        :param step: 'check' or 'handle'.
+        :param error: The exception.
+        """
+        metrics.count('message_errors', account=self.config['username'], step=step)
+        self.failed_uids.add(message.uid)
+        log(' Could not ' + step + ' email ' + str(message.uid) + ': ' + type(error).__name__ + ': ' + str(error),
+            Style.red, 'error', account=self.config['username'], uid=message.uid, step=step, error=repr(error))
+    
+    def handle_blocked(self, message):
+        """
+        Archives and replies to a blocked email, depending on the config.
+        
+        :param message: The blocked email.
+        """
+        if not (self.config['save_archive'] or self.config['also_reply_to_email']):
+            return
+        
+        email_sender = decode_header_value(message.sender)
+        
+        # the Date header, or when the server received the email if the header can't be read
+        date_obj = message.date_time or datetime.datetime.now().astimezone()
+        
+        # decode the email
+        with self.stage('decode'):
+            decode_email_content = message.text()
+            subject = decode_header_value(message.subject)
+        
+        # add the email to the compressed archive, it is written to disk at the end of the pass
+        if self.config['save_archive'] and self.config['archive_backend'] == 'archive':
+            with self.stage('archive'):
+                self.archive.add(
+                    email_sender,
+                    subject,
+                    date_obj,
+                    decode_email_content,
+                    uid=message.uid,
+                    account=self.config['username'],
+                    folder=self.config['search_mail_folder']
+                )
+        
+        # or save the email to a file so it follows the format 'email-date-uid.txt'
+        elif self.config['save_archive']:
+            archived_email_content = date_obj.strftime('%Y-%m-%d %H:%M:%S') + '\nFrom: ' + email_sender + \
+                                     '\nSubject: ' + subject + '\n\n' + decode_email_content
+            filename = f'emails/email-{date_obj.strftime("%Y-%m-%d %H.%M.%S")}-{message.uid}.txt'
+            try:
+                easy_write(filename, archived_email_content)
+            
+            except FileNotFoundError:
+                os.mkdir('emails')
+                easy_write(filename, archived_email_content)
+        
+        # don't reply to automatic emails or to senders who were replied to recently
+        reply_suppressed = None
+        if self.config['also_reply_to_email']:
+            reply_suppressed = self.reply_cache.allow(message, self.config['username'])
+            if reply_suppressed is not None:
+                metrics.count('replies_suppressed', account=self.config['username'], reason=reply_suppressed)
+                log(' No reply to ' + email_sender + ' (' + reply_suppressed + ')', sender=email_sender,
+                    reason=reply_suppressed)
+        
+        # queue the reply email, it is built from the templates and sent in the background
+        if self.config['also_reply_to_email'] and reply_suppressed is None:
+            from reply_templates import quote_original
+            
+            self.replies.put(
+                self.config['smtp_address'],
+                receiver_email=parseaddr(message.sender)[1],
+                subject='Re: ' + subject,
+                quoted=quote_original(email_sender, date_obj, decode_email_content),
+                values={'sender': email_sender, 'subject': subject, 'date': date_obj.strftime('%b %d, %Y')}
+            )
+            log(' Reply queued for: ' + email_sender, sender=email_sender)
+    
+    @property
+    def archive(self):
+        if self._archive is None:
+            self._archive = Archive(self.config['archive_dir'])
+        return self._archive
+    
+    @property
+    def decision_log(self):
+        if self._decision_log is None:
+            self._decision_log = DecisionLog(state_path(self.config, self.config['decision_log_file']))
+        return self._decision_log
+    
+    def apply_config(self, settings):
+        """
+        Switches to a newly loaded config. Only the parts that depend on changed settings are rebuilt.
+        
+        :param settings: The config dict.
+        """
+        old, self.config = self.config, settings
+        if settings is old:
+            return
+        set_log_format(settings['log_format'])
+        
+        # open connections are only dropped when the login or server settings changed
+        self.connections.update(settings)
+        
+        if changed(old, settings, MATCHER_KEYS):
+            self.build_matchers()
+        
+        if changed(old, settings, REPLY_CACHE_KEYS):
+            self.reply_cache.configure(settings)
+        
+        if changed(old, settings, SCHEDULE_KEYS):
+            self.scheduler.configure(settings)
+    
+    def build_matchers(self):
+        """
+        Builds the blacklist matcher, the content rules and the search queries from the config.
+        """
+        self.matcher = BlacklistMatcher(self.config['blacklist'])
+        self.rules = ContentRules(self.config['rules'])
+        
+        # content rules have to see every new email, so the server can't narrow the search down to the senders, and
+        # neither can it when the decisions are logged for replaying them with another blacklist
+        logged = self.config['shadow_mode'] or self.config['log_decisions']
+        terms = None if self.rules or logged else self.matcher.search_terms()
+        self.search_queries = plan_search(terms, budget=self.config['search_command_budget'])
+    
+    def bot_pass(self):
+        """
+        Checks the mail folder once and handles all blocked emails.
+        
+        :return: The number of emails checked and the number of blocked emails.
+        """
+        pass_start_time = perf_counter()
+        account = self.config['username']
+        imap = self.connect()
+        shadow = self.config['shadow_mode']
+        self.failed_uids = set()
+        
+        log('\n -> ' + datetime.datetime.now().strftime('%H:%M') + ' Checking emails in "' +
+            self.config['search_mail_folder'] + '" ', Style.blue + Style.inverted, account=account,
+            folder=self.config['search_mail_folder'])
+        
+        # clean up the quarantine before the mail folder is selected
+        if not shadow:
+            self.sweep_quarantine(imap)
         
         # apply a search criteria to the mailbox (like OR, AND, etc.)
+        folder = self.config['search_mail_folder']
         while True:
             # noinspection PyBroadException
             try:
-                imap.select(self.config['search_mail_folder'])
-                _, data = imap.search(None, imap_operation_str)
-                mail_ids = []
+                with self.stage('select'):
+                    imap.select(folder)
+                    validity = uid_validity(imap)
+                key = search_key(self.config['blacklist'], self.config['rules'])
+                
+                # only search the emails that arrived since the last pass
+                state_folder = account + '/' + folder
+                if shadow:
+                    # kept apart, so the emails are checked again for real once shadow mode is turned off
+                    state_folder += ' (shadow)'
+                last_uid = self.scan_state.last_uid(state_folder, validity, key)
+                self.retry_uids = self.scan_state.retries(state_folder, validity, key)
+                with self.stage('search'):
+                    if self.config['stream_mode']:
+                        top_uid = highest_uid(imap)
+                    else:
+                        mail_uids = self.search(imap, folder, last_uid)
                 break
             except imaplib.IMAP4.error:
-                print('The mailbox "' + self.config['search_mail_folder'] + '" does not exist.')
-                self.config['search_mail_folder'] = input('Please enter a valid mailbox: ')
-                config(self.config)
-        
-        # parse the message ids
-        for block in data:
-            # b'1 2 3'.split() => [b'1', b'2', b'3']
-            if block:
-                mail_ids += block.split()
-            else:
-                print(' No new emails')
-                break
+                log('The mailbox "' + folder + '" does not exist.', level='error', account=account)
+                if not self.interactive:
+                    raise AccountError('The mailbox "' + folder + '" does not exist')
+                folder = input('Please enter a valid mailbox: ')
+                self.config = {**self.config, 'search_mail_folder': folder}
+                update_config_file(search_mail_folder=folder)
         
-        # make the latest email id the first one
-        mail_ids.reverse()
+        if self.config['stream_mode']:
+            scanned, blocked = self.stream_folder(imap, folder, state_folder, validity, key, last_uid, top_uid)
         
-        # now check though each email
-        for email_id in mail_ids[:self.config['max_search_results']]:
-            _, sender_raw = imap.fetch(email_id, "BODY.PEEK[HEADER.FIELDS (From)]")
+        else:
+            if not mail_uids:
+                log(' No new emails', account=account, folder=folder)
             
-            # noinspection PyUnresolvedReferences
-            email_sender = sender_raw[0][1].decode('utf-8').replace('From: ', '').strip()
+            # make the latest email the first one, the ones that failed before come last
+            mail_uids.reverse()
+            scanned, blocked = self.check_messages(
+                imap, folder, mail_uids[:self.config['max_search_results']] + sorted(self.retry_uids, reverse=True)
+            )
             
-            print(email_id.decode('utf-8') + ': ' + email_sender)
-            for blocked_email in self.config['blacklist']:
-                if blocked_email in email_sender.lower():
-                    print(Style.red + Style.inverted + ' -> Blocked email found. ' + Style.reset)
-                    _, raw_content = imap.fetch(email_id, "BODY[1]")
-                    _, raw_subject = imap.fetch(email_id, "BODY.PEEK[HEADER.FIELDS (SUBJECT)]")
-                    _, raw_date = imap.fetch(email_id, "BODY.PEEK[HEADER.FIELDS (Date)]")
-                    
-                    # noinspection PyUnresolvedReferences
-                    date_str = raw_date[0][1].decode('utf-8').replace('Date: ', '').strip().replace(' (UTC)', '')
-                    
-                    # convert date to datetime object
-                    date_obj = datetime.datetime.strptime(date_str, '%a, %d %b %Y %H:%M:%S %z')
-                    
-                    # decode the email
-                    # noinspection PyUnresolvedReferences
-                    email_content = raw_content[0][1].decode("UTF-8")
-                    decode_email_content = decode_email_str(email_content)
-                    # noinspection PyUnresolvedReferences
-                    subject = decode_email_str(raw_subject[0][1].decode("UTF-8").replace('SUBJECT: ', ''))
-                    
-                    # save the email to a file so it follows the format 'subject-date.txt'
-                    if self.config['save_archive']:
-                        archived_email_content = date_obj.strftime('%Y-%m-%d %H:%M:%S') + '\nFrom: ' + email_sender + \
-                                                 '\nSubject: ' + subject + '\n\n' + decode_email_content
-                        try:
-                            easy_write(
-                                f'emails/email-{date_obj.strftime("%Y-%m-%d %H.%M.%S")}.txt',
-                                archived_email_content
-                            )
-                        
-                        except FileNotFoundError:
-                            os.mkdir('emails')
-                            easy_write(
-                                f'emails/email-{date_obj.strftime("%Y-%m-%d %H.%M.%S")}.txt',
-                                archived_email_content
-                            )
-                    
-                    # format header
-                    if self.config['also_reply_to_email']:
-                        reply_email_header = 'On ' + date_obj.strftime(
-                            '%b %d, %Y, at %I:%M %p') + ', ' + email_sender + ' wrote:'
-                        
-                        # format a reply email
-                        indented_email_content = '> ' + reply_email_header + '\n> \n'
-                        for i in decode_email_content.splitlines(keepends=False):
-                            indented_email_content += '> ' + i + '\n'
-                        
-                        # join the header and the email content
-                        email_reply_full_content = self.email_reply_plain_text + '\n\n\n' + indented_email_content
-                        
-                        # send the reply email
-                        self.send_email(
-                            receiver_email=email_sender,
-                            message=email_reply_full_content,
-                            subject='Re: ' + subject,
-                            html=self.email_reply_html
-                        )
-                        print(' Email replied to: ' + email_sender)
+            # remember how far this folder has been scanned
+            if mail_uids or self.retry_uids or self.failed_uids:
+                self.save_progress(state_folder, validity, key, max(mail_uids[0], last_uid) if mail_uids else last_uid)
+        
+        metrics.observe('pass_seconds', perf_counter() - pass_start_time, account=account)
+        return scanned, blocked
+    
+    def save_progress(self, state_folder, validity, key, last_uid, backfill=None):
+        """
+        Saves how far the folder has been scanned, together with the emails that failed so far and are tried again.
+        
+        :param state_folder: The name of the folder in the scan state.
+        :param validity: The UIDVALIDITY of the folder.
+        :param key: The search key of the blacklist and rules.
+        :param last_uid: Every email up to this UID was checked.
+        :param backfill: The (after, up to) UIDs an unfinished backfill covered.
+        """
+        retries = {}
+        for uid in self.failed_uids:
+            attempts = self.retry_uids.get(uid, 0) + 1
+            if attempts < MESSAGE_ATTEMPTS:
+                retries[uid] = attempts
+            else:
+                log(' Giving up on email ' + str(uid) + ' after ' + str(attempts) + ' attempts', Style.red, 'error',
+                    account=self.config['username'], uid=uid)
+        self.scan_state.update(state_folder, validity, key, last_uid, backfill, retries)
+        self.scan_state.save()
+    
+    def search(self, imap, folder, after_uid, up_to_uid=None):
+        """
+        Runs the search queries over the new emails of the selected folder.
+        
+        :param imap: The logged in IMAP session.
+        :param folder: The selected folder.
+        :param after_uid: Only emails with a higher UID are searched.
+        :param up_to_uid: Only emails up to this UID are searched, None for no limit.
+        :return: A sorted list of UIDs.
+        """
+        return run_search(
+            imap,
+            self.search_queries,
+            after_uid,
+            connect=lambda: self.open_search_connection(folder),
+            # extra connections would log in again for every window of a backfill
+            connections=1 if self.config['stream_mode'] else self.config['search_connections'],
+            up_to_uid=up_to_uid
+        )
+    
+    def stream_folder(self, imap, folder, state_folder, validity, key, last_uid, top_uid):
+        """
+        Checks a folder in windows of stream_window UIDs, from the newest emails to the oldest, so only one window of
+        headers and at most stream_memory_mb of bodies are held at a time. The progress is saved after every window
+        and an interrupted backfill goes on where it stopped, after the emails that arrived in the meantime.
+        
+        :param imap: The logged in IMAP session with the folder selected.
+        :param folder: The selected folder.
+        :param state_folder: The name of the folder in the scan state.
+        :param validity: The UIDVALIDITY of the folder.
+        :param key: The search key of the blacklist and rules.
+        :param last_uid: Every email up to this UID was checked already.
+        :param top_uid: The highest UID in the folder, None if it is empty.
+        :return: The number of emails checked and the number of blocked emails.
+        """
+        done = self.scan_state.backfill(state_folder, validity, key)
+        top_uid = max(top_uid or 0, last_uid, done[1] if done else 0)
+        
+        # (after, up to) UID ranges, the last one is the backfill whose progress is saved
+        ranges = [(done[1], top_uid), (last_uid, done[0])] if done else [(last_uid, top_uid)]
+        if not done and top_uid == last_uid:
+            log(' No new emails', account=self.config['username'], folder=folder)
+        
+        # the emails that failed before are tried again first
+        scanned, blocked = self.check_messages(imap, folder, sorted(self.retry_uids, reverse=True))
+        saved = False
+        for number, (after_uid, up_to_uid) in enumerate(ranges, 1):
+            while up_to_uid > after_uid:
+                window_start = max(after_uid, up_to_uid - self.config['stream_window'])
+                with self.stage('search'):
+                    mail_uids = self.search(imap, folder, window_start, up_to_uid)
+                mail_uids.reverse()
+                
+                window_scanned, window_blocked = self.check_messages(imap, folder, mail_uids)
+                scanned += window_scanned
+                blocked += window_blocked
+                up_to_uid = window_start
+                
+                if number == len(ranges):
+                    if window_start == last_uid:
+                        self.save_progress(state_folder, validity, key, top_uid)
+                    else:
+                        self.save_progress(state_folder, validity, key, last_uid, (window_start, top_uid))
+                    saved = True
+        
+        # without a window in the last range everything up to the top was checked already
+        if not saved and (self.retry_uids or self.failed_uids):
+            self.save_progress(state_folder, validity, key, top_uid)
+        return scanned, blocked
+    
+    def body_batch_size(self):
+        """
+        How many bodies are downloaded at once. In stream mode the batches are kept below stream_memory_mb, otherwise
+        all bodies of a pass are downloaded with a single command.
+        """
+        if not self.config['stream_mode']:
+            return None
+        if not self.config['max_body_bytes']:
+            return 1
+        return max(1, self.config['stream_memory_mb'] * 1048576 // self.config['max_body_bytes'])
+    
+    def check_messages(self, imap, folder, uids):
+        """
+        Checks emails and handles the blocked ones.
+        
+        :param imap: The logged in IMAP session with the folder selected.
+        :param folder: The selected folder.
+        :param uids: The UIDs of the emails, the newest first.
+        :return: The number of emails checked and the number of blocked emails.
+        """
+        account = self.config['username']
+        
+        # in shadow mode the emails are only matched and the decisions logged, nothing is deleted or replied to
+        shadow = self.config['shadow_mode']
+        log_decisions = shadow or self.config['log_decisions']
+        
+        # bodies are downloaded in batches and let go of after use when the memory is limited
+        batch_size = self.body_batch_size()
+        streaming = batch_size is not None
+        
+        # fetch the headers of the newest emails with a single command, bodies are only downloaded when needed
+        fields = HEADER_FIELDS + self.rules.header_fields
+        if self.config['also_reply_to_email']:
+            fields += REPLY_HEADER_FIELDS
+        if log_decisions:
+            fields += DECISION_HEADER_FIELDS
+        with self.stage('fetch'):
+            messages = batch_fetch(
+                imap,
+                uids,
+                fields=tuple(dict.fromkeys(fields)),
+                with_body=False,
+                max_body_bytes=self.config['max_body_bytes'],
+                with_structure=self.rules.needs_structure or log_decisions
+            )
+        metrics.count('scanned', len(messages), account=account)
+        
+        blocked = []
+        # uid -> the entry or rule that blocked the email
+        reasons = {}
+        
+        def block(blocked_message, blocked_rule):
+            log(' -> Blocked email found (' + blocked_rule.entry + '). ', Style.red + Style.inverted, account=account,
+                uid=blocked_message.uid, rule=blocked_rule.entry)
+            blocked.append(blocked_message)
+            reasons[blocked_message.uid] = blocked_rule.entry
+        
+        # now check though each email, the blacklist and the header conditions of the rules come first
+        needs_body = []
+        with self.stage('match'):
+            for message in messages:
+                # noinspection PyBroadException
+                try:
+                    email_sender = decode_header_value(message.sender)
                     
-                    if self.config['block_emails']:
-                        # mark email for deletion
-                        imap.store(email_id, "+FLAGS", "\\Deleted")
-                        print(' Original email deleted')
-                        
-                        # finish removing email
-                        imap.expunge()
-        
-        # close the mailbox
-        imap.close()
-        # logout from the account
-        imap.logout()
+                    log(str(message.uid) + ': ' + email_sender, account=account, uid=message.uid, sender=email_sender)
+                    rule = self.matcher.match(email_sender)
+                    pending = None
+                    if rule is None and self.rules:
+                        rule, pending = self.rules.check_headers(message)
+                except Exception as e:
+                    self.message_error(message, 'check', e)
+                    continue
+                
+                if rule is not None:
+                    block(message, rule)
+                elif pending:
+                    needs_body.append((message, pending))
+        
+        # download the bodies only for the emails a rule still depends on, all at once unless memory is limited
+        for batch in batches(needs_body, batch_size):
+            with self.stage('fetch_bodies'):
+                fetch_bodies(imap, [message for message, _ in batch], self.config['max_body_bytes'])
+            with self.stage('match_body'):
+                for message, pending in batch:
+                    # noinspection PyBroadException
+                    try:
+                        rule = self.rules.check_body(message, pending)
+                    except Exception as e:
+                        self.message_error(message, 'check', e)
+                        rule = None
+                    if rule is not None:
+                        block(message, rule)
+                    if streaming:
+                        # blocked ones are downloaded again with their batch below
+                        message.release_body()
+        metrics.count('matched', len(blocked), account=account)
+        
+        if log_decisions:
+            action = actions_for(self.config)
+            with self.stage('decision_log'):
+                self.decision_log.write([
+                    decision(message, account, folder, reasons.get(message.uid),
+                             action if message.uid in reasons else ACTION_PASS, shadow)
+                    for message in messages
+                ])
+        
+        handled = blocked
+        if shadow and blocked:
+            log(' Shadow mode: ' + str(len(blocked)) + ' email(s) would have been blocked (' + action + ')',
+                Style.yellow, account=account, would_block=len(blocked), action=action)
+            handled = []
+        
+        blocked_uids = set()
+        for batch in batches(handled, batch_size):
+            # download the bodies of the blocked emails at once, but only if the archive or the reply needs them
+            if self.config['save_archive'] or self.config['also_reply_to_email']:
+                with self.stage('fetch_bodies'):
+                    fetch_bodies(imap, batch, self.config['max_body_bytes'])
+            
+            for message in batch:
+                # noinspection PyBroadException
+                try:
+                    self.handle_blocked(message)
+                except Exception as e:
+                    # kept on the server, so nothing is lost that wasn't archived
+                    self.message_error(message, 'handle', e)
+                    continue
+                finally:
+                    if streaming:
+                        message.release_body()
+                
+                if self.config['block_emails']:
+                    # mark the email, they all get deleted or moved together once every email was checked
+                    blocked_uids.add(message.uid)
+        
+        # write the archived emails to disk at once, before they are deleted from the server
+        if self._archive is not None:
+            with self.stage('archive'):
+                self._archive.flush()
+        if handled and self.config['also_reply_to_email']:
+            self.reply_cache.save()
+        
+        # delete or move all the blocked emails with a single command
+        target = self.block_folder()
+        if blocked_uids and target is None:
+            start_time = perf_counter()
+            with self.stage('delete'):
+                deleted = delete_messages(imap, blocked_uids)
+            metrics.count('deleted', deleted, account=account)
+            log(' Deleted ' + str(deleted) + ' email(s) in ' + '{:.2f}'.format(perf_counter() - start_time) +
+                ' seconds', account=account, deleted=deleted)
+        elif blocked_uids and target.lower() != folder.lower():
+            # emails already in that folder stay, moving them would only give them new UIDs to check again
+            start_time = perf_counter()
+            with self.stage('move'):
+                # quarantined emails are tagged with the day of the move, their retention starts then
+                keyword = quarantine_keyword() if self.config['block_action'] == 'quarantine' else None
+                moved = move_messages(imap, blocked_uids, target, keyword)
+            metrics.count('moved', moved, account=account)
+            log(' Moved ' + str(moved) + ' email(s) to "' + target + '" in ' +
+                '{:.2f}'.format(perf_counter() - start_time) + ' seconds', account=account, moved=moved, to=target)
+        
+        return len(messages), len(blocked)
+    
+    def idle_forever(self):
+        """
+        Keeps one connection open and runs a pass every time the server pushes a new email with IMAP IDLE.
+        
+        :return: False if the server doesn't support IDLE and True if idle_mode was turned off in the config (or the bot
+                 is stopping), so the caller can fall back to polling.
+        """
+        imap = self.connect()
+        if 'IDLE' not in imap.capabilities:
+            log('The IMAP server doesn\'t support IDLE, checking emails every ' + str(self.config['update_interval']) +
+                ' minutes instead.', level='warning', account=self.config['username'])
+            self.idle_supported = False
+            return False
+        
+        new_mail = True
+        while not self.stopping.is_set():
+            if new_mail:
+                self.bot_pass()
+                log('\nWaiting for new emails...')
+            
+            # re-issue IDLE before the server times the connection out, a changed config file or stop() ends it early
+            version = self.config_service.version
+            metrics.heartbeat(self.config['idle_timeout'] * 60)
+            new_mail = idle_wait(self.connect(), self.config['idle_timeout'] * 60,
+                                 lambda: self.stopping.is_set() or self.config_service.reload())
+            
+            if self.config_service.version != version:
+                log('\nThe config file changed, checking again with the new settings')
+                self.apply_config(self.config_service.snapshot())
+                if not self.config['idle_mode']:
+                    return True
+                new_mail = True
+        return True
+    
+    def stop(self):
+        """
+        Makes run_forever() return once the pass that is running is done. Can be called from a signal handler.
+        """
+        self.stopping.set()
+    
+    def close(self):
+        """
+        Waits for the replies that are being sent right now and closes all connections.
+        """
+        self.replies.stop(timeout=30)
+        self.connections.close()
+        if self.owns_archive and self._archive is not None:
+            self._archive.close()
     
     def run_forever(self):
-        # check emails every x minutes forever
-        while True:
-            self.config = config()
+        if self.config_service is None:
+            self.config_service = ConfigService()
+        self.replies.start()
+        
+        # check emails every x minutes until stop() is called
+        while not self.stopping.is_set():
+            # the config file is only parsed again when it changed
+            self.apply_config(self.config_service.snapshot())
             
             try:
-                bot.bot_pass()
-            except TimeoutError:
-                print(Style.red + 'Network disconnected.' + Style.reset)
+                if self.config['idle_mode'] and self.idle_supported:
+                    if not self.idle_forever():
+                        # no IDLE on this server, the first polling pass runs right away
+                        continue
+                else:
+                    self.scheduler.record(self.bot_pass()[1])
+            except (OSError, imaplib.IMAP4.abort) as e:
+                # local errors like a missing directory or a full disk are not hidden as a lost connection
+                if not is_network_error(e):
+                    raise
+                metrics.count('errors', account=self.config['username'], kind='network')
+                log('Network disconnected.', Style.red, 'error', account=self.config['username'], error=str(e))
+                # the connections are reopened on the next pass, which waits longer with every failure in a row
+                self.connections.close()
+                self.scheduler.record_failure()
+            except imaplib.IMAP4.error as e:
+                # the server refused a command, e.g. moving the blocked emails to a folder that is over its quota. The
+                # emails are checked again on the next pass, which waits longer with every failure in a row
+                metrics.count('errors', account=self.config['username'], kind='imap')
+                log('The IMAP server refused a command: ' + str(e), Style.red, 'error', account=self.config['username'],
+                    error=str(e))
+                self.scheduler.record_failure()
             
-            # get time interval from the config and print wait time
-            sleep_time = sleep_time_until_checkpoint(self.config['update_interval'])
-            print('\nSleeping for ' + str(sleep_time // 60) + ' minutes and ' + str(sleep_time % 60) + ' seconds')
-            sleep(sleep_time)
+            if self.stopping.is_set():
+                break
+            
+            # the wait depends on the config, how much spam arrived lately and the failures in a row
+            sleep_time = self.scheduler.next_delay()
+            metrics.heartbeat(sleep_time)
+            seconds = round(sleep_time)
+            log('\nSleeping for ' + str(seconds // 60) + ' minutes and ' + str(seconds % 60) + ' seconds'
+                ' (connections reused: ' + str(self.connections.counters['imap_reused'] +
+                                               self.connections.counters['smtp_reused']) +
+                ', reopened: ' + str(self.connections.counters['imap_reopened'] +
+                                     self.connections.counters['smtp_reopened']) + ')',
+                sleep_seconds=round(sleep_time, 1), **self.connections.counters)
+            
+            # an edited config file is applied right away instead of after the sleep
+            if self.config_service.wait_for_change(sleep_time, self.stopping):
+                log('\nThe config file changed, checking again with the new settings')
 
 
 if __name__ == '__main__':
     
     clear_console()
-    bot = EmailBlocker()
+    try:
+        main_config = load_config()
+    except ConfigError as config_error:
+        print(Style.red + 'The config file has errors:\n' + str(config_error) + Style.reset)
+        exit()
+    
+    set_log_format(main_config.snapshot()['log_format'])
+    if main_config.snapshot()['metrics_port']:
+        # serves /metrics and /metrics.json for monitoring
+        metrics.serve(main_config.snapshot()['metrics_port'], main_config.snapshot()['metrics_address'])
+    
+    if main_config.snapshot().get('accounts'):
+        # several mailboxes are checked by a pool of workers
+        from engine import Engine
+        
+        bot = Engine(main_config)
+    else:
+        try:
+            bot = EmailBlocker(config_service=main_config)
+        except AccountError:
+            exit()
+    
     try:
         # runs scheduled function on this line forever
         bot.run_forever()
+    except AccountError:
+        pass
     except KeyboardInterrupt:
         # when control-c is pressed
-        print('\n\nProgram has exited')
+        log('\n\nProgram has exited')
+    finally:
+        bot.close()
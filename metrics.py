@@ -0,0 +1,249 @@
+"""
+Counters and timing histograms that show where the passes spend their time.
+
+Every pass is split into stages (connect, login, sweep, select, search, fetch, match, fetch_bodies, match_body,
+decision_log, decode, archive, delete, move, smtp_connect, smtp) which are timed separately per account, so a slow IMAP
+server or a regression shows up as one stage getting slower. The counters (scanned, matched, replied, deleted, errors, ...) are labelled the same way.
+
+Set metrics_port in the config to serve them while the program runs:
+
+    http://127.0.0.1:<metrics_port>/metrics        Prometheus text format
+    http://127.0.0.1:<metrics_port>/metrics.json   the same values as JSON
+    http://127.0.0.1:<metrics_port>/readyz         200 once the bot is running, for readiness probes
+    http://127.0.0.1:<metrics_port>/healthz        200 as long as the bot keeps checking, for liveness probes
+"""
+
+import json
+import threading
+from contextlib import contextmanager
+from time import perf_counter, time, monotonic
+
+PREFIX = 'emailautoblock_'
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# how many seconds a heartbeat may be late before /healthz fails, a pass over a big folder takes a while
+HEARTBEAT_GRACE = 600
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+               for name, value in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+class Histogram:
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Estimates a quantile from the buckets, like Prometheus' histogram_quantile().
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, in_bucket in zip(BUCKETS, self.buckets):
+            if in_bucket and seen + in_bucket >= rank:
+                return min(lower + (bound - lower) * (rank - seen) / in_bucket, self.max)
+            seen += in_bucket
+            lower = bound
+        return self.max
+
+
+class Metrics:
+    """
+    Can be used from several threads at once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time()
+
+        # set by the daemon once the bot runs
+        self.ready = False
+        # the next heartbeat is due before this monotonic() time, None before the first one
+        self.heartbeat_due = None
+
+    def heartbeat(self, next_in):
+        """
+        Tells the health check that the bot is still checking emails.
+
+        :param next_in: The number of seconds until the next heartbeat, e.g. the sleep before the next pass. Passes
+                        may take HEARTBEAT_GRACE seconds longer before the bot counts as stuck.
+        """
+        self.heartbeat_due = monotonic() + next_in + HEARTBEAT_GRACE
+
+    def healthy(self):
+        return self.heartbeat_due is None or monotonic() < self.heartbeat_due
+
+    def count(self, name, value=1, **labels):
+        """
+        Adds to a counter.
+
+        :param name: The counter, e.g. 'scanned'.
+        :param value: How much to add.
+        :param labels: Labels like account='me@example.com'.
+        """
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Adds a measurement to a histogram.
+
+        :param name: The histogram, e.g. 'stage_seconds'.
+        :param value: The measured value.
+        :param labels: Labels like stage='search'.
+        """
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def stage(self, name, **labels):
+        """
+        Times the code in the with block as one stage of a pass.
+
+        :param name: The stage, e.g. 'fetch'.
+        :param labels: Labels like account='me@example.com'.
+        """
+        start_time = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', perf_counter() - start_time, stage=name, **labels)
+
+    def prometheus(self):
+        """
+        Returns all metrics in the Prometheus text format.
+        """
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append('# TYPE ' + PREFIX + name + '_total counter')
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append(PREFIX + name + '_total' + _format_labels(labels) + ' ' + str(value))
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append('# TYPE ' + PREFIX + name + ' histogram')
+                for (histogram_name, labels), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, in_bucket in zip(BUCKETS, histogram.buckets):
+                        cumulative += in_bucket
+                        lines.append(PREFIX + name + '_bucket' + _format_labels(labels, [('le', bound)]) + ' ' +
+                                     str(cumulative))
+                    lines.append(PREFIX + name + '_bucket' + _format_labels(labels, [('le', '+Inf')]) + ' ' +
+                                 str(histogram.count))
+                    lines.append(PREFIX + name + '_sum' + _format_labels(labels) + ' ' + repr(histogram.sum))
+                    lines.append(PREFIX + name + '_count' + _format_labels(labels) + ' ' + str(histogram.count))
+
+            lines.append('# TYPE ' + PREFIX + 'uptime_seconds gauge')
+            lines.append(PREFIX + 'uptime_seconds ' + '{:.1f}'.format(time() - self.started))
+        return '\n'.join(lines) + '\n'
+
+    def as_json(self):
+        """
+        Returns all metrics as a JSON serializable dict, with p50 and p99 estimates for the histograms.
+        """
+        with self._lock:
+            return {
+                'uptime_seconds': round(time() - self.started, 1),
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                'histograms': [{'name': name, 'labels': dict(labels), 'count': histogram.count,
+                                'sum': round(histogram.sum, 6), 'max': round(histogram.max, 6),
+                                'p50': round(histogram.quantile(0.5), 6), 'p99': round(histogram.quantile(0.99), 6)}
+                               for (name, labels), histogram in sorted(self.histograms.items())],
+            }
+
+    def serve(self, port, address='127.0.0.1'):
+        """
+        Serves the metrics over HTTP from a background thread.
+
+        :param port: The port to listen on.
+        :param address: The address to listen on, only this computer by default.
+        :return: The server, call shutdown() on it to stop it.
+        """
+        # only imported when the metrics are served, the http package is slow to import
+        from http.server import ThreadingHTTPServer
+
+        server = ThreadingHTTPServer((address, port), _handler(self))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+
+def _handler(registry):
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path in ('/readyz', '/healthz'):
+                ok = registry.ready if self.path == '/readyz' else registry.healthy()
+                body = b'ok\n' if ok else b'starting\n' if self.path == '/readyz' else b'stuck\n'
+                self.send_response(200 if ok else 503)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            if self.path == '/metrics':
+                body = registry.prometheus().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            elif self.path == '/metrics.json':
+                body = json.dumps(registry.as_json()).encode('utf-8')
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            # scrapes every few seconds would flood the output
+            pass
+
+    return Handler
+
+
+# the metrics of this process
+metrics = Metrics()
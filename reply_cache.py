@@ -0,0 +1,179 @@
+"""
+Decides whether a blocked email gets an auto-reply, so a spammer who sends 200 emails doesn't get 200 replies.
+
+A reply is suppressed when:
+    - the email was sent by a machine (Auto-Submitted, Precedence: bulk, mailing lists, bounces), since replying to
+      those starts reply loops with other autoresponders
+    - the same sender (or the same thread, with reply_cache_key: thread) was replied to within the last
+      reply_cache_hours hours
+    - the sender got sender_reply_limit replies within the last day
+    - global_reply_limit replies were sent within the last hour
+
+The cache is kept in reply_cache.json in state_dir so it survives restarts. It holds at most reply_cache_size
+senders, the ones that were replied to longest ago are dropped first.
+"""
+
+import re
+import threading
+from collections import OrderedDict, deque
+from email.utils import parseaddr
+from time import time
+from metrics import metrics
+from widgets import easy_read, easy_write
+
+# kept in state_dir, see config_service.state_path()
+CACHE_FILE = 'reply_cache.json'
+
+SENDER_WINDOW = 24 * 60 * 60
+GLOBAL_WINDOW = 60 * 60
+
+# the headers needed to recognise automatic emails and threads
+HEADER_FIELDS = ('AUTO-SUBMITTED', 'PRECEDENCE', 'LIST-ID', 'LIST-UNSUBSCRIBE', 'X-AUTO-RESPONSE-SUPPRESS',
+                 'RETURN-PATH', 'MESSAGE-ID', 'IN-REPLY-TO', 'REFERENCES')
+
+_automatic_sender = re.compile(r'^(mailer-daemon|postmaster|no-?reply|do-?not-?reply|bounces?)([+\-.@]|$)')
+
+
+def automatic_reason(message):
+    """
+    Checks whether an email was sent by a machine.
+
+    :param message: A FetchedMessage with the HEADER_FIELDS downloaded.
+    :return: Why the email counts as automatic, or None.
+    """
+    auto_submitted = message.header('Auto-Submitted').lower()
+    if auto_submitted and auto_submitted != 'no':
+        return 'auto-submitted'
+
+    if message.header('Precedence').lower() in ('bulk', 'junk', 'list', 'auto_reply'):
+        return 'bulk'
+
+    if message.header('List-Id') or message.header('List-Unsubscribe'):
+        return 'mailing list'
+
+    suppress = message.header('X-Auto-Response-Suppress').lower()
+    if any(value in suppress for value in ('all', 'autoreply', 'oof')):
+        return 'auto-response suppressed'
+
+    if message.header('Return-Path') == '<>':
+        return 'bounce'
+
+    if _automatic_sender.match(parseaddr(message.sender)[1].lower()):
+        return 'automatic sender'
+
+    return None
+
+
+def thread_id(message):
+    """
+    Returns the Message-ID of the first email of the thread an email belongs to.
+    """
+    references = message.header('References').split()
+    if references:
+        return references[0]
+    return message.header('In-Reply-To') or message.header('Message-ID')
+
+
+class ReplyCache:
+    """
+    Can be shared by several accounts, the global limit then covers all of them.
+    """
+
+    def __init__(self, settings, filename=CACHE_FILE):
+        """
+        :param settings: The config dict.
+        :param filename: Where the cache is kept between restarts.
+        """
+        self.filename = filename
+        self.configure(settings)
+
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'automatic': 0, 'rate_limited': 0}
+
+        try:
+            saved = easy_read(filename, 'JSON')
+        except (FileNotFoundError, ValueError):
+            saved = {}
+
+        # key -> time of the last reply, least recently replied first
+        self.replied = OrderedDict(saved.get('replied', {}))
+        # sender -> times of the replies within the last day
+        self.sender_times = OrderedDict((sender, deque(times)) for sender, times in saved.get('senders', {}).items())
+        self.global_times = deque(saved.get('global', []))
+
+    def configure(self, settings):
+        """
+        Applies the reply_cache_* and *_reply_limit settings of a newly loaded config.
+
+        :param settings: The config dict.
+        """
+        self.ttl = settings['reply_cache_hours'] * 60 * 60
+        self.max_entries = settings['reply_cache_size']
+        self.key = settings['reply_cache_key']
+        self.sender_limit = settings['sender_reply_limit']
+        self.global_limit = settings['global_reply_limit']
+
+    def _count(self, name, account):
+        # exported as reply_cache_hits, reply_cache_misses, ... for /metrics
+        self.counters[name] += 1
+        metrics.count('reply_cache_' + name, account=account)
+
+    def allow(self, message, account=''):
+        """
+        Decides whether a blocked email gets a reply. If it does, the reply is counted right away.
+
+        :param message: A FetchedMessage with the HEADER_FIELDS downloaded.
+        :param account: The account the email was found in, for the metrics.
+        :return: None if the reply may be sent, otherwise why it is suppressed.
+        """
+        reason = automatic_reason(message)
+        if reason is not None:
+            with self._lock:
+                self._count('automatic', account)
+            return reason
+
+        sender = parseaddr(message.sender)[1].lower()
+        key = sender + ' ' + thread_id(message) if self.key == 'thread' else sender
+        now = time()
+
+        with self._lock:
+            last_reply = self.replied.get(key)
+            if last_reply is not None and now - last_reply < self.ttl:
+                self._count('hits', account)
+                return 'already replied'
+            self._count('misses', account)
+
+            times = self.sender_times.get(sender, deque())
+            _expire(times, now - SENDER_WINDOW)
+            _expire(self.global_times, now - GLOBAL_WINDOW)
+            if len(times) >= self.sender_limit or len(self.global_times) >= self.global_limit:
+                self._count('rate_limited', account)
+                return 'rate limited'
+
+            times.append(now)
+            self.global_times.append(now)
+            self.sender_times[sender] = times
+            self.sender_times.move_to_end(sender)
+            self.replied[key] = now
+            self.replied.move_to_end(key)
+
+            while len(self.replied) > self.max_entries:
+                self.replied.popitem(last=False)
+            while len(self.sender_times) > self.max_entries:
+                self.sender_times.popitem(last=False)
+
+        return None
+
+    def save(self):
+        now = time()
+        with self._lock:
+            replied = {key: at for key, at in self.replied.items() if now - at < self.ttl}
+            senders = {sender: list(times) for sender, times in self.sender_times.items()
+                       if times and now - times[-1] < SENDER_WINDOW}
+            easy_write(self.filename, {'replied': replied, 'senders': senders, 'global': list(self.global_times)},
+                       'JSON')
+
+
+def _expire(times, before):
+    while times and times[0] < before:
+        times.popleft()
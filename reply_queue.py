@@ -0,0 +1,175 @@
+"""
+Sends the auto-replies in the background, so a slow or unreachable SMTP server never holds up checking and deleting
+emails.
+
+Every reply is written to the spool directory before it is queued and only removed once it was sent, so replies that
+were still waiting when the program stopped are sent after the next start. Failed replies are retried with an
+exponential backoff and moved to "spool/failed" once they ran out of attempts, just like spool files that can't be
+read. Spool files are written to a temporary file first, so a crash never leaves half a reply behind.
+"""
+
+import os
+import queue
+import threading
+import uuid
+from time import time
+from widgets import easy_read, easy_write, Style, log
+
+SPOOL_DIR = 'spool'
+
+
+class ReplyQueue:
+
+    def __init__(self, send_function, spool_dir=SPOOL_DIR, max_queued=100, workers=2, per_server=2, retries=5,
+                 retry_delay=60):
+        """
+        :param send_function: Called with the keyword arguments given to put() to actually send a reply.
+        :param spool_dir: Where queued replies are kept until they were sent.
+        :param max_queued: How many replies are held in memory. Any more wait in the spool directory.
+        :param workers: How many replies are sent at the same time.
+        :param per_server: How many replies are sent to the same SMTP server at the same time.
+        :param retries: How many times a failed reply is tried again.
+        :param retry_delay: Seconds to wait before the first retry. Doubles after every failed attempt.
+        """
+        self.send_function = send_function
+        self.spool_dir = spool_dir
+        self.workers = workers
+        self.per_server = per_server
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._queued = set()
+        self._server_limits = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+
+        os.makedirs(os.path.join(spool_dir, 'failed'), exist_ok=True)
+
+    def start(self):
+        """
+        Starts the worker threads and queues all replies left in the spool directory.
+        """
+        self._refill()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """
+        Lets the workers finish the replies they are sending right now. Everything else stays in the spool.
+        """
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def put(self, server, **reply):
+        """
+        Queues a reply. Returns right away, even if the queue is full; the reply is picked up from the spool directory
+        once there is room again.
+
+        :param server: The SMTP server the reply goes through, used for the per-server limit.
+        :param reply: The keyword arguments for the send function.
+        """
+        filename = os.path.join(self.spool_dir, str(int(time() * 1000)) + '-' + uuid.uuid4().hex + '.json')
+        self._write(filename, {'server': server, 'attempts': 0, 'reply': reply})
+        self._enqueue(filename)
+
+    def pending(self):
+        """
+        Returns how many replies are waiting to be sent.
+        """
+        return len([name for name in os.listdir(self.spool_dir) if name.endswith('.json')])
+
+    def _write(self, filename, job):
+        # the temporary file doesn't end with .json, so it is never picked up while it is written
+        temporary = filename + '.tmp'
+        easy_write(temporary, job, 'JSON')
+        os.replace(temporary, filename)
+
+    def _move_to_failed(self, filename):
+        os.replace(filename, os.path.join(self.spool_dir, 'failed', os.path.basename(filename)))
+
+    def _enqueue(self, filename):
+        with self._lock:
+            if filename in self._queued:
+                return
+            try:
+                self._queue.put_nowait(filename)
+            except queue.Full:
+                return
+            self._queued.add(filename)
+
+    def _refill(self):
+        # oldest first, the file names start with a timestamp
+        for name in sorted(os.listdir(self.spool_dir)):
+            if name.endswith('.json'):
+                self._enqueue(os.path.join(self.spool_dir, name))
+
+    def _server_limit(self, server):
+        with self._lock:
+            if server not in self._server_limits:
+                self._server_limits[server] = threading.BoundedSemaphore(self.per_server)
+            return self._server_limits[server]
+
+    def _work(self):
+        while not self._stopped.is_set():
+            try:
+                filename = self._queue.get(timeout=1)
+            except queue.Empty:
+                self._refill()
+                continue
+
+            try:
+                self._send(filename)
+            finally:
+                with self._lock:
+                    self._queued.discard(filename)
+
+    def _send(self, filename):
+        try:
+            job = easy_read(filename, 'JSON')
+        except FileNotFoundError:
+            return
+        except ValueError:
+            job = None
+
+        # a broken file would otherwise be picked up again every second
+        if not isinstance(job, dict) or not {'server', 'attempts', 'reply'} <= job.keys():
+            self._move_to_failed(filename)
+            log(' The spool file "' + filename + '" can\'t be read, it was moved to "' + self.spool_dir + '/failed".',
+                Style.red, 'error', spool_file=filename)
+            return
+
+        # don't send a reply that is still waiting for its retry
+        if job.get('retry_at', 0) > time():
+            return
+
+        try:
+            with self._server_limit(job['server']):
+                self.send_function(**job['reply'])
+        except Exception as e:
+            job['attempts'] += 1
+            log(' Sending the reply to ' + job['reply'].get('receiver_email', '') + ' failed (' + type(e).__name__ +
+                ': ' + str(e) + ')', Style.red, 'warning', server=job['server'], attempts=job['attempts'])
+
+            if job['attempts'] > self.retries:
+                self._move_to_failed(filename)
+                log(' Giving up, the reply was moved to "' + self.spool_dir + '/failed".', Style.red, 'error',
+                    server=job['server'])
+                return
+
+            delay = self.retry_delay * 2 ** (job['attempts'] - 1)
+            job['retry_at'] = time() + delay
+            self._write(filename, job)
+
+            timer = threading.Timer(delay, self._enqueue, args=(filename,))
+            timer.daemon = True
+            timer.start()
+            return
+
+        os.remove(filename)
+        log(' Email replied to: ' + job['reply'].get('receiver_email', ''), server=job['server'])
@@ -0,0 +1,136 @@
+"""
+Builds the auto-reply emails from the templates in templates/.
+
+The templates can contain the placeholders $sender, $subject and $date, which are filled in with the details of the
+blocked email. The values come from the sender, so they are HTML escaped in the HTML template. Template parts without placeholders (usually the HTML one) are MIME encoded once when the template is
+loaded and the cached bytes are reused for every reply, so only the parts that differ per reply are encoded again.
+The templates are reloaded automatically when the files change on disk.
+"""
+
+import os
+import threading
+import uuid
+from email.mime.text import MIMEText
+from email.policy import SMTP
+from email.utils import formatdate, make_msgid
+from html import escape
+from string import Template
+from widgets import easy_read, easy_write
+
+HTML_TEMPLATE = 'templates/fancy_template.html'
+PLAIN_TEMPLATE = 'templates/plain_template.txt'
+DEFAULT_PLAIN_TEXT = 'Email could not be delivered.'
+
+
+def quote_original(sender, date, text):
+    """
+    Formats the blocked email as a quote for the reply.
+
+    :param sender: The sender of the blocked email.
+    :param date: The date of the blocked email as a datetime.
+    :param text: The decoded body of the blocked email.
+    :return: The quoted email.
+    """
+    header = 'On ' + date.strftime('%b %d, %Y, at %I:%M %p') + ', ' + sender + ' wrote:'
+    return '> ' + header + '\n> \n' + ''.join('> ' + line + '\n' for line in text.splitlines())
+
+
+def _encode_part(text, subtype):
+    return MIMEText(text, subtype, 'utf-8', policy=SMTP).as_bytes()
+
+
+def _has_placeholders(template):
+    # like Template.get_identifiers(), which needs Python 3.11
+    return any(found.group('named') or found.group('braced') for found in template.pattern.finditer(template.template))
+
+
+def _header(name, value):
+    # the header object encodes non-ASCII values (e.g. the subject) as RFC 2047 encoded words
+    return SMTP.header_factory(name, value).fold(policy=SMTP).encode('ascii')
+
+
+class _TemplateFile:
+
+    def __init__(self, filename, subtype):
+        self.filename = filename
+        self.subtype = subtype
+        self.mtime = -1
+        self.template = None
+        self.encoded = None
+
+    def reload_if_changed(self):
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+
+        if mtime is None:
+            self.template = self.encoded = None
+            return
+
+        self.template = Template(easy_read(self.filename))
+
+        # without placeholders the part is the same for every reply, so it is encoded right away
+        self.encoded = None if _has_placeholders(self.template) else _encode_part(self.template.template, self.subtype)
+
+    def render(self, values):
+        if self.subtype == 'html':
+            # a subject like '<a href="...">' would otherwise be sent as markup from the user's account
+            values = {key: escape(str(value)) for key, value in values.items()}
+        return self.template.safe_substitute(values)
+
+
+class ReplyTemplates:
+
+    def __init__(self, html_filename=HTML_TEMPLATE, plain_filename=PLAIN_TEMPLATE):
+        # the plain text template is needed for every reply
+        if not os.path.isfile(plain_filename):
+            os.makedirs(os.path.dirname(plain_filename) or '.', exist_ok=True)
+            easy_write(plain_filename, DEFAULT_PLAIN_TEXT)
+
+        self.html = _TemplateFile(html_filename, 'html')
+        self.plain = _TemplateFile(plain_filename, 'plain')
+        self._lock = threading.Lock()
+
+    def build(self, sender_email, receiver_email, subject, quoted='', values=None):
+        """
+        Builds a reply email.
+
+        :param sender_email: The address the reply is sent from.
+        :param receiver_email: The address the reply is sent to.
+        :param subject: The subject of the reply.
+        :param quoted: The quoted original email, added below the plain text template.
+        :param values: The values for the placeholders: sender, subject and date.
+        :return: The full email as bytes, ready for smtplib's sendmail.
+        """
+        values = values or {}
+
+        with self._lock:
+            self.html.reload_if_changed()
+            self.plain.reload_if_changed()
+            html, plain = self.html, self.plain
+
+            plain_text = plain.render(values) if plain.template is not None else DEFAULT_PLAIN_TEXT
+            if quoted:
+                plain_text += '\n\n\n' + quoted
+            parts = [_encode_part(plain_text, 'plain')]
+
+            if html.template is not None:
+                parts.append(html.encoded or _encode_part(html.render(values), 'html'))
+
+        boundary = ('=' * 15 + uuid.uuid4().hex).encode('ascii')
+        head = (_header('Subject', subject) +
+                _header('From', sender_email) +
+                _header('To', receiver_email) +
+                _header('Date', formatdate(localtime=True)) +
+                _header('Message-ID', make_msgid()) +
+                b'MIME-Version: 1.0\r\n' +
+                b'Content-Type: multipart/alternative; boundary="' + boundary + b'"\r\n'
+                b'\r\n')
+
+        body = b''.join(b'--' + boundary + b'\r\n' + part + b'\r\n' for part in parts)
+        return head + body + b'--' + boundary + b'--\r\n'
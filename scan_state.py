@@ -0,0 +1,107 @@
+"""
+Remembers how far each mail folder has been scanned, so a pass only has to look at emails that arrived since the last
+one.
+
+The state is kept per folder as the folder's UIDVALIDITY and the highest UID that was processed. If the server
+changes UIDVALIDITY (the UIDs were renumbered) or the blacklist changes, the folder is scanned from the start again.
+A backfill in stream mode goes from the newest emails to the oldest, so until it is done the range of UIDs it already
+covered is kept as well. Emails that couldn't be checked or handled are kept with the number of failed attempts, so
+they are tried again even though the scan has moved past them.
+"""
+
+import hashlib
+import json
+import threading
+from widgets import easy_read, easy_write
+
+# kept in state_dir, see config_service.state_path()
+STATE_FILE = 'state.json'
+
+
+def search_key(blacklist, rules=()):
+    """
+    A short fingerprint of the blacklist and the content rules. Old emails have to be searched again when new entries
+    are added.
+
+    :param blacklist: The blacklist from the config.
+    :param rules: The content rules from the config.
+    :return: A hex digest string.
+    """
+    text = '\n'.join(sorted(blacklist))
+    if rules:
+        text += '\n' + json.dumps([dict(rule) for rule in rules], sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+class ScanState:
+    """
+    Can be shared by several accounts that are checked at the same time.
+    """
+
+    def __init__(self, filename=STATE_FILE):
+        self.filename = filename
+        self._lock = threading.Lock()
+        try:
+            self.folders = easy_read(filename, 'JSON')
+        except (FileNotFoundError, ValueError):
+            self.folders = {}
+
+    def last_uid(self, folder, uidvalidity, key):
+        """
+        Returns the highest UID that was already processed in a folder or 0 if the folder has to be scanned fully.
+
+        :param folder: The account and mail folder, e.g. 'me@example.com/inbox'.
+        :param uidvalidity: The UIDVALIDITY the server reported when selecting the folder.
+        :param key: The blacklist fingerprint from search_key().
+        """
+        state = self.folders.get(folder)
+        if not state or state.get('uidvalidity') != uidvalidity or state.get('search_key') != key:
+            return 0
+        return state.get('last_uid', 0)
+
+    def backfill(self, folder, uidvalidity, key):
+        """
+        Returns the UIDs an unfinished backfill already covered as a (after, up to) tuple, or None.
+
+        :param folder: The account and mail folder.
+        :param uidvalidity: The UIDVALIDITY the server reported when selecting the folder.
+        :param key: The blacklist fingerprint from search_key().
+        """
+        state = self.folders.get(folder)
+        if not state or state.get('uidvalidity') != uidvalidity or state.get('search_key') != key or \
+                not state.get('backfill'):
+            return None
+        return tuple(state['backfill'])
+
+    def retries(self, folder, uidvalidity, key):
+        """
+        Returns the emails that failed in earlier passes as a dict of UID -> failed attempts.
+
+        :param folder: The account and mail folder.
+        :param uidvalidity: The UIDVALIDITY the server reported when selecting the folder.
+        :param key: The blacklist fingerprint from search_key().
+        """
+        state = self.folders.get(folder)
+        if not state or state.get('uidvalidity') != uidvalidity or state.get('search_key') != key:
+            return {}
+        return {uid: attempts for uid, attempts in state.get('retry', [])}
+
+    def update(self, folder, uidvalidity, key, last_uid, backfill=None, retries=None):
+        """
+        :param backfill: The (after, up to) UIDs an unfinished backfill covered, above last_uid.
+        :param retries: The emails to try again as a dict of UID -> failed attempts.
+        """
+        with self._lock:
+            self.folders[folder] = {
+                'uidvalidity': uidvalidity,
+                'search_key': key,
+                'last_uid': last_uid,
+            }
+            if backfill:
+                self.folders[folder]['backfill'] = list(backfill)
+            if retries:
+                self.folders[folder]['retry'] = sorted([uid, attempts] for uid, attempts in retries.items())
+
+    def save(self):
+        with self._lock:
+            easy_write(self.filename, self.folders, 'JSON')
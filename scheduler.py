@@ -0,0 +1,104 @@
+"""
+Decides when a folder is checked next.
+
+update_interval is the time between passes in minutes and can be any number, 0.5 checks every 30 seconds. Passes are
+not tied to the clock, so several bots don't all hit the mail server at the full minute, and every wait is made up to
+poll_jitter (0.1 = 10%) shorter or longer at random.
+
+With adaptive_polling: true the interval of every folder follows how many of its emails get blocked:
+
+    spam burst      the interval shrinks so that about one blocked email is found per pass, down to min_poll_seconds
+    quiet           the interval grows by half with every pass that blocks nothing, up to twice update_interval
+
+The blocked rate is averaged over the last few passes, so a single spam email doesn't change much.
+
+After a failed pass (a network error, a failed login) the next try comes after retry_seconds, doubled with every
+further failure up to max_retry_seconds, instead of trying a server that is down again and again.
+"""
+
+import random
+from time import monotonic
+
+# the config keys of the scheduler
+SCHEDULE_KEYS = ('update_interval', 'adaptive_polling', 'min_poll_seconds', 'poll_jitter', 'retry_seconds',
+                 'max_retry_seconds')
+
+# the number of blocked emails per pass adaptive polling aims for
+TARGET_BLOCKED = 1.0
+
+# how much the latest pass counts in the average blocked rate
+RATE_WEIGHT = 0.5
+
+# how fast the interval grows while nothing is blocked
+QUIET_GROWTH = 1.5
+
+# how many times update_interval the interval can grow to, so new spam never waits much longer than configured
+QUIET_LIMIT = 2
+
+
+class Scheduler:
+    """
+    Keeps the interval of a single folder.
+    """
+
+    def __init__(self, settings):
+        """
+        :param settings: The config dict.
+        """
+        self.configure(settings)
+
+        # blocked emails per second, averaged over the last passes
+        self.rate = 0.0
+        self.failures = 0
+        self.last_pass = None
+
+    def configure(self, settings):
+        """
+        Applies the update_interval, *_poll* and *retry_seconds settings of a newly loaded config. The interval starts
+        over from update_interval.
+
+        :param settings: The config dict.
+        """
+        self.base = settings['update_interval'] * 60
+        self.adaptive = settings['adaptive_polling']
+        self.min_interval = min(settings['min_poll_seconds'], self.base)
+        self.max_interval = self.base * QUIET_LIMIT
+        self.jitter = settings['poll_jitter']
+        self.retry = settings['retry_seconds']
+        self.max_retry = settings['max_retry_seconds']
+        self.interval = self.base
+
+    def record(self, blocked):
+        """
+        Adapts the interval to a pass that went through.
+
+        :param blocked: The number of emails the pass blocked.
+        """
+        now = monotonic()
+        elapsed = now - self.last_pass if self.last_pass is not None else self.interval
+        self.last_pass = now
+        self.failures = 0
+
+        if not self.adaptive:
+            return
+
+        self.rate += RATE_WEIGHT * (blocked / max(elapsed, 1.0) - self.rate)
+        wanted = TARGET_BLOCKED / self.rate if self.rate else self.max_interval
+        # a burst shortens the interval right away, while it only grows step by step once the burst is over
+        self.interval = max(self.min_interval, min(wanted, self.interval * QUIET_GROWTH, self.max_interval))
+
+    def record_failure(self):
+        """
+        Backs off after a failed pass.
+        """
+        self.failures += 1
+
+    def next_delay(self):
+        """
+        :return: The seconds until the folder should be checked again, with jitter.
+        """
+        if self.failures:
+            delay = min(self.retry * 2 ** min(self.failures - 1, 32), self.max_retry)
+        else:
+            delay = self.interval
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
@@ -0,0 +1,105 @@
+"""
+Builds the IMAP SEARCH commands for the blacklist.
+
+IMAP's OR takes exactly two search keys, so n entries need n - 1 nested ORs:
+
+    OR OR FROM "a" FROM "b" FROM "c"
+
+The ORs are nested as a balanced tree and every value is quoted, so entries with spaces or quotes work too. Large
+blacklists are split into several searches that each stay below a command size budget, since servers reject
+overlong command lines. The UIDs found by all of them are merged.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from imap_tools import uid_search
+
+# the size of the " OR " glue around every key
+_OR_OVERHEAD = 4
+
+
+def quote(value):
+    """
+    Quotes a value for use in a search command. For example, 'say "hi"' becomes '"say \\"hi\\""'.
+    """
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def or_tree(keys):
+    """
+    Joins search keys with ORs nested as a balanced tree.
+
+    :param keys: A non-empty list of search keys, e.g. ['FROM "a"', 'FROM "b"'].
+    :return: A single search key that matches if any of the keys match.
+    """
+    if len(keys) == 1:
+        return keys[0]
+    middle = len(keys) // 2
+    return 'OR ' + or_tree(keys[:middle]) + ' ' + or_tree(keys[middle:])
+
+
+def plan_search(terms, field='FROM', budget=8000):
+    """
+    Turns the blacklist search terms into as few search queries as possible that each stay within the budget.
+
+    :param terms: Strings to search the field for, or None to search every email.
+    :param field: The header to search, e.g. 'FROM'.
+    :param budget: The maximum length of a single query in bytes.
+    :return: A list of search queries.
+    """
+    if terms is None or not terms:
+        return ['ALL']
+
+    # quoted strings have to be 7-bit, anything else can only be checked locally
+    if not all(term.isascii() for term in terms):
+        return ['ALL']
+
+    keys = [field + ' ' + quote(term) for term in dict.fromkeys(terms)]
+
+    chunks = [[]]
+    size = 0
+    for key in keys:
+        if chunks[-1] and size + len(key) + _OR_OVERHEAD > budget:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(key)
+        size += len(key) + _OR_OVERHEAD
+
+    return [or_tree(chunk) for chunk in chunks]
+
+
+def run_search(imap, queries, after_uid=0, connect=None, connections=1, up_to_uid=None):
+    """
+    Runs the search queries and merges the results.
+
+    :param imap: A logged in imaplib connection with the mailbox selected.
+    :param queries: The queries from plan_search().
+    :param after_uid: Only return UIDs greater than this.
+    :param connect: Opens another connection with the mailbox selected, needed when connections is more than 1.
+    :param connections: How many connections to spread the queries over.
+    :param up_to_uid: Only return UIDs up to this one, None for no limit.
+    :return: A sorted list of UIDs.
+    """
+    if connections <= 1 or connect is None or len(queries) == 1:
+        uids = set()
+        for query in queries:
+            uids.update(uid_search(imap, query, after_uid, up_to_uid))
+        return sorted(uids)
+
+    # the given connection takes the first share, the others get their own connection each
+    shares = [queries[i::connections] for i in range(connections)]
+    shares = [share for share in shares if share]
+
+    def search_share(share):
+        extra = connect()
+        try:
+            return run_search(extra, share, after_uid, up_to_uid=up_to_uid)
+        finally:
+            extra.logout()
+
+    with ThreadPoolExecutor(len(shares) - 1) as pool:
+        results = list(pool.map(search_share, shares[1:]))
+
+    uids = set(run_search(imap, shares[0], after_uid, up_to_uid=up_to_uid))
+    for result in results:
+        uids.update(result)
+    return sorted(uids)
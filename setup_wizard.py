@@ -22,6 +22,7 @@ class SetupWizard:
             'also_reply_to_email': True,
             'save_archive': True,
             'block_emails': True,
+            'idle_mode': True,
         }
         
         self.config_explain = {
@@ -35,22 +36,27 @@ class SetupWizard:
             'max_search_results': 'How many of the most recent emails will be checked for blacklist emails.\n',
             
             'update_interval': 'The interval in minutes between each update of the search results.\n'
-                               'Must be less than an hour.',
+                               'Can be any number, e.g. 0.5 for every 30 seconds. With "adaptive_polling: true" it '
+                               'gets shorter while a lot of spam arrives and up to twice as long while none does.',
             
             'also_reply_to_email': 'If enabled, the email will be replied to with the template provided in the config '
                                    'files.\n'
                                    'Feel free to edit this template.',
             
-            'save_archive': 'If enabled, the email will be saved in the emails archive after mailbox deletion as plain '
-                            'text.',
+            'save_archive': 'If enabled, the email will be saved in the compressed archive before mailbox deletion.\n'
+                            'Search it with "python3 archive.py".',
             
             'block_emails': 'Any emails on the blacklist will be permanently and unrecoverable deleted from your mail '
                             'account.',
+            
+            'idle_mode': 'If enabled, the connection to the mail server stays open and blocked emails are handled '
+                         'seconds after they arrive.\n'
+                         'Falls back to checking every "update_interval" minutes if the server doesn\'t support '
+                         'IMAP IDLE.',
         }
         
-        # check if in the correct directory
-        current_folder = os.getcwd().split('/')[-1]
-        if current_folder != 'emailBlockBot':
+        # check if in the correct directory, whatever the repository was cloned as
+        if os.path.abspath(os.getcwd()) != os.path.dirname(os.path.abspath(__file__)):
             print("It looks like your not running this from the correct directory!")
             print(
                 'Make sure you "cd" into this file. It would look something like this but with the folder this program '
@@ -108,6 +114,8 @@ class SetupWizard:
         print(Style.blue + Style.inverted + ' Step 2/3 - Block list' + Style.reset)
         print('Now you\'ll enter the addresses you want to block.')
         print('They can either be full addresses (johnny@gmail.com) or words in the address (@gmail, or johnny)')
+        print('For more control, start an entry with "exact:" (exact:johnny@gmail.com), "domain:" (domain:gmail.com) '
+              'or "regex:" (regex:^promo-[0-9]+@)')
         print('Just press enter when you\'re done.\n')
         
         self.blacklist = []
@@ -157,6 +165,8 @@ class SetupWizard:
                         # format the value
                         if new_value.isdigit():
                             new_value = int(new_value)
+                        elif new_value.replace('.', '', 1).isdigit():
+                            new_value = float(new_value)
                         elif new_value.lower() == 'true':
                             new_value = True
                         elif new_value.lower() == 'false':
@@ -33,6 +33,37 @@ def clear_console():
     os.system(command)
 
 
+# 'text' prints coloured lines for the terminal, 'json' prints one JSON object per line for log collectors
+log_format = 'text'
+
+
+def set_log_format(new_format):
+    global log_format
+    log_format = new_format
+
+
+def log(message, style='', level='info', **fields):
+    """
+    Prints a line of the program's output.
+    
+    :param message: The text to print.
+    :param style: Style colours used in the terminal, ignored for JSON logs.
+    :param level: 'info', 'warning' or 'error'.
+    :param fields: Extra values that are only included in JSON logs, e.g. account='me@example.com'.
+    """
+    if log_format == 'json':
+        print(json.dumps({
+            'time': datetime.datetime.now().astimezone().isoformat(timespec='milliseconds'),
+            'level': level,
+            'message': message.strip(),
+            **fields
+        }, ensure_ascii=False, default=str), flush=True)
+    elif style:
+        print(style + message + Style.reset)
+    else:
+        print(message)
+
+
 def easy_read(filename, filetype="TXT"):
     if filetype == "TXT":
         with open(filename, mode="r") as f:  # update program job
@@ -55,27 +86,6 @@ def easy_write(filename, write_data, filetype="TXT"):
         print("error. Filetype '%s' not found." % filetype)
 
 
-def sleep_time_until_checkpoint(minute_break):
-    """
-    Returns the time until the next checkpoint. E.g. if the current minute is 10, and the checkpoint is 15,
-    the function will return 5.
-    
-    :param minute_break:
-    :return:
-    """
-    now_second = datetime.datetime.now().second
-    now_minute = datetime.datetime.now().minute
-    
-    if 60 / minute_break == float(60 // minute_break):
-        next_break = 0
-        while now_minute >= next_break:
-            next_break += minute_break
-        
-        return (next_break - now_minute) * 60 - now_second
-    else:
-        return (60 - now_minute) * 60
-
-
 def wait_indicator(time_to_wait):
     # fun spinning loading indicator for terminal
     loading_icon = ['|', '/', '-', '\\']
@@ -84,6 +94,54 @@ def wait_indicator(time_to_wait):
         sleep(0.2)
 
 
+# values for settings that are missing from the config file, e.g. because it was created by an older version
+config_defaults = {
+    'rules': [],
+    'imap_port': 993,
+    'imap_ssl': True,
+    'smtp_starttls': True,
+    'idle_mode': True,
+    'idle_timeout': 25,
+    'smtp_pool_size': 2,
+    'reply_workers': 2,
+    'reply_queue_size': 100,
+    'reply_retries': 5,
+    'reply_retry_delay': 60,
+    'search_command_budget': 8000,
+    'search_connections': 1,
+    'max_body_bytes': 1048576,
+    'spool_dir': 'spool',
+    'engine_workers': 4,
+    'account_concurrency': 1,
+    'archive_backend': 'archive',
+    'archive_dir': 'archive',
+    'reply_cache_hours': 24,
+    'reply_cache_size': 10000,
+    'reply_cache_key': 'sender',
+    'sender_reply_limit': 3,
+    'global_reply_limit': 100,
+    'log_format': 'text',
+    'metrics_port': 0,
+    'metrics_address': '127.0.0.1',
+    'stream_mode': False,
+    'stream_window': 1000,
+    'stream_memory_mb': 64,
+    'block_action': 'delete',
+    'move_folder': 'Junk',
+    'quarantine_folder': 'Quarantine',
+    'quarantine_days': 30,
+    'shadow_mode': False,
+    'log_decisions': False,
+    'decision_log_file': 'decisions.jsonl.gz',
+    'state_dir': '',
+    'adaptive_polling': False,
+    'min_poll_seconds': 30,
+    'poll_jitter': 0.1,
+    'retry_seconds': 30,
+    'max_retry_seconds': 1800,
+}
+
+
 def config(set_to: dict = None):
     """
     Get or set the config file.
@@ -96,4 +154,4 @@ def config(set_to: dict = None):
             yaml.dump(set_to, f)
     else:
         with open('config files/config.yml', 'r') as stream:
-            return yaml.safe_load(stream)
+            return {**config_defaults, **yaml.safe_load(stream)}